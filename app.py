@@ -31,6 +31,9 @@ from opentelemetry.instrumentation.requests import RequestsInstrumentor
 from opentelemetry.resourcedetector.gcp_resource_detector import GoogleCloudResourceDetector
 
 import filter_feed
+import metrics
+import prefetch
+import settings_cache
 import view
 import model
 import ndb_user_datastore
@@ -41,6 +44,8 @@ from werkzeug.routing.converters import BaseConverter, ValidationError
 
 TRACE_EXPORTER = os.environ.get("TRACE_EXPORTER", "").lower()
 TRACE_PROPAGATE = os.environ.get("TRACE_PROPAGATE", "").lower()
+# "stackdriver", "stdout", "memory" (for tests) or empty for none.
+METRICS_EXPORTER = os.environ.get("METRICS_EXPORTER", "").lower()
 STACKDRIVER_ERROR_REPORTING = os.environ.get("STACKDRIVER_ERROR_REPORTING", "").lower() in (1, 'true', 't')
 LOG_HANDLER = os.environ.get("LOG_HANDLER", "").lower()
 PROJECT_ID = os.environ.get("PROJECT_ID", "filter-feed")
@@ -48,7 +53,7 @@ SECRET_KEY = os.environ.get('SECRET_KEY', "secret key only for DEBUG")
 SECURITY_PASSWORD_SALT = os.environ.get("SECURITY_PASSWORD_SALT", '257726044742079860569628914655245968662')
 
 resource = Resource.create({"service.name": PROJECT_ID})
-if TRACE_EXPORTER:
+if TRACE_EXPORTER or METRICS_EXPORTER:
     # slow, don't bother if we're not using it
     resource.merge(get_aggregated_resources([GoogleCloudResourceDetector()]))
 tracer_provider = TracerProvider(resource=resource)
@@ -69,6 +74,7 @@ elif TRACE_EXPORTER == "stdout":
     tracer_provider.add_span_processor(SimpleSpanProcessor(ConsoleSpanExporter()))
 
 trace.set_tracer_provider(tracer_provider)
+metrics.configure(METRICS_EXPORTER, resource)
 
 if LOG_HANDLER == 'absl':
     logging.use_absl_handler()
@@ -119,8 +125,11 @@ app.config['SECURITY_USER_IDENTITY_ATTRIBUTES'] = [
 app.config["NDB_PROJECT"] = PROJECT_ID
 
 cloud_ndb = CloudNDB(app)
+# Also used by the middleware CloudNDB installs, which calls client.context().
+cloud_ndb.client.context = settings_cache.context(cloud_ndb.client)
 user_datastore = ndb_user_datastore.NdbUserDatastore(model.User, model.Role)
 app.security = Security(app, user_datastore)
+prefetch.start(cloud_ndb.context)
 
 # hack to add NDB context for flask CLI
 original_invoke = click.Context.invoke
@@ -133,22 +142,28 @@ def wrapped_invoke(*args, **kwargs):
         return original_invoke(*args, **kwargs)
 click.Context.invoke = wrapped_invoke
 
+error_reporting_client = google.cloud.error_reporting.Client(project=PROJECT_ID)
+
+def report_exception(e: Exception, http_context: google.cloud.error_reporting.HTTPContext):
+    """Logs e, the exception being handled, and sends it to Google Error
+    Reporting if STACKDRIVER_ERROR_REPORTING is set."""
+    logging.exception(e)
+    if STACKDRIVER_ERROR_REPORTING:
+        try:
+            error_reporting_client.report_exception(http_context=http_context)
+        except Exception:
+            logging.exception("Failed to send error report to Google")
+
 def error_reporting(f):
-    client = google.cloud.error_reporting.Client(project=PROJECT_ID)
     @wraps(f)
     def wrapped(*args,  **kwargs):
         try:
             return f(*args,  **kwargs)
-        except werkzeug.exceptions.NotFound as e:
+        except (werkzeug.exceptions.NotFound, werkzeug.exceptions.BadGateway) as e:
+            # Missing feeds and failing upstreams are not errors in this app.
             raise
         except Exception as e:
-            logging.exception(e)
-            if STACKDRIVER_ERROR_REPORTING:
-                try:
-                    client.report_exception(
-                        http_context=google.cloud.error_reporting.build_flask_context(request))
-                except Exception:
-                    logging.exception("Failed to send error report to Google")
+            report_exception(e, google.cloud.error_reporting.build_flask_context(request))
             raise
     return wrapped
 
@@ -179,6 +194,20 @@ class KeyConverter(BaseConverter):
 app.url_map.converters['key'] = KeyConverter
 
 
+class KeyListConverter(BaseConverter):
+    """Several keys in KeyConverter's format, joined by "+"."""
+    regex = r"%s(\+%s)*" % (KeyConverter.regex, KeyConverter.regex)
+    part_isolating = False
+    def to_python(self, value: str) -> list[KeyConstructor]:
+        keys = [KeyConverter(self.map).to_python(part) for part in value.split("+")]
+        if len(keys) > filter_feed.MERGE_MAX_FEEDS:
+            raise ValidationError()
+        return keys
+    def to_url(self, value: list[Union[ndb.Key, KeyConstructor]]) -> str:
+        return "+".join(KeyConverter(self.map).to_url(key) for key in value)
+app.url_map.converters['keys'] = KeyListConverter
+
+
 @app.route('/v1/<key:key>.rss')
 @app.route('/v1/<key:key>.atom')
 @app.route('/v1/<key:key>.xml')
@@ -187,8 +216,20 @@ app.url_map.converters['key'] = KeyConverter
 def feed_by_key(key: KeyConstructor):
     key = ndb.Key(*key)
     with model.ApplyFilterPermission(key).require(403):
+        prefetch.record(key)
         return filter_feed.feed_by_key(request, key)
 
+@app.route('/v1/merge/<keys:keys>.rss')
+@app.route('/v1/merge/<keys:keys>.atom')
+@app.route('/v1/merge/<keys:keys>.xml')
+@app.route('/v1/merge/<keys:keys>')
+@error_reporting
+def merged_feed(keys: list[KeyConstructor]):
+    keys = [ndb.Key(*key) for key in keys]
+    if not all(model.ApplyFilterPermission(key).can() for key in keys):
+        flask.abort(403)
+    return filter_feed.merged_feed(request, keys)
+
 @app.route('/v1/')
 @app.route('/')
 @login_required
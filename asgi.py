@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""ASGI entry point.
+
+Feed requests, merged or not, are served on the event loop by filter_feed,
+so a single worker can wait on hundreds of slow upstreams at once. Everything
+else is handed to the Flask app unchanged. Run with
+
+    gunicorn -k uvicorn.workers.UvicornWorker asgi:application
+"""
+
+import re
+from typing import Optional
+
+from asgiref.wsgi import WsgiToAsgi
+from google.cloud import ndb
+import google.cloud.error_reporting
+import werkzeug.exceptions
+from werkzeug.routing import ValidationError
+
+from app import app, cloud_ndb, KeyConverter, KeyListConverter, report_exception
+import compress
+import filter_feed
+import prefetch
+
+FEED_PATH = re.compile(r"/v1/(%s)(\.rss|\.atom|\.xml)?" % KeyConverter.regex)
+MERGE_PATH = re.compile(r"/v1/merge/(%s)(\.rss|\.atom|\.xml)?" % KeyListConverter.regex)
+
+wsgi = WsgiToAsgi(app)
+
+
+async def _respond(send, status: int, body: bytes, content_type=None, headers=()):
+    headers = [(b"content-length", str(len(body)).encode("latin-1"))] + list(headers)
+    if content_type:
+        headers.append((b"content-type", content_type.encode("latin-1")))
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+def _header(scope, name: bytes) -> Optional[str]:
+    for key, value in scope["headers"]:
+        if key.lower() == name:
+            return value.decode("latin-1")
+    return None
+
+
+def _http_context(scope) -> google.cloud.error_reporting.HTTPContext:
+    """Like google.cloud.error_reporting.build_flask_context, for an ASGI request."""
+    host = _header(scope, b"host")
+    if host is None and scope.get("server"):
+        host = "%s:%d" % scope["server"]
+    url = "%s://%s%s" % (scope["scheme"], host, scope["path"])
+    if scope["query_string"]:
+        url += "?" + scope["query_string"].decode("latin-1")
+    client = scope.get("client")
+    return google.cloud.error_reporting.HTTPContext(
+        url=url,
+        method=scope["method"],
+        user_agent=_header(scope, b"user-agent"),
+        referrer=_header(scope, b"referer"),
+        remote_ip=client[0] if client else None)
+
+
+async def _respond_rendered(scope, send, render):
+    """Sends the feed render() returns, once awaited in an ndb context."""
+    # model.ApplyFilterPermission allows everyone, so unlike app.feed_by_key
+    # there is no identity to load.
+    try:
+        with cloud_ndb.context():
+            rendered = await render()
+    except werkzeug.exceptions.HTTPException as e:
+        await _respond(send, e.code, b"")
+        return
+    except Exception as e:
+        # As app.error_reporting does for the same routes under WSGI.
+        report_exception(e, _http_context(scope))
+        await _respond(send, 500, b"")
+        return
+    body, encoding = rendered.encoded(compress.negotiate(_header(scope, b"accept-encoding")))
+    headers = [(b"vary", b"Accept-Encoding")]
+    if encoding:
+        headers.append((b"content-encoding", encoding.encode("latin-1")))
+    await _respond(send, 200, body, rendered.content_type, headers)
+
+
+async def feed(scope, send, key_path: str):
+    try:
+        key_args = KeyConverter(app.url_map).to_python(key_path)
+    except ValidationError:
+        await _respond(send, 404, b"")
+        return
+
+    async def render():
+        # Keys can only be made inside the ndb context.
+        key = ndb.Key(*key_args)
+        prefetch.record(key)
+        return await filter_feed.feed_by_key_async(key)
+    await _respond_rendered(scope, send, render)
+
+
+async def merged_feed(scope, send, keys_path: str):
+    try:
+        keys_args = KeyListConverter(app.url_map).to_python(keys_path)
+    except ValidationError:
+        await _respond(send, 404, b"")
+        return
+
+    async def render():
+        return await filter_feed.merged_feed_async([ndb.Key(*args) for args in keys_args])
+    await _respond_rendered(scope, send, render)
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "http" and scope["method"] == "GET":
+        match = FEED_PATH.fullmatch(scope["path"])
+        if match:
+            await feed(scope, send, match.group(1))
+            return
+        match = MERGE_PATH.fullmatch(scope["path"])
+        if match:
+            await merged_feed(scope, send, match.group(1))
+            return
+    await wsgi(scope, receive, send)
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""Benchmarks the parse, filter and serialize stages on synthetic feeds.
+
+Runs every combination of the given parameters, and prints, per stage, the
+best time over --repeat runs, the throughput and the peak Python memory:
+
+    python3 benchmark.py --items=10,1000,50000 --formats=rss,atom \\
+        --output=bench.json
+    python3 benchmark.py --baseline=bench.json
+
+With --baseline, cases are compared to a previous --output, and the exit
+status is non-zero if any stage got slower by more than --max_slowdown.
+Peak memory is measured by tracemalloc in a separate run, so it does not
+include lxml's own (C) allocations. XML_BACKEND and RULE_ENGINE apply as in
+the service.
+"""
+
+from datetime import datetime, timedelta, timezone
+import gc
+import itertools
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable
+
+from absl import app, flags
+
+import dates
+import fetch
+import filter_feed
+import xml_backend
+from model import FilterFeed
+
+flags.DEFINE_list("items", ["10", "1000", "10000"], "items per feed (10 to 50000)")
+flags.DEFINE_list("description_bytes", ["256"], "approximate size of each item's description")
+flags.DEFINE_list("namespaces", ["2"], "extra namespaced elements per item, one namespace each")
+flags.DEFINE_list("rules", ["4"], "rules in the filter")
+flags.DEFINE_list("formats", ["rss"], "rss and/or atom")
+flags.DEFINE_integer("repeat", 3, "runs per stage; the fastest is reported")
+flags.DEFINE_integer("seed", 0, "seed for the synthetic feeds")
+flags.DEFINE_string("output", None, "write the results to this JSON file")
+flags.DEFINE_string("baseline", None, "compare to the results in this JSON file")
+flags.DEFINE_float("max_slowdown", 1.25, "largest tolerated ratio to the baseline time")
+
+FLAGS = flags.FLAGS
+
+ATOM = "http://www.w3.org/2005/Atom"
+WORDS = ("alpha", "boring", "cast", "deep", "episode", "feature", "guest", "history",
+         "interesting", "journal", "kind", "live", "music", "news", "open", "pod")
+
+
+def _text(rng: random.Random, size: int) -> str:
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)
+
+
+def synthetic_feed(items: int, description_bytes: int = 256, namespaces: int = 2,
+                   atom: bool = False, seed: int = 0) -> bytes:
+    """Generates an RSS or Atom feed with the given number of items, newest
+    first, each with namespaces extra elements in as many namespaces."""
+    rng = random.Random(seed)
+    declarations = "".join(' xmlns:x%d="http://example.com/ns/%d"' % (n, n) for n in range(namespaces))
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    parts = []
+    if atom:
+        parts.append('<?xml version="1.0" encoding="UTF-8"?>\n<feed xmlns="%s"%s>\n'
+                     '<title>Synthetic Feed</title>\n<id>urn:synthetic</id>\n'
+                     '<updated>%s</updated>\n' % (ATOM, declarations, start.isoformat()))
+    else:
+        parts.append('<?xml version="1.0" encoding="UTF-8"?>\n<rss version="2.0"%s>\n<channel>\n'
+                     '<title>Synthetic Feed</title>\n<link>http://example.com/</link>\n'
+                     '<description>A synthetic feed</description>\n' % declarations)
+    for i in range(items):
+        title = "%s Ep %d" % (rng.choice(("Boring", "Interesting", "Guest")), items - i)
+        date = start - timedelta(hours=i)
+        description = _text(rng, description_bytes)
+        extra = "".join("<x%d:extra>%s</x%d:extra>" % (n, rng.choice(WORDS), n)
+                        for n in range(namespaces))
+        if atom:
+            parts.append('<entry><title>%s</title><id>urn:synthetic:%d</id><updated>%s</updated>'
+                         '<summary>%s</summary><link href="http://example.com/%d"/>%s</entry>\n'
+                         % (title, i, date.isoformat(), description, i, extra))
+        else:
+            parts.append('<item><title>%s</title><guid>urn:synthetic:%d</guid>'
+                         '<pubDate>%s</pubDate><description>%s</description>'
+                         '<enclosure url="http://example.com/%d.mp3" length="1" type="audio/mpeg"/>'
+                         '%s</item>\n'
+                         % (title, i, date.strftime("%a, %d %b %Y %H:%M:%S +0000"), description,
+                            i, extra))
+    parts.append("</feed>\n" if atom else "</channel>\n</rss>\n")
+    return "".join(parts).encode("utf-8")
+
+
+def synthetic_filter(rules: int) -> FilterFeed:
+    """A filter of the given number of rules, all of which are evaluated for
+    most items: all but the last rarely match, and the last drops "Boring"
+    items."""
+    query = []
+    for n in range(rules - 1):
+        field = ("title", "description")[n % 2]
+        query.append({"id": field, "field": field, "type": "string", "input": "text",
+                      "operator": "not_contains", "value": "zz%d" % n})
+    query.append({"id": "title", "field": "title", "type": "string", "input": "text",
+                  "operator": "contains", "value": "Boring"})
+    return FilterFeed(url="http://example.com/feed", name="benchmark",
+                      query_builder={"condition": "AND", "rules": query})
+
+
+def _cold():
+    filter_feed.decision_index.clear()
+    filter_feed.parsed_cache.clear()
+    dates.parse.cache_clear()
+
+
+def _best(stage: Callable[[Any], Any], setup: Callable[[], Any], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        arg = setup()
+        gc.collect()
+        start = time.perf_counter()
+        stage(arg)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _peak(stage: Callable[[Any], Any], setup: Callable[[], Any]) -> int:
+    arg = setup()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        stage(arg)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_case(items: int, description_bytes: int, namespaces: int, rules: int, atom: bool,
+             repeat: int = 3, seed: int = 0) -> dict:
+    content = synthetic_feed(items, description_bytes, namespaces, atom, seed)
+    settings = synthetic_filter(rules)
+    document = xml_backend.document_class()
+    modify = filter_feed.modifyAtom if atom else filter_feed.modifyRss
+    upstream = fetch.Upstream("http://example.com/feed", content,
+                              "application/atom+xml" if atom else "application/rss+xml")
+
+    def parsed():
+        _cold()
+        return document(content)
+
+    def filtered():
+        doc = parsed()
+        modify(doc.root, settings)
+        return doc
+
+    def warm():
+        # As when the feed is refetched: decisions and dates are remembered.
+        doc = document(content)
+        modify(document(content).root, settings)
+        return doc
+
+    stages = {
+        "parse": (lambda _: document(content), _cold),
+        "filter": (lambda doc: modify(doc.root, settings), parsed),
+        "filter_warm": (lambda doc: modify(doc.root, settings), warm),
+        "serialize": (lambda doc: doc.tostring(doc.root), filtered),
+        "render": (lambda _: filter_feed.render_tree(upstream, settings), _cold),
+    }
+    results = {}
+    for name, (stage, setup) in stages.items():
+        seconds = _best(stage, setup, repeat)
+        results[name] = {
+            "seconds": seconds,
+            "items_per_second": items / seconds if seconds else None,
+            "mb_per_second": len(content) / 1e6 / seconds if seconds else None,
+            "peak_bytes": _peak(stage, setup),
+        }
+    return {
+        "name": "%s-%d-d%d-ns%d-r%d" % ("atom" if atom else "rss", items, description_bytes,
+                                        namespaces, rules),
+        "items": items,
+        "description_bytes": description_bytes,
+        "namespaces": namespaces,
+        "rules": rules,
+        "format": "atom" if atom else "rss",
+        "content_bytes": len(content),
+        "stages": results,
+    }
+
+
+def compare(results: dict, baseline: dict, max_slowdown: float) -> list[str]:
+    """Returns a description of each stage slower than baseline by more than
+    max_slowdown."""
+    before = {case["name"]: case for case in baseline["cases"]}
+    regressions = []
+    for case in results["cases"]:
+        old = before.get(case["name"])
+        if old is None:
+            continue
+        for stage, now in case["stages"].items():
+            then = old["stages"].get(stage)
+            if then is None or not then["seconds"]:
+                continue
+            ratio = now["seconds"] / then["seconds"]
+            now["baseline_ratio"] = ratio
+            if ratio > max_slowdown:
+                regressions.append("%s %s: %.4fs -> %.4fs (x%.2f)" % (
+                        case["name"], stage, then["seconds"], now["seconds"], ratio))
+    return regressions
+
+
+def main(_):
+    cases = []
+    for items, description_bytes, namespaces, rules, fmt in itertools.product(
+            FLAGS.items, FLAGS.description_bytes, FLAGS.namespaces, FLAGS.rules, FLAGS.formats):
+        case = run_case(int(items), int(description_bytes), int(namespaces), int(rules),
+                        fmt == "atom", FLAGS.repeat, FLAGS.seed)
+        cases.append(case)
+        print(case["name"], "(%d bytes)" % case["content_bytes"])
+        for stage, result in case["stages"].items():
+            print("  %-12s %9.4fs %12.0f items/s %8.1f MB/s %12d peak bytes" % (
+                    stage, result["seconds"], result["items_per_second"],
+                    result["mb_per_second"], result["peak_bytes"]))
+    results = {
+        "python": platform.python_version(),
+        "xml_backend": xml_backend.XML_BACKEND,
+        "rule_engine": filter_feed.RULE_ENGINE,
+        "cases": cases,
+    }
+    regressions = []
+    if FLAGS.baseline:
+        with open(FLAGS.baseline) as f:
+            regressions = compare(results, json.load(f), FLAGS.max_slowdown)
+        for regression in regressions:
+            print("REGRESSION", regression)
+    if FLAGS.output:
+        with open(FLAGS.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -0,0 +1,60 @@
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Hashable
+
+
+@dataclass
+class _Circuit:
+    failures: int = 0
+    open_until: float = 0.0
+    probing: bool = False
+
+
+class CircuitBreaker:
+    """Tracks consecutive failures per key (e.g. per upstream host).
+
+    After max_failures consecutive failures the circuit opens and allow()
+    refuses requests for cooldown seconds. Then it is half open: a single
+    probe is allowed through, and its outcome either closes the circuit again
+    or reopens it for another cooldown.
+    """
+
+    def __init__(self, max_failures: int, cooldown: float,
+                 clock: Callable[[], float] = time.monotonic):
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.clock = clock
+        self._circuits = {}  # type: dict[Hashable, _Circuit]
+        self._lock = threading.Lock()
+
+    def allow(self, key: Hashable) -> bool:
+        with self._lock:
+            circuit = self._circuits.get(key)
+            if circuit is None or circuit.failures < self.max_failures:
+                return True
+            if circuit.probing or self.clock() < circuit.open_until:
+                return False
+            circuit.probing = True
+            return True
+
+    def is_open(self, key: Hashable) -> bool:
+        with self._lock:
+            circuit = self._circuits.get(key)
+            return circuit is not None and circuit.failures >= self.max_failures
+
+    def success(self, key: Hashable):
+        with self._lock:
+            self._circuits.pop(key, None)
+
+    def failure(self, key: Hashable):
+        with self._lock:
+            circuit = self._circuits.setdefault(key, _Circuit())
+            circuit.failures += 1
+            circuit.probing = False
+            if circuit.failures >= self.max_failures:
+                circuit.open_until = self.clock() + self.cooldown
+
+    def clear(self):
+        with self._lock:
+            self._circuits.clear()
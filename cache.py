@@ -0,0 +1,145 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+
+class LRUCache:
+    """A thread-safe mapping bounded by entry count, with a per-entry TTL.
+
+    If max_bytes is given, it is also bounded by the total sizeof its values,
+    and values larger than max_bytes are not kept at all.
+    """
+
+    def __init__(self, max_entries: int, ttl: float,
+                 clock: Callable[[], float] = time.monotonic,
+                 max_bytes: Optional[int] = None,
+                 sizeof: Callable[[Any], int] = lambda value: 0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self._size = 0
+        self._entries = OrderedDict()  # type: OrderedDict[Hashable, tuple[float, Any, int]]
+        self._lock = threading.Lock()
+
+    def _remove(self, key: Hashable):
+        _, _, size = self._entries.pop(key)
+        self._size -= size
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value, _ = entry
+            if expires <= self.clock():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        expires = self.clock() + (self.ttl if ttl is None else ttl)
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._entries[key] = (expires, value, size)
+            self._size += size
+            while len(self._entries) > self.max_entries or (
+                    self.max_bytes is not None and self._size > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+
+    def discard(self, key: Hashable):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def discard_where(self, predicate: Callable[[Hashable], bool]):
+        with self._lock:
+            for key in [k for k in self._entries if predicate(k)]:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    @property
+    def size(self) -> int:
+        with self._lock:
+            return self._size
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None  # type: Any
+        self.error = None  # type: Optional[BaseException]
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key across threads.
+
+    The first caller for a key runs the function. Callers that arrive while
+    it is running wait for it and get the same result, or the same exception.
+    """
+
+    def __init__(self):
+        self._calls = {}  # type: dict[Hashable, _Call]
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+class AsyncSingleFlight:
+    """SingleFlight for coroutines on an event loop.
+
+    The call runs as its own task, so it completes for the remaining waiters
+    even if the caller that started it is cancelled.
+    """
+
+    def __init__(self):
+        self._tasks = {}  # type: dict[Hashable, asyncio.Future]
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        loop = asyncio.get_running_loop()
+        task = self._tasks.get(key)
+        if task is None or task.get_loop() is not loop:
+            task = loop.create_task(fn())
+            self._tasks[key] = task
+
+            def forget(t):
+                if self._tasks.get(key) is t:
+                    del self._tasks[key]
+            task.add_done_callback(forget)
+        return await asyncio.shield(task)
@@ -0,0 +1,47 @@
+import gzip
+import os
+from typing import Optional
+
+import brotli
+
+GZIP_LEVEL = int(os.environ.get("GZIP_LEVEL", 9))
+BROTLI_QUALITY = int(os.environ.get("BROTLI_QUALITY", 9))
+# Smaller bodies are sent uncompressed.
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", 1024))
+
+# In order of preference when the client accepts several equally.
+ENCODINGS = ("br", "gzip")
+
+
+def negotiate(accept_encoding: Optional[str]) -> Optional[str]:
+    """Picks the content coding to use for an Accept-Encoding header, or None
+    for identity."""
+    if not accept_encoding:
+        return None
+    qualities = {}
+    for part in accept_encoding.split(","):
+        coding, _, params = part.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name.lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qualities[coding.strip().lower()] = q
+    best = None
+    best_q = 0.0
+    for encoding in ENCODINGS:
+        q = qualities.get(encoding, qualities.get("*", 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+    raise ValueError("Unsupported encoding %r" % encoding)
@@ -0,0 +1,101 @@
+"""Parses feed dates: RFC 822 (RSS pubDate) and RFC 3339 (Atom updated).
+
+The shapes nearly every feed uses are matched by a regular expression and
+built directly. Anything else goes through email.utils and
+datetime.fromisoformat, and what those reject parses as None. Results are
+memoized, since feeds repeat the same dates on every fetch.
+"""
+
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+import functools
+import os
+import re
+from typing import Optional
+
+DATE_CACHE_SIZE = int(os.environ.get("DATE_CACHE_SIZE", 16 * 1024))
+
+_MONTHS = {m: n for n, m in enumerate(
+        ("jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"), 1)}
+
+# e.g. "Sat, 05 Jun 2021 16:57:00 -0700". The weekday is optional and not
+# checked, like email.utils.
+_RFC822 = re.compile(
+        r"(?:[a-z]{3},?\s+)?(\d{1,2})\s+([a-z]{3})\s+(\d{4})\s+(\d{1,2}):(\d{2})(?::(\d{2}))?"
+        r"\s*(?:([+-])(\d{2})(\d{2})|(gmt|ut|utc|z))?",
+        re.IGNORECASE)
+# e.g. "2021-06-05T16:57:00.123-07:00" or "2021-06-05T23:57:00Z".
+_RFC3339 = re.compile(
+        r"(\d{4})-(\d{2})-(\d{2})[t ](\d{2}):(\d{2})(?::(\d{2})(?:\.(\d+))?)?"
+        r"(?:([+-])(\d{2}):?(\d{2})|(z))?",
+        re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=None)
+def _offset(sign: str, hours: str, minutes: str) -> timezone:
+    delta = timedelta(hours=int(hours), minutes=int(minutes))
+    return timezone(-delta if sign == "-" else delta)
+
+
+def _rfc822(text: str) -> Optional[datetime]:
+    match = _RFC822.fullmatch(text)
+    if match is None:
+        return None
+    day, month, year, hour, minute, second, sign, hours, minutes, utc = match.groups()
+    month = _MONTHS.get(month.lower())
+    if month is None:
+        return None
+    if sign is not None:
+        # Like email.utils, -0000 means the offset is unknown.
+        tz = None if sign == "-" and hours == minutes == "00" else _offset(sign, hours, minutes)
+    elif utc is not None:
+        tz = timezone.utc
+    else:
+        tz = None
+    return datetime(int(year), month, int(day), int(hour), int(minute), int(second or 0),
+                    tzinfo=tz)
+
+
+def _rfc3339(text: str) -> Optional[datetime]:
+    match = _RFC3339.fullmatch(text)
+    if match is None:
+        return None
+    year, month, day, hour, minute, second, fraction, sign, hours, minutes, utc = match.groups()
+    if sign is not None:
+        tz = _offset(sign, hours, minutes)
+    elif utc is not None:
+        tz = timezone.utc
+    else:
+        tz = None
+    return datetime(int(year), int(month), int(day), int(hour), int(minute), int(second or 0),
+                    int((fraction or "0")[:6].ljust(6, "0")), tzinfo=tz)
+
+
+def _fallback(text: str) -> Optional[datetime]:
+    try:
+        return parsedate_to_datetime(text)
+    except (TypeError, ValueError, IndexError):
+        pass
+    if text[-1:] in "Zz":
+        # Only accepted by fromisoformat from Python 3.11.
+        text = text[:-1] + "+00:00"
+    try:
+        return datetime.fromisoformat(text)
+    except ValueError:
+        return None
+
+
+@functools.lru_cache(maxsize=DATE_CACHE_SIZE)
+def parse(text: Optional[str]) -> Optional[datetime]:
+    """Parses an RFC 822 or RFC 3339 date, or returns None."""
+    if text is None:
+        return None
+    text = text.strip()
+    if not text:
+        return None
+    try:
+        parsed = _rfc822(text) or _rfc3339(text)
+    except ValueError:
+        # Matched, but out of range (e.g. 31 Feb).
+        return None
+    return parsed or _fallback(text)
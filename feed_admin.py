@@ -10,11 +10,14 @@ from validators import url
 from jqqb_evaluator.evaluator import Evaluator
 
 from model import FilterFeed,  validate_jqqb
+import settings_cache
 
 flags.DEFINE_integer("id", None, "ID for previous feed")
 flags.DEFINE_string("url", None, "Upstream feed")
 flags.DEFINE_string("name", None, "nickname for feed")
 flags.DEFINE_string("query_builder", None, "querybuilder string to filter")
+flags.DEFINE_integer("max_bytes", None, "largest upstream body to download, 0 for the default")
+flags.DEFINE_list("extra_urls", None, "more upstream feeds to filter and merge, empty for none")
 
 @flags.validator('url', 'not a valid url')
 def _CheckUrl(value) -> bool:
@@ -22,6 +25,12 @@ def _CheckUrl(value) -> bool:
         return True
     return url(value, public=True)
 
+@flags.validator('extra_urls', 'not a list of valid urls')
+def _CheckExtraUrls(value) -> bool:
+    if value is None:
+        return True
+    return all(url(v, public=True) for v in value)
+
 @flags.validator('query_builder', 'Not a valid query builder')
 def _CheckQuery(value):
     if value is None:
@@ -38,9 +47,9 @@ def _CheckFlagsSet(f) -> bool:
 
 FLAGS = flags.FLAGS
 
-def upsert_feed(feed_id, url, name, query_builder) -> str:
+def upsert_feed(feed_id, url, name, query_builder, max_bytes=None, extra_urls=None) -> str:
     client = ndb.Client()
-    with client.context():
+    with settings_cache.context(client)():
         if feed_id:
             feed = FilterFeed.get_by_id(feed_id)
         else:
@@ -51,11 +60,18 @@ def upsert_feed(feed_id, url, name, query_builder) -> str:
             feed.name = name
         if query_builder:
             feed.query_builder = json.loads(query_builder)
+        if max_bytes is not None:
+            feed.max_bytes = max_bytes or None
+        if extra_urls is not None:
+            feed.extra_urls = extra_urls
+        # Serving processes see the change once their in-process copy
+        # expires (see settings_cache).
         key = feed.put()
         return f"https://filter-feed.newg.as/v1/{key.id()}"
 
 def main(_):
-    print(upsert_feed(FLAGS.id, FLAGS.url, FLAGS.name, FLAGS.query_builder))
+    print(upsert_feed(FLAGS.id, FLAGS.url, FLAGS.name, FLAGS.query_builder, FLAGS.max_bytes,
+                      FLAGS.extra_urls))
 
 if __name__ == '__main__':
     app.run(main)
@@ -0,0 +1,606 @@
+import asyncio
+import fcntl
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import cached_property
+from typing import Optional, Union
+from urllib.parse import urlsplit, urlunsplit
+
+from absl import logging
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+import urllib3
+
+import breaker
+import cache
+import metrics
+
+UPSTREAM_STORE_BYTES = int(os.environ.get("UPSTREAM_STORE_BYTES", 64 * 1024 * 1024))
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT", 3.05))
+UPSTREAM_READ_TIMEOUT = float(os.environ.get("UPSTREAM_READ_TIMEOUT", 20))
+# Number of distinct hosts to keep a connection pool for.
+UPSTREAM_POOL_HOSTS = int(os.environ.get("UPSTREAM_POOL_HOSTS", 32))
+# Connections kept alive per host. Each gunicorn worker thread holds at most
+# one upstream connection at a time, so default to the worker's thread count.
+UPSTREAM_POOL_MAXSIZE = int(os.environ.get("UPSTREAM_POOL_MAXSIZE", os.environ.get("THREADS", 1)))
+# Concurrent upstream connections per worker when serving through asgi.py.
+UPSTREAM_ASYNC_MAX_CONNECTIONS = int(os.environ.get("UPSTREAM_ASYNC_MAX_CONNECTIONS", 200))
+# Largest upstream body to download, unless a FilterFeed sets its own.
+UPSTREAM_MAX_BYTES = int(os.environ.get("UPSTREAM_MAX_BYTES", 16 * 1024 * 1024))
+# Seconds allowed for a whole upstream download, however steadily it arrives.
+UPSTREAM_DEADLINE = float(os.environ.get("UPSTREAM_DEADLINE", 30))
+UPSTREAM_CHUNK_BYTES = int(os.environ.get("UPSTREAM_CHUNK_BYTES", 64 * 1024))
+# Consecutive failures (connection errors, timeouts and 5xx responses) after
+# which requests to a host fail immediately for UPSTREAM_BREAKER_COOLDOWN
+# seconds, before a single probe request is let through.
+UPSTREAM_BREAKER_FAILURES = int(os.environ.get("UPSTREAM_BREAKER_FAILURES", 5))
+UPSTREAM_BREAKER_COOLDOWN = float(os.environ.get("UPSTREAM_BREAKER_COOLDOWN", 30))
+# Seconds for which a URL that could not be fetched fails again immediately.
+UPSTREAM_NEGATIVE_TTL = float(os.environ.get("UPSTREAM_NEGATIVE_TTL", 10))
+UPSTREAM_NEGATIVE_ENTRIES = int(os.environ.get("UPSTREAM_NEGATIVE_ENTRIES", 1024))
+# Bodies are decoded here rather than by the clients, a chunk at a time, so
+# that the size cap bounds the decoded body however well it compressed. The
+# brotli package can not bound the output of a single call, so br is not
+# asked for.
+ACCEPT_ENCODING = "gzip, deflate"
+# Directory shared by the worker processes. When set, only one process at a
+# time fetches a given URL and processes that were waiting for it reuse its
+# response. Holds a lock file and the last response for each URL.
+UPSTREAM_COALESCE_DIR = os.environ.get("UPSTREAM_COALESCE_DIR", "")
+
+
+class UpstreamError(Exception):
+    """The upstream response could not be used."""
+
+
+class UpstreamTooLarge(UpstreamError):
+    pass
+
+
+class UpstreamDeadlineExceeded(UpstreamError):
+    pass
+
+
+class UpstreamUnavailable(UpstreamError):
+    """The upstream could not be reached, or has been failing recently."""
+
+
+class UpstreamHTTPError(UpstreamError):
+    """The upstream answered with an error status."""
+
+
+@dataclass
+class Upstream:
+    url: str
+    content: bytes
+    content_type: Optional[str]
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+    @classmethod
+    def fromResponse(cls, url: str,
+                     response: Union[requests.Response, httpx.Response],
+                     content: Optional[bytes] = None) -> 'Upstream':
+        return Upstream(
+                url=url,
+                content=response.content if content is None else content,
+                content_type=response.headers.get('Content-Type', None),
+                etag=response.headers.get('ETag', None),
+                last_modified=response.headers.get('Last-Modified', None))
+
+    @cached_property
+    def fingerprint(self) -> str:
+        return hashlib.sha256(self.content).hexdigest()
+
+    @property
+    def revalidatable(self) -> bool:
+        return bool(self.etag or self.last_modified)
+
+
+class UpstreamStore:
+    """Remembers the last upstream response for each URL so it can be revalidated.
+
+    Bounded by the total size of the stored bodies, evicting the least recently
+    used URL first.
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._size = 0
+        self._entries = OrderedDict()  # type: OrderedDict[str, Upstream]
+        self._lock = threading.Lock()
+
+    def get(self, url: str) -> Optional[Upstream]:
+        with self._lock:
+            upstream = self._entries.get(url)
+            if upstream is not None:
+                self._entries.move_to_end(url)
+            return upstream
+
+    def put(self, upstream: Upstream):
+        if len(upstream.content) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(upstream.url, None)
+            if old is not None:
+                self._size -= len(old.content)
+            self._entries[upstream.url] = upstream
+            self._size += len(upstream.content)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted.content)
+
+    def discard(self, url: str):
+        with self._lock:
+            old = self._entries.pop(url, None)
+            if old is not None:
+                self._size -= len(old.content)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+store = UpstreamStore(UPSTREAM_STORE_BYTES)
+
+
+def new_session(pool_hosts: int = UPSTREAM_POOL_HOSTS,
+                pool_maxsize: int = UPSTREAM_POOL_MAXSIZE) -> requests.Session:
+    s = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_maxsize)
+    s.mount('http://', adapter)
+    s.mount('https://', adapter)
+    s.headers['Accept-Encoding'] = ACCEPT_ENCODING
+    return s
+
+
+session = new_session()
+
+
+_DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def normalize_url(url: str) -> str:
+    """Returns url in a canonical form, so that feeds spelling the same
+    upstream differently share its fetches.
+
+    Lowercases the scheme and host, drops a default port and the fragment, and
+    gives an empty path as "/".
+    """
+    parts = urlsplit(url.strip())
+    try:
+        port = parts.port
+    except ValueError:
+        return url
+    scheme = parts.scheme.lower()
+    netloc = parts.hostname or ""
+    if ":" in netloc:
+        netloc = "[%s]" % netloc
+    if port is not None and port != _DEFAULT_PORTS.get(scheme):
+        netloc += ":%d" % port
+    if parts.username is not None:
+        userinfo = parts.username
+        if parts.password is not None:
+            userinfo += ":" + parts.password
+        netloc = userinfo + "@" + netloc
+    return urlunsplit((scheme, netloc, parts.path or "/", parts.query, ""))
+
+
+hosts = breaker.CircuitBreaker(UPSTREAM_BREAKER_FAILURES, UPSTREAM_BREAKER_COOLDOWN)
+# URL -> why it could not be fetched.
+_unavailable = cache.LRUCache(UPSTREAM_NEGATIVE_ENTRIES, UPSTREAM_NEGATIVE_TTL)
+
+
+def _admit(url: str) -> str:
+    host = urlsplit(url).hostname or ""
+    if not hosts.allow(host):
+        raise UpstreamUnavailable("%s: %s has been failing, not retrying yet" % (url, host))
+    return host
+
+
+def _unreachable(url: str, host: str, e: Exception) -> UpstreamError:
+    hosts.failure(host)
+    if isinstance(e, UpstreamError):
+        return e
+    return UpstreamUnavailable("%s: %s" % (url, e))
+
+
+def _responded(url: str, host: str, status_code: int):
+    """Records whether the host is working. A 5xx response counts as a failure
+    and raises UpstreamUnavailable, like a connection error, so that fetch
+    remembers the URL as unavailable."""
+    if status_code >= 500:
+        hosts.failure(host)
+        store.discard(url)
+        raise UpstreamUnavailable("%s: HTTP %d" % (url, status_code))
+    hosts.success(host)
+
+
+def _check_status(url: str, response: Union[requests.Response, httpx.Response]):
+    # Anything but the feed itself, or a revalidation of the stored copy, is
+    # an error page that must not be rendered as the feed.
+    if response.status_code not in (200, 304):
+        store.discard(url)
+        raise UpstreamHTTPError("%s: HTTP %d" % (url, response.status_code))
+
+
+def _check_length(url: str, response: Union[requests.Response, httpx.Response],
+                  max_bytes: int):
+    length = response.headers.get('Content-Length')
+    if length is not None and length.isdigit() and int(length) > max_bytes:
+        # The caller closes the response: httpx's async streams can only be
+        # closed asynchronously.
+        raise UpstreamTooLarge("%s is %s bytes, more than %d" % (url, length, max_bytes))
+
+
+class _Limit:
+    """Counts the bytes of a download against a size cap and a deadline."""
+
+    def __init__(self, url: str, max_bytes: int):
+        self.url = url
+        self.max_bytes = max_bytes
+        self.deadline = time.monotonic() + UPSTREAM_DEADLINE
+        self.size = 0
+
+    def add(self, chunk: bytes):
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            raise UpstreamTooLarge("%s is more than %d bytes" % (self.url, self.max_bytes))
+        self.check_deadline()
+
+    @property
+    def remaining(self) -> float:
+        return max(0.0, self.deadline - time.monotonic())
+
+    def check_deadline(self):
+        if time.monotonic() > self.deadline:
+            self.exceeded()
+
+    def exceeded(self):
+        raise UpstreamDeadlineExceeded("%s took more than %gs" % (self.url, UPSTREAM_DEADLINE))
+
+
+class _Decoder:
+    """Undoes a Content-Encoding, producing at most chunk_size bytes per call
+    to zlib so that the caller can stop a compression bomb early."""
+
+    def __init__(self, url: str, content_encoding: Optional[str],
+                 chunk_size: int = UPSTREAM_CHUNK_BYTES):
+        self.url = url
+        self.chunk_size = chunk_size
+        encoding = (content_encoding or "identity").strip().lower()
+        if encoding in ("gzip", "x-gzip"):
+            self._wbits = 16 + zlib.MAX_WBITS
+        elif encoding == "deflate":
+            self._wbits = zlib.MAX_WBITS
+        elif encoding == "identity":
+            self._wbits = 0
+        else:
+            raise UpstreamUnavailable("%s: unsupported Content-Encoding %s" % (url, content_encoding))
+        self._zlib = zlib.decompressobj(self._wbits) if self._wbits else None
+        self._started = False
+        self._members = 0
+
+    def decode(self, data: bytes):
+        """Yields the decoded bytes of the next piece of the raw body."""
+        if self._zlib is None:
+            if data:
+                yield data
+            return
+        while True:
+            try:
+                out = self._zlib.decompress(data, self.chunk_size)
+            except zlib.error as e:
+                if self._wbits == zlib.MAX_WBITS and not self._started:
+                    # Some servers send deflate without the zlib header.
+                    self._wbits = -zlib.MAX_WBITS
+                    self._zlib = zlib.decompressobj(self._wbits)
+                    continue
+                if self._members:
+                    # Trailing garbage after a complete gzip member.
+                    return
+                raise UpstreamUnavailable("%s: %s" % (self.url, e)) from e
+            self._started = True
+            if out:
+                yield out
+            data = self._zlib.unconsumed_tail
+            if not data and self._zlib.eof and self._zlib.unused_data:
+                # Another gzip member follows.
+                data = self._zlib.unused_data
+                self._members += 1
+                self._zlib = zlib.decompressobj(self._wbits)
+            elif not data and len(out) < self.chunk_size:
+                return
+
+
+def stream(url: str, max_bytes: int = UPSTREAM_MAX_BYTES) -> requests.Response:
+    """Starts a streamed GET. Use iter_limited for the body."""
+    host = _admit(url)
+    try:
+        response = session.get(url, stream=True,
+                               timeout=(UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT))
+    except requests.RequestException as e:
+        raise _unreachable(url, host, e) from e
+    try:
+        _responded(url, host, response.status_code)
+        _check_status(url, response)
+        _check_length(url, response, max_bytes)
+    except UpstreamError:
+        response.close()
+        raise
+    return response
+
+
+def _abort(response: requests.Response):
+    """Makes a read of response blocked in another thread return."""
+    sock = getattr(getattr(response.raw, "_connection", None), "sock", None)
+    if sock is None:
+        # http.client hands the socket over to the response when the
+        # connection is to be closed after it.
+        fp = getattr(getattr(response.raw, "_fp", None), "fp", None)
+        sock = getattr(getattr(fp, "raw", None), "_sock", None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+def iter_limited(url: str, response: requests.Response, max_bytes: int = UPSTREAM_MAX_BYTES,
+                 chunk_size: int = UPSTREAM_CHUNK_BYTES):
+    """Yields the decoded body of a streamed response, raising once it passes
+    max_bytes or UPSTREAM_DEADLINE."""
+    limit = _Limit(url, max_bytes)
+    # A read only returns once a whole chunk has arrived, so an upstream that
+    # drips a byte at a time could hold it far past the deadline. Cut the
+    # connection when the deadline passes instead.
+    watchdog = threading.Timer(UPSTREAM_DEADLINE, _abort, (response,))
+    watchdog.daemon = True
+    with response:
+        decoder = _Decoder(url, response.headers.get('Content-Encoding'), chunk_size)
+        watchdog.start()
+        try:
+            for data in response.raw.stream(chunk_size, decode_content=False):
+                for chunk in decoder.decode(data):
+                    limit.add(chunk)
+                    yield chunk
+        except urllib3.exceptions.HTTPError as e:
+            limit.check_deadline()
+            # Reading the raw body skips requests' wrapping of these.
+            raise UpstreamUnavailable("%s: %s" % (url, e)) from e
+        finally:
+            watchdog.cancel()
+        # The cut connection may just look like the end of the body.
+        limit.check_deadline()
+
+
+def _conditional_headers(cached: Optional[Upstream]) -> dict[str, str]:
+    headers = {}
+    if cached is not None:
+        if cached.etag:
+            headers['If-None-Match'] = cached.etag
+        if cached.last_modified:
+            headers['If-Modified-Since'] = cached.last_modified
+    return headers
+
+
+def _revalidated(url: str, cached: Optional[Upstream],
+                 response: Union[requests.Response, httpx.Response],
+                 content: Optional[bytes] = None) -> Upstream:
+    if response.status_code == 304:
+        if cached is None:
+            raise UpstreamHTTPError("%s: HTTP 304, but nothing is stored for it" % url)
+        logging.debug("Upstream %s not modified, reusing stored body", url)
+        return cached
+    upstream = Upstream.fromResponse(url, response, content)
+    if response.status_code == 200 and upstream.revalidatable:
+        store.put(upstream)
+    else:
+        store.discard(url)
+    return upstream
+
+
+def _fetch(url: str, max_bytes: int) -> Upstream:
+    host = _admit(url)
+    cached = store.get(url)
+    try:
+        with metrics.request("upstream"):
+            response = session.get(url, headers=_conditional_headers(cached), stream=True,
+                                   timeout=(UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT))
+            with response:
+                _check_length(url, response, max_bytes)
+                content = b"".join(iter_limited(url, response, max_bytes))
+    except (requests.RequestException, UpstreamUnavailable, UpstreamDeadlineExceeded) as e:
+        raise _unreachable(url, host, e) from e
+    except Exception:
+        # The host did respond.
+        hosts.success(host)
+        raise
+    _responded(url, host, response.status_code)
+    metrics.upstream_bytes.add(len(content))
+    _check_status(url, response)
+    return _revalidated(url, cached, response, content)
+
+
+_async_client = None  # type: Optional[httpx.AsyncClient]
+
+
+def async_client() -> httpx.AsyncClient:
+    # Created lazily so it binds to the serving event loop.
+    global _async_client
+    if _async_client is None:
+        _async_client = httpx.AsyncClient(
+                timeout=httpx.Timeout(UPSTREAM_READ_TIMEOUT, connect=UPSTREAM_CONNECT_TIMEOUT),
+                limits=httpx.Limits(max_connections=UPSTREAM_ASYNC_MAX_CONNECTIONS,
+                                    max_keepalive_connections=UPSTREAM_POOL_HOSTS),
+                headers={'Accept-Encoding': ACCEPT_ENCODING},
+                follow_redirects=True)
+    return _async_client
+
+
+async def _read_async(url: str, response: httpx.Response, max_bytes: int) -> bytes:
+    """Returns the decoded body of a streamed response, raising once it passes
+    max_bytes or UPSTREAM_DEADLINE."""
+    limit = _Limit(url, max_bytes)
+    decoder = _Decoder(url, response.headers.get('Content-Encoding'))
+    chunks = []
+
+    async def read():
+        async for data in response.aiter_raw(UPSTREAM_CHUNK_BYTES):
+            for chunk in decoder.decode(data):
+                limit.add(chunk)
+                chunks.append(chunk)
+    # Like iter_limited, don't wait for each read to learn that time is up.
+    try:
+        await asyncio.wait_for(read(), limit.remaining)
+    except asyncio.TimeoutError:
+        limit.exceeded()
+    return b"".join(chunks)
+
+
+async def _fetch_async(url: str, max_bytes: int,
+                       client: Optional[httpx.AsyncClient]) -> Upstream:
+    host = _admit(url)
+    cached = store.get(url)
+    try:
+        with metrics.request("upstream"):
+            async with (client or async_client()).stream(
+                    "GET", url, headers=_conditional_headers(cached)) as response:
+                _check_length(url, response, max_bytes)
+                content = await _read_async(url, response, max_bytes)
+    except (httpx.TransportError, UpstreamUnavailable, UpstreamDeadlineExceeded) as e:
+        raise _unreachable(url, host, e) from e
+    except Exception:
+        hosts.success(host)
+        raise
+    _responded(url, host, response.status_code)
+    metrics.upstream_bytes.add(len(content))
+    _check_status(url, response)
+    return _revalidated(url, cached, response, content)
+
+
+def _shared_path(url: str) -> str:
+    return os.path.join(UPSTREAM_COALESCE_DIR, hashlib.sha256(url.encode('utf-8')).hexdigest())
+
+
+def _read_shared(path: str, since: float) -> Optional[Upstream]:
+    """Returns the response another process stored at path after since."""
+    try:
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_mtime < since:
+                return None
+            header = json.loads(f.readline())
+            upstream = Upstream(content=f.read(), **header)
+    except (FileNotFoundError, ValueError, TypeError):
+        return None
+    if upstream.revalidatable:
+        store.put(upstream)
+    return upstream
+
+
+def _write_shared(path: str, upstream: Upstream):
+    header = {"url": upstream.url, "content_type": upstream.content_type,
+              "etag": upstream.etag, "last_modified": upstream.last_modified}
+    tmp = "%s.%d" % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(json.dumps(header).encode('utf-8') + b"\n")
+        f.write(upstream.content)
+    os.replace(tmp, path)
+
+
+def _fetch_across_processes(url: str, max_bytes: int) -> Upstream:
+    path = _shared_path(url)
+    since = time.time()
+    with open(path + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            upstream = _read_shared(path, since)
+            if upstream is None:
+                upstream = _fetch(url, max_bytes)
+                _write_shared(path, upstream)
+            return upstream
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+async def _fetch_async_across_processes(url: str, max_bytes: int,
+                                        client: Optional[httpx.AsyncClient]) -> Upstream:
+    path = _shared_path(url)
+    since = time.time()
+    with open(path + ".lock", "a") as lock:
+        # flock blocks, so wait for it off the event loop.
+        await asyncio.to_thread(fcntl.flock, lock, fcntl.LOCK_EX)
+        try:
+            upstream = _read_shared(path, since)
+            if upstream is None:
+                upstream = await _fetch_async(url, max_bytes, client)
+                _write_shared(path, upstream)
+            return upstream
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+_inflight = cache.SingleFlight()
+_inflight_async = cache.AsyncSingleFlight()
+
+
+def _within(upstream: Upstream, max_bytes: int) -> Upstream:
+    # A stored or shared response may have been fetched under a larger cap.
+    if len(upstream.content) > max_bytes:
+        raise UpstreamTooLarge("%s is more than %d bytes" % (upstream.url, max_bytes))
+    return upstream
+
+
+def _check_available(url: str):
+    reason = _unavailable.get(url)
+    if reason is not None:
+        raise UpstreamUnavailable(reason)
+
+
+def fetch(url: str, max_bytes: Optional[int] = None) -> Upstream:
+    """Fetches url, sharing the result with concurrent fetches of the same url.
+
+    Raises UpstreamError if the body is larger than max_bytes (by default
+    UPSTREAM_MAX_BYTES) or takes longer than UPSTREAM_DEADLINE to download,
+    UpstreamHTTPError if the response is neither 200 nor 304, and
+    UpstreamUnavailable if the upstream can not be reached, answers with a
+    5xx or has been failing recently.
+    """
+    url = normalize_url(url)
+    max_bytes = max_bytes or UPSTREAM_MAX_BYTES
+    _check_available(url)
+    try:
+        if UPSTREAM_COALESCE_DIR:
+            upstream = _inflight.do((url, max_bytes), lambda: _fetch_across_processes(url, max_bytes))
+        else:
+            upstream = _inflight.do((url, max_bytes), lambda: _fetch(url, max_bytes))
+    except UpstreamUnavailable as e:
+        _unavailable.put(url, str(e))
+        raise
+    return _within(upstream, max_bytes)
+
+
+async def fetch_async(url: str, max_bytes: Optional[int] = None,
+                      client: Optional[httpx.AsyncClient] = None) -> Upstream:
+    url = normalize_url(url)
+    max_bytes = max_bytes or UPSTREAM_MAX_BYTES
+    _check_available(url)
+    try:
+        if UPSTREAM_COALESCE_DIR:
+            upstream = await _inflight_async.do(
+                    (url, max_bytes), lambda: _fetch_async_across_processes(url, max_bytes, client))
+        else:
+            upstream = await _inflight_async.do(
+                    (url, max_bytes), lambda: _fetch_async(url, max_bytes, client))
+    except UpstreamUnavailable as e:
+        _unavailable.put(url, str(e))
+        raise
+    return _within(upstream, max_bytes)
@@ -1,31 +1,145 @@
 #!/usr/bin/env python3
 
 
-from dataclasses import asdict
-from typing import Any
+import asyncio
+import concurrent.futures
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+import hashlib
+import os
+import threading
+from typing import Any, Callable, Collection, Optional
 import xml.etree.ElementTree as ET
 
 from absl import logging
 import flask
-import requests
 from google.cloud import ndb  # type: Any
 from opentelemetry import  trace
-from jqqb_evaluator.evaluator import Evaluator
 
+import cache
+import compress
+import fetch
+import metrics
 import model
-from item import Item
+import rules
+import settings_cache
+import streaming
+import xml_backend
+from item import Item, ItemView, ATOM_FIELDS, RSS_FIELDS
 
 tracer = trace.get_tracer(__name__)
 
-class NamespaceRecordingTreeBuilder(ET.TreeBuilder):
-    def __init__(self, *args,  **kwargs):
-        self.ns = {}
-        super().__init__(*args,  **kwargs)
-    
-    def start_ns(self,  prefix,  uri):
-        self.ns[prefix] = uri
+ATOM_NS = "{http://www.w3.org/2005/Atom}"
 
+# "tree" parses the whole upstream document before filtering it and
+# re-serializes the result. "splice" copies the original upstream bytes,
+# cutting out dropped items. "stream" splices the upstream body as it is
+# downloaded, with bounded memory, but bypasses the upstream store and render
+# cache.
+FEED_PIPELINE = os.environ.get("FEED_PIPELINE", "tree").lower()
+# "row" evaluates the filter one item at a time, "column" evaluates each rule
+# over all items of the feed at once. Only the tree pipeline can use "column",
+# since the others decide on each item as soon as it has been parsed.
+RULE_ENGINE = os.environ.get("RULE_ENGINE", "row").lower()
+STREAM_CHUNK_BYTES = int(os.environ.get("STREAM_CHUNK_BYTES", 64 * 1024))
 
+DECISION_INDEX_SIZE = int(os.environ.get("DECISION_INDEX_SIZE", 64 * 1024))
+# Keep/drop decisions, keyed by (query_builder hash, atom, item_digest of the
+# fields the filter reads). A decision only depends on those, so when a feed is
+# refetched its unchanged items are not evaluated again, and an edited item
+# gets a new key.
+decision_index = cache.LRUCache(DECISION_INDEX_SIZE, ttl=float('inf'))
+
+
+def fieldTags(atom: bool, fields: Optional[Collection[str]]) -> list[str]:
+    tags = ATOM_FIELDS if atom else RSS_FIELDS
+    return [tags[f][0] for f in sorted(tags) if fields is None or f in fields]
+
+
+def item_digest(item: ET.Element, tags: list[str]) -> bytes:
+    """Hashes the text Item extracts from each of the tags."""
+    digest = hashlib.blake2b(digest_size=16)
+    for tag in tags:
+        el = item.find(tag)
+        if el is None:
+            digest.update(b"-")
+        elif el.text is None:
+            digest.update(b"0")
+        else:
+            text = el.text.encode("utf-8", "surrogatepass")
+            digest.update(b"%d:" % len(text))
+            digest.update(text)
+    return digest.digest()
+
+
+def _indexedMatcher(settings: model.FilterFeed, atom: bool) -> Callable[[ET.Element], bool]:
+    matches = rules.compiled(settings.query_builder)
+    fields = rules.referenced_fields(settings.query_builder)
+    qb_hash = rules.query_builder_hash(settings.query_builder)
+    tags = fieldTags(atom, fields)
+    view_tags = ItemView.tags(atom, fields)
+
+    def drop(item: ET.Element) -> bool:
+        key = (qb_hash, atom, item_digest(item, tags))
+        decision = decision_index.get(key)
+        if decision is None:
+            decision = bool(matches(ItemView(item, view_tags)))
+            decision_index.put(key, decision)
+        return decision
+    return drop
+
+
+def rssMatcher(settings: model.FilterFeed) -> Callable[[ET.Element], bool]:
+    return _indexedMatcher(settings, atom=False)
+
+
+def atomMatcher(settings: model.FilterFeed) -> Callable[[ET.Element], bool]:
+    return _indexedMatcher(settings, atom=True)
+
+
+def _evaluate(settings: model.FilterFeed, columns: dict[str, list], count: int) -> list[bool]:
+    if RULE_ENGINE == "column":
+        return rules.compiled_columns(settings.query_builder)(columns, count)
+    matches = rules.compiled(settings.query_builder)
+    return [matches(rules.Row(columns, i)) for i in range(count)]
+
+
+def dropMask(items: list[ET.Element], settings: model.FilterFeed, atom: bool,
+             digests: Optional[list[bytes]] = None,
+             columns: Optional[Callable[[Optional[Collection[str]]], dict[str, list]]] = None
+             ) -> list[bool]:
+    """Decides on each item, only evaluating the filter on those missing from
+    decision_index.
+
+    digests are the items' item_digests over the fields the filter reads, and
+    columns returns all the items' columns of the given fields, if the caller
+    already has them.
+    """
+    fields = rules.referenced_fields(settings.query_builder)
+    qb_hash = rules.query_builder_hash(settings.query_builder)
+    if digests is None:
+        tags = fieldTags(atom, fields)
+        digests = [item_digest(i, tags) for i in items]
+    keys = [(qb_hash, atom, d) for d in digests]
+    mask = [decision_index.get(k) for k in keys]
+    missing = [i for i, drop in enumerate(mask) if drop is None]
+    metrics.cache_lookup("decision", True, len(mask) - len(missing))
+    metrics.cache_lookup("decision", False, len(missing))
+    if missing:
+        if len(missing) == len(items) and columns is not None:
+            found = columns(fields)
+        else:
+            found = (Item.atomColumns if atom else Item.rssColumns)(
+                    [items[i] for i in missing], fields)
+        for i, drop in zip(missing, _evaluate(settings, found, len(missing))):
+            mask[i] = bool(drop)
+            decision_index.put(keys[i], mask[i])
+    return mask
+
+
+# modifyRss and modifyAtom filter a tree in place, which serving never does:
+# it filters a shared Parsed document with Parsed.filtered. They remain for
+# the benchmark and tests, and decide on items with the same dropMask.
 def modifyRss(root: ET.Element, settings: model.FilterFeed):
     title = root.find(".//channel/title")
     if title is None:
@@ -36,12 +150,10 @@ def modifyRss(root: ET.Element, settings: model.FilterFeed):
         chan = root.find("channel")
         if chan is None:
             raise Exception('Missing channel element')
-        evaluator = Evaluator(settings.query_builder)
-        delete_items = filter(
-                lambda i: evaluator.object_matches_rules(asdict(Item.fromRssItem(i))),
-                root.iterfind(".//item"))
-        for item in delete_items:
-            chan.remove(item)
+        items = list(root.iterfind(".//item"))
+        for item, drop in zip(items, dropMask(items, settings, atom=False)):
+            if drop:
+                chan.remove(item)
 
 
 def modifyAtom(root: ET.Element, settings: model.FilterFeed):
@@ -51,12 +163,10 @@ def modifyAtom(root: ET.Element, settings: model.FilterFeed):
     else:
         title.text += " (filtered)"
     with tracer.start_as_current_span('filter_atom'):
-        evaluator = Evaluator(settings.query_builder)
-        delete_entries = filter(
-                lambda i: evaluator.object_matches_rules(asdict(Item.fromAtomEntry(i))),
-                root.iterfind(".//{http://www.w3.org/2005/Atom}entry"))
-        for entry in delete_entries:
-            root.remove(entry)
+        entries = list(root.iterfind(".//{http://www.w3.org/2005/Atom}entry"))
+        for entry, drop in zip(entries, dropMask(entries, settings, atom=True)):
+            if drop:
+                root.remove(entry)
 
 def detectRss(content_type: str, root: ET.Element) -> bool:
     if content_type in (
@@ -73,30 +183,595 @@ def detectAtom(content_type: str, root: ET.Element) -> bool:
     return root.tag in ("feed", "{http://www.w3.org/2005/Atom}feed")
 
 
-def feed_by_key(request: flask.Request, key: ndb.Key) -> flask.Response:
-    res = flask.Response()
-    settings = key.get()
-    if settings is None:
-        flask.abort(404)
-    upstream = requests.get(settings.url)
-    with tracer.start_as_current_span('parse'):
-        tb = NamespaceRecordingTreeBuilder()
-        root = ET.fromstring(upstream.text,  parser=ET.XMLParser(target=tb))
-    if detectRss(upstream.headers.get('Content-Type', None), root):
-        modifyRss(root, settings)
-    elif detectAtom(upstream.headers.get('Content-Type', None), root):
-        modifyAtom(root, settings)
+def streamingLayout(content_type: Optional[str], settings: model.FilterFeed
+                    ) -> Callable[[str], Optional[streaming.Layout]]:
+    def layout_for_root(tag: str) -> Optional[streaming.Layout]:
+        root = ET.Element(tag)
+        if detectRss(content_type, root):
+            return streaming.Layout(
+                    item_path=(tag, "channel", "item"),
+                    title_path=(tag, "channel", "title"),
+                    drop=rssMatcher(settings))
+        if detectAtom(content_type, root):
+            return streaming.Layout(
+                    item_path=(tag, ATOM_NS + "entry"),
+                    title_path=(tag, ATOM_NS + "title"),
+                    drop=atomMatcher(settings))
+        logging.error('Could not detect content-type, returning XML unmodified')
+        return None
+    return layout_for_root
+
+
+def _count_items(sf: streaming.StreamingFilter):
+    metrics.items.add(sf.items, {"direction": "in"})
+    metrics.items.add(sf.items - sf.dropped, {"direction": "out"})
+
+
+def stream_feed(settings: model.FilterFeed) -> flask.Response:
+    max_bytes = settings.max_bytes or fetch.UPSTREAM_MAX_BYTES
+    upstream = fetch.stream(settings.url, max_bytes)
+    content_type = upstream.headers.get('Content-Type', None)
+    sf = streaming.StreamingFilter(streamingLayout(content_type, settings))
+
+    def generate():
+        # Once the response has started, exceeding a limit can only abort it.
+        # The body is generated after feed_by_key returns, so it counts as a
+        # request in flight by itself.
+        try:
+            with tracer.start_as_current_span('filter_stream'), metrics.request("feed"), \
+                    metrics.phase("stream"):
+                for chunk in fetch.iter_limited(settings.url, upstream, max_bytes, STREAM_CHUNK_BYTES):
+                    out = sf.feed(chunk)
+                    if out:
+                        yield out
+                yield sf.close()
+        finally:
+            _count_items(sf)
+    return flask.Response(generate(), content_type=content_type)
+
+
+@dataclass
+class Rendered:
+    body: bytes
+    content_type: Optional[str]
+    # Compressed copies of body, by content coding, made on first use so that
+    # cached renders are only compressed once.
+    _encoded: dict = field(default_factory=dict, compare=False, repr=False)
+
+    def encoded(self, encoding: Optional[str]) -> tuple[bytes, Optional[str]]:
+        """Returns the body in the given content coding, and the coding used."""
+        if encoding is None or len(self.body) < compress.COMPRESS_MIN_BYTES:
+            return self.body, None
+        body = self._encoded.get(encoding)
+        if body is None:
+            with tracer.start_as_current_span('compress'), metrics.phase("compress"):
+                body = self._encoded[encoding] = compress.compress(self.body, encoding)
+        return body, encoding
+
+
+RENDER_CACHE_SIZE = int(os.environ.get("RENDER_CACHE_SIZE", 256))
+RENDER_CACHE_TTL = float(os.environ.get("RENDER_CACHE_TTL", 3600))
+# Keyed by (FilterFeed urlsafe key, upstream fingerprint, query_builder hash).
+render_cache = cache.LRUCache(RENDER_CACHE_SIZE, RENDER_CACHE_TTL)
+# Requests that miss the render cache together only render once.
+_rendering = cache.SingleFlight()
+
+# After a feed has been served, the same output is served without contacting
+# the upstream for FEED_FRESH_TTL seconds. For FEED_STALE_WHILE_REVALIDATE
+# seconds after that it is still served immediately while it is refreshed in
+# the background, and for FEED_STALE_IF_ERROR seconds after that it is only
+# served if refreshing it fails (see RFC 5861).
+FEED_FRESH_TTL = float(os.environ.get("FEED_FRESH_TTL", 60))
+FEED_STALE_WHILE_REVALIDATE = float(os.environ.get("FEED_STALE_WHILE_REVALIDATE", 3600))
+FEED_STALE_IF_ERROR = float(os.environ.get("FEED_STALE_IF_ERROR", 86400))
+FEED_REFRESH_THREADS = int(os.environ.get("FEED_REFRESH_THREADS", 4))
+
+
+@dataclass
+class Served:
+    rendered: Rendered
+    fresh_until: float
+    stale_until: float
+
+
+# Keyed by (FilterFeed urlsafe key, query_builder hash).
+served_cache = cache.LRUCache(
+        RENDER_CACHE_SIZE,
+        FEED_FRESH_TTL + max(FEED_STALE_WHILE_REVALIDATE, FEED_STALE_IF_ERROR))
+_refresher = concurrent.futures.ThreadPoolExecutor(
+        max_workers=FEED_REFRESH_THREADS, thread_name_prefix="refresh")
+_refreshing = set()  # type: set[tuple[str, str]]
+_refreshing_lock = threading.Lock()
+# Background asyncio tasks, referenced until they finish.
+_refresh_tasks = set()  # type: set[asyncio.Task]
+
+
+def invalidate(key: ndb.Key):
+    urlsafe = key.urlsafe()
+    render_cache.discard_where(lambda k: k[0] == urlsafe)
+    merged_cache.discard_where(lambda k: any(source[0] == urlsafe for source in k))
+    served_cache.discard_where(lambda k: k[0] == urlsafe)
+    settings_cache.invalidate(key)
+
+
+class Parsed:
+    """An upstream document parsed once and shared by every feed filtering it.
+
+    The parsed tree is never modified: filtered() and merged() return new
+    documents, made by the xml_backend document. Item fields are also
+    extracted once and shared.
+    """
+
+    def __init__(self, content: bytes, content_type: Optional[str]):
+        with tracer.start_as_current_span('parse'), metrics.phase("parse"):
+            self.document = xml_backend.document_class()(content)
+        self.content_bytes = len(content)
+        self.root = self.document.root
+        self.ns = self.document.ns
+        self.atom = None  # type: Optional[bool]
+        self.title = None  # type: Optional[ET.Element]
+        self.items = []  # type: list[ET.Element]
+        if detectRss(content_type, self.root):
+            self.atom = False
+            self.title = self.document.find(xml_backend.TITLE[False])
+            if self.title is None:
+                logging.warning("Could not find .//channel/title to modify")
+            if self.document.find(xml_backend.CONTAINER[False]) is None:
+                raise Exception('Missing channel element')
+            self.items = self.document.findall(xml_backend.ITEMS[False])
+        elif detectAtom(content_type, self.root):
+            self.atom = True
+            self.title = self.document.find(xml_backend.TITLE[True])
+            if self.title is None:
+                logging.warning("Could not find ./{http://www.w3.org/2005/Atom}title to modify")
+            self.items = self.document.findall(xml_backend.ITEMS[True])
+        else:
+            logging.error('Could not detect content-type, returning XML unmodified')
+        self._columns = {}  # type: dict[str, list]
+        self._digests = {}  # type: dict[Optional[frozenset], list[bytes]]
+        self._lock = threading.Lock()
+
+    def columns(self, fields: Optional[Collection[str]]) -> dict[str, list]:
+        with self._lock:
+            wanted = (ATOM_FIELDS if self.atom else RSS_FIELDS) if fields is None else fields
+            missing = [f for f in wanted if f not in self._columns]
+            if missing:
+                self._columns.update(
+                        (Item.atomColumns if self.atom else Item.rssColumns)(self.items, missing))
+            return {f: self._columns[f] for f in self._columns
+                    if fields is None or f in fields}
+
+    def digests(self, fields: Optional[Collection[str]]) -> list[bytes]:
+        """item_digest of every item, over the given fields (or all of them)."""
+        cache_key = None if fields is None else frozenset(fields)
+        with self._lock:
+            digests = self._digests.get(cache_key)
+            if digests is None:
+                tags = fieldTags(self.atom, fields)
+                digests = self._digests[cache_key] = [item_digest(i, tags) for i in self.items]
+            return digests
+
+    def dropMask(self, settings: model.FilterFeed) -> list[bool]:
+        fields = rules.referenced_fields(settings.query_builder)
+        return dropMask(self.items, settings, self.atom, self.digests(fields), self.columns)
+
+    def dates(self) -> list[Optional[datetime]]:
+        """Every item's date, or None where it is missing or malformed."""
+        dates = self.columns({"date"})["date"]
+        # Naive dates are taken to be UTC so that all of them can be compared.
+        return [d if d is None or d.tzinfo else d.replace(tzinfo=timezone.utc) for d in dates]
+
+    def guid(self, item: ET.Element) -> Optional[str]:
+        return item.findtext(ATOM_NS + "id" if self.atom else "guid")
+
+    def filtered(self, settings: model.FilterFeed) -> ET.Element:
+        if self.atom is None:
+            return self.root
+        with metrics.phase("filter"):
+            with tracer.start_as_current_span('filter_atom' if self.atom else 'filter_rss'):
+                dropped = self.dropMask(settings)
+            title = None if self.title is None else (self.title.text or "") + streaming.TITLE_SUFFIX
+            root = self.document.filtered(self.atom, self.items, dropped, title)
+        metrics.items.add(len(dropped), {"direction": "in"})
+        metrics.items.add(dropped.count(False), {"direction": "out"})
+        return root
+
+    def merged(self, items: list[ET.Element], title: str) -> ET.Element:
+        """Returns the document with its items replaced by the given ones,
+        which may come from other documents of the same backend, and its
+        title by title."""
+        return self.document.merged(self.atom, self.items, items, title)
+
+    def tostring(self, root: ET.Element, ns: Optional[dict[str, str]] = None) -> bytes:
+        with tracer.start_as_current_span('serialize'), metrics.phase("serialize"):
+            return self.document.tostring(root, ns)
+
+
+PARSED_CACHE_SIZE = int(os.environ.get("PARSED_CACHE_SIZE", 64))
+# Total size of the upstream bodies whose parses are kept. A parsed tree, with
+# its extracted fields, takes about five times the size of the body.
+PARSED_CACHE_BYTES = int(os.environ.get("PARSED_CACHE_BYTES", 32 * 1024 * 1024))
+# Keyed by (upstream fingerprint, content type, XML backend), so feeds over
+# the same upstream share a parse.
+parsed_cache = cache.LRUCache(PARSED_CACHE_SIZE, RENDER_CACHE_TTL, max_bytes=PARSED_CACHE_BYTES,
+                              sizeof=lambda parsed: parsed.content_bytes)
+_parsing = cache.SingleFlight()
+
+
+def parse(upstream: fetch.Upstream) -> Parsed:
+    cache_key = (upstream.fingerprint, upstream.content_type, xml_backend.XML_BACKEND)
+    parsed = parsed_cache.get(cache_key)
+    metrics.cache_lookup("parsed", parsed is not None)
+    if parsed is None:
+        def parse_and_cache():
+            parsed = Parsed(upstream.content, upstream.content_type)
+            parsed_cache.put(cache_key, parsed)
+            return parsed
+        parsed = _parsing.do(cache_key, parse_and_cache)
+    return parsed
+
+
+def render_tree(upstream: fetch.Upstream, settings: model.FilterFeed) -> bytes:
+    parsed = parse(upstream)
+    return parsed.tostring(parsed.filtered(settings))
+
+
+def render_splice(upstream: fetch.Upstream, settings: model.FilterFeed) -> bytes:
+    with tracer.start_as_current_span('splice'), metrics.phase("splice"):
+        sf = streaming.StreamingFilter(streamingLayout(upstream.content_type, settings))
+        body = sf.feed(upstream.content) + sf.close()
+    _count_items(sf)
+    return body
+
+
+def render(upstream: fetch.Upstream, settings: model.FilterFeed) -> Rendered:
+    if FEED_PIPELINE == "splice":
+        body = render_splice(upstream, settings)
     else:
+        body = render_tree(upstream, settings)
+    return Rendered(body, upstream.content_type)
+
+
+def cached_render(key: ndb.Key, settings: model.FilterFeed,
+                  upstream: fetch.Upstream) -> Rendered:
+    cache_key = (key.urlsafe(), upstream.fingerprint,
+                 rules.query_builder_hash(settings.query_builder))
+    rendered = render_cache.get(cache_key)
+    metrics.cache_lookup("render", rendered is not None)
+    if rendered is None:
+        rendered = _rendering.do(cache_key, lambda: _render_and_cache(cache_key, upstream, settings))
+    return rendered
+
+
+def _render_and_cache(cache_key, upstream: fetch.Upstream, settings: model.FilterFeed) -> Rendered:
+    rendered = render(upstream, settings)
+    render_cache.put(cache_key, rendered)
+    return rendered
+
+
+def _served_key(key: ndb.Key, settings: model.FilterFeed) -> tuple[str, str]:
+    return (key.urlsafe(), rules.query_builder_hash(settings.query_builder))
+
+
+def _remember(served_key: tuple[str, str], rendered: Rendered) -> Rendered:
+    now = served_cache.clock()
+    served_cache.put(served_key, Served(
+            rendered,
+            fresh_until=now + FEED_FRESH_TTL,
+            stale_until=now + FEED_FRESH_TTL + FEED_STALE_WHILE_REVALIDATE),
+        ttl=FEED_FRESH_TTL + max(FEED_STALE_WHILE_REVALIDATE, FEED_STALE_IF_ERROR))
+    return rendered
+
+
+def refresh_from(key: ndb.Key, settings: model.FilterFeed, upstream: fetch.Upstream) -> Rendered:
+    """Renders upstream and serves the result as fresh for FEED_FRESH_TTL."""
+    return _remember(_served_key(key, settings), cached_render(key, settings, upstream))
+
+
+def refresh(key: ndb.Key, settings: model.FilterFeed) -> Rendered:
+    """Renders the feed, merging its upstreams if it has extra_urls, and serves
+    the result as fresh for FEED_FRESH_TTL."""
+    if settings.extra_urls:
+        return _remember(_served_key(key, settings), merge([(key, settings)]))
+    with metrics.phase("fetch"):
+        upstream = fetch.fetch(settings.url, settings.max_bytes)
+    return refresh_from(key, settings, upstream)
+
+
+async def refresh_async(key: ndb.Key, settings: model.FilterFeed) -> Rendered:
+    if settings.extra_urls:
+        rendered = await merge_async([(key, settings)])
+    else:
+        with metrics.phase("fetch"):
+            upstream = await fetch.fetch_async(settings.url, settings.max_bytes)
+        rendered = await asyncio.to_thread(cached_render, key, settings, upstream)
+    return _remember(_served_key(key, settings), rendered)
+
+
+def _start_refresh(served_key: tuple[str, str]) -> bool:
+    with _refreshing_lock:
+        if served_key in _refreshing:
+            return False
+        _refreshing.add(served_key)
+        return True
+
+
+def _end_refresh(served_key: tuple[str, str]):
+    with _refreshing_lock:
+        _refreshing.discard(served_key)
+
+
+def _refresh_in_background(key: ndb.Key, settings: model.FilterFeed):
+    served_key = _served_key(key, settings)
+    if not _start_refresh(served_key):
+        return
+
+    def run():
+        try:
+            refresh(key, settings)
+        except Exception as e:
+            logging.warning("Background refresh of %s failed: %s", settings.url, e)
+        finally:
+            _end_refresh(served_key)
+    _refresher.submit(run)
+
+
+def _refresh_async_in_background(key: ndb.Key, settings: model.FilterFeed):
+    served_key = _served_key(key, settings)
+    if not _start_refresh(served_key):
+        return
+
+    async def run():
+        try:
+            await refresh_async(key, settings)
+        except Exception as e:
+            logging.warning("Background refresh of %s failed: %s", settings.url, e)
+        finally:
+            _end_refresh(served_key)
+    task = asyncio.get_running_loop().create_task(run())
+    _refresh_tasks.add(task)
+    task.add_done_callback(_refresh_tasks.discard)
+
+
+def serve(key: ndb.Key, settings: model.FilterFeed) -> Rendered:
+    """Returns the filtered feed, from served_cache while it is fresh or stale."""
+    served = served_cache.get(_served_key(key, settings))
+    now = served_cache.clock()
+    metrics.cache_lookup("served", served is not None and now < served.stale_until)
+    if served is None:
+        return refresh(key, settings)
+    if now < served.fresh_until:
+        return served.rendered
+    if now < served.stale_until:
+        _refresh_in_background(key, settings)
+        return served.rendered
+    try:
+        return refresh(key, settings)
+    except Exception as e:
+        logging.warning("Refreshing %s failed, serving stale feed: %s", settings.url, e)
+        return served.rendered
+
+
+async def serve_async(key: ndb.Key, settings: model.FilterFeed) -> Rendered:
+    served = served_cache.get(_served_key(key, settings))
+    now = served_cache.clock()
+    metrics.cache_lookup("served", served is not None and now < served.stale_until)
+    if served is None:
+        return await refresh_async(key, settings)
+    if now < served.fresh_until:
+        return served.rendered
+    if now < served.stale_until:
+        _refresh_async_in_background(key, settings)
+        return served.rendered
+    try:
+        return await refresh_async(key, settings)
+    except Exception as e:
+        logging.warning("Refreshing %s failed, serving stale feed: %s", settings.url, e)
+        return served.rendered
+
+
+# A merged feed combines the items that several FilterFeeds keep, or that one
+# FilterFeed keeps from each of its upstreams, newest first. It always uses the
+# tree pipeline. A FilterFeed with extra_urls is served through serve, fresh or
+# stale like any other. /v1/merge/ combinations refetch their upstreams on
+# every request and are only cached in merged_cache.
+MERGE_MAX_FEEDS = int(os.environ.get("MERGE_MAX_FEEDS", 20))
+MERGE_FETCH_THREADS = int(os.environ.get("MERGE_FETCH_THREADS", 8))
+
+# Keyed by a (FilterFeed urlsafe key, upstream fingerprint, query_builder hash)
+# tuple per merged upstream.
+merged_cache = cache.LRUCache(RENDER_CACHE_SIZE, RENDER_CACHE_TTL)
+_merging = cache.SingleFlight()
+_merge_fetcher = concurrent.futures.ThreadPoolExecutor(
+        max_workers=MERGE_FETCH_THREADS, thread_name_prefix="merge")
+
+# (FilterFeed key, FilterFeed, upstream)
+Source = tuple[ndb.Key, model.FilterFeed, fetch.Upstream]
+
+_OLDEST = datetime.min.replace(tzinfo=timezone.utc)
+
+
+def upstream_urls(settings: model.FilterFeed) -> list[str]:
+    return [settings.url] + list(settings.extra_urls or [])
+
+
+def _merge_jobs(feeds: list[tuple[ndb.Key, model.FilterFeed]]) -> list[tuple[ndb.Key, model.FilterFeed, str]]:
+    return [(key, settings, url) for key, settings in feeds for url in upstream_urls(settings)]
+
+
+def _fetched(jobs: list[tuple[ndb.Key, model.FilterFeed, str]], results: list) -> list[Source]:
+    sources = []
+    error = None
+    for (key, settings, url), result in zip(jobs, results):
+        if isinstance(result, fetch.UpstreamError):
+            logging.warning("Leaving %s out of merged feed: %s", url, result)
+            error = error or result
+        elif isinstance(result, BaseException):
+            raise result
+        else:
+            sources.append((key, settings, result))
+    if not sources and error is not None:
+        raise error
+    return sources
+
+
+def fetch_all(feeds: list[tuple[ndb.Key, model.FilterFeed]]) -> list[Source]:
+    """Fetches the upstreams of every feed concurrently. Failing upstreams are
+    left out, unless all of them fail."""
+    jobs = _merge_jobs(feeds)
+    with metrics.phase("fetch"):
+        futures = [_merge_fetcher.submit(fetch.fetch, url, settings.max_bytes)
+                   for _, settings, url in jobs]
+        results = [f.exception() or f.result() for f in futures]
+    return _fetched(jobs, results)
+
+
+async def fetch_all_async(feeds: list[tuple[ndb.Key, model.FilterFeed]]) -> list[Source]:
+    jobs = _merge_jobs(feeds)
+    with metrics.phase("fetch"):
+        results = await asyncio.gather(
+                *(fetch.fetch_async(url, settings.max_bytes) for _, settings, url in jobs),
+                return_exceptions=True)
+    return _fetched(jobs, results)
+
+
+def render_merged(sources: list[Source]) -> Rendered:
+    """Merges the items each source's filter keeps into the first RSS or Atom
+    source's document. Sources in the other format are left out, as are items
+    whose guid (or Atom id) has already been merged."""
+    parsed = [(settings, parse(upstream), upstream) for _, settings, upstream in sources]
+    base = next(((p, u) for _, p, u in parsed if p.atom is not None), None)
+    if base is None:
         logging.error('Could not detect content-type, returning XML unmodified')
-    with tracer.start_as_current_span('serialize'):
-        # pytype: disable=module-attr
-        nsmap = ET._namespace_map.copy()
-        for prefix,  uri in tb.ns.items():
-            ET.register_namespace(prefix,  uri)
-        res.set_data(ET.tostring(root, encoding='unicode') )
-        ET._namespace_map.clear()
-        ET._namespace_map.update(nsmap)
-        # pytype: enable=module-attr
-        res.content_type = upstream.headers.get('Content-Type', None)
+        upstream = sources[0][2]
+        return Rendered(upstream.content, upstream.content_type)
+    base_parsed, base_upstream = base
+    entries = []  # type: list[tuple[datetime, ET.Element]]
+    seen = set()
+    titles = []  # type: list[str]
+    ns = {}  # type: dict[str, str]
+    considered = 0
+    with tracer.start_as_current_span('merge'), metrics.phase("merge"):
+        for settings, p, upstream in parsed:
+            if p.atom != base_parsed.atom:
+                logging.warning("Leaving %s out of merged feed: not %s",
+                                upstream.url, "Atom" if base_parsed.atom else "RSS")
+                continue
+            if p.title is not None and p.title.text and p.title.text not in titles:
+                titles.append(p.title.text)
+            for prefix, uri in p.ns.items():
+                ns.setdefault(prefix, uri)
+            considered += len(p.items)
+            for item, drop, date in zip(p.items, p.dropMask(settings), p.dates()):
+                identity = p.guid(item) or id(item)
+                if drop or identity in seen:
+                    continue
+                seen.add(identity)
+                entries.append((date or _OLDEST, item))
+        # Newest first; the sort is stable, so undated items keep their order.
+        entries.sort(key=lambda e: e[0], reverse=True)
+        root = base_parsed.merged([item for _, item in entries],
+                                  " + ".join(titles) + streaming.TITLE_SUFFIX)
+    metrics.items.add(considered, {"direction": "in"})
+    metrics.items.add(len(entries), {"direction": "out"})
+    return Rendered(base_parsed.tostring(root, ns), base_upstream.content_type)
+
+
+def cached_merge(sources: list[Source]) -> Rendered:
+    cache_key = tuple((key.urlsafe(), upstream.fingerprint,
+                       rules.query_builder_hash(settings.query_builder))
+                      for key, settings, upstream in sources)
+    rendered = merged_cache.get(cache_key)
+    metrics.cache_lookup("merged", rendered is not None)
+    if rendered is None:
+        def merge_and_cache():
+            rendered = render_merged(sources)
+            merged_cache.put(cache_key, rendered)
+            return rendered
+        rendered = _merging.do(cache_key, merge_and_cache)
+    return rendered
+
+
+def merge(feeds: list[tuple[ndb.Key, model.FilterFeed]]) -> Rendered:
+    return cached_merge(fetch_all(feeds))
+
+
+async def merge_async(feeds: list[tuple[ndb.Key, model.FilterFeed]]) -> Rendered:
+    sources = await fetch_all_async(feeds)
+    return await asyncio.to_thread(cached_merge, sources)
+
+
+def _response(request: flask.Request, rendered: Rendered) -> flask.Response:
+    res = flask.Response()
+    body, encoding = rendered.encoded(compress.negotiate(request.headers.get('Accept-Encoding')))
+    res.set_data(body)
+    res.content_type = rendered.content_type
+    if encoding:
+        res.content_encoding = encoding
+    res.vary.add('Accept-Encoding')
     return res
 
+
+def feed_by_key(request: flask.Request, key: ndb.Key) -> flask.Response:
+    with metrics.request("feed"):
+        with metrics.phase("settings"):
+            settings = settings_cache.get(key)
+        if settings is None:
+            flask.abort(404)
+        try:
+            # Feeds with extra_urls are merged, which the stream pipeline can't do.
+            if FEED_PIPELINE == "stream" and not settings.extra_urls:
+                return stream_feed(settings)
+            rendered = serve(key, settings)
+        except fetch.UpstreamError as e:
+            logging.warning("Upstream error: %s", e)
+            flask.abort(502, description=str(e))
+        return _response(request, rendered)
+
+
+def merged_feed(request: flask.Request, keys: list[ndb.Key]) -> flask.Response:
+    with metrics.request("merge"):
+        with metrics.phase("settings"):
+            found = settings_cache.get_multi(keys)
+        if any(settings is None for settings in found):
+            flask.abort(404)
+        try:
+            rendered = merge(list(zip(keys, found)))
+        except fetch.UpstreamError as e:
+            logging.warning("Upstream error: %s", e)
+            flask.abort(502, description=str(e))
+        return _response(request, rendered)
+
+
+async def feed_by_key_async(key: ndb.Key) -> Rendered:
+    """Event-loop version of feed_by_key, used by asgi.py.
+
+    ndb has no asyncio API, so a settings_cache miss is looked up in a
+    thread (which inherits the caller's ndb context). The upstream fetch is
+    native async. Parsing and filtering are CPU-bound and also run in a
+    thread. The "stream" pipeline is not available here and renders as
+    "tree".
+    """
+    with metrics.request("feed"):
+        with metrics.phase("settings"):
+            settings = await asyncio.to_thread(settings_cache.get, key)
+        if settings is None:
+            flask.abort(404)
+        try:
+            return await serve_async(key, settings)
+        except fetch.UpstreamError as e:
+            logging.warning("Upstream error: %s", e)
+            flask.abort(502, description=str(e))
+
+
+async def merged_feed_async(keys: list[ndb.Key]) -> Rendered:
+    with metrics.request("merge"):
+        with metrics.phase("settings"):
+            found = await asyncio.to_thread(settings_cache.get_multi, keys)
+        if any(settings is None for settings in found):
+            flask.abort(404)
+        try:
+            return await merge_async(list(zip(keys, found)))
+        except fetch.UpstreamError as e:
+            logging.warning("Upstream error: %s", e)
+            flask.abort(502, description=str(e))
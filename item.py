@@ -1,34 +1,121 @@
+from collections.abc import Mapping
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Optional, Callable, TypeVar
-from email.utils import parsedate_to_datetime
+from typing import Any, Optional, Callable, TypeVar, Collection, Sequence
 
 import xml.etree.ElementTree as ET
 
+import dates
+
+ATOM_NS = "{http://www.w3.org/2005/Atom}"
+
+# Item field -> (child tag, conversion) for each feed format.
+RSS_FIELDS = {
+    "title": ("title", str),
+    "date": ("pubDate", dates.parse),
+    "description": ("description", str),
+}
+ATOM_FIELDS = {
+    "title": (ATOM_NS + "title", str),
+    "date": (ATOM_NS + "updated", dates.parse),
+    "description": (ATOM_NS + "summary", str),
+}
+
 @dataclass
-class Item:
+class Item(Mapping):
+    """An item's fields. Read-only mapping access lets an Item be evaluated
+    by rules directly, without copying it into a dict first."""
+    __slots__ = ("title", "date", "description")
     title: Optional[str]
     date: Optional[datetime]
     description: Optional[str]
     T = TypeVar('T')
 
+    def __getitem__(self, name: str) -> Any:
+        if name not in self.__slots__:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self) -> int:
+        return len(self.__slots__)
+
     @classmethod
     def _content(cls, item: ET.Element, tag: str, c: Callable[[str], T]=str) -> Optional[T]:
         el = item.find(tag)
         return None if el is None else c(el.text)
 
+    @classmethod
+    def _fields(cls, item: ET.Element, tags: dict,
+                fields: Optional[Collection[str]]) -> dict[str, Any]:
+        return {name: cls._content(item, tag, c)
+                for name, (tag, c) in tags.items() if fields is None or name in fields}
+
+    @classmethod
+    def rssFields(cls, item: ET.Element, fields: Optional[Collection[str]] = None) -> dict[str, Any]:
+        """Extracts the named fields (or all of them), as a dict for rule evaluation."""
+        return cls._fields(item, RSS_FIELDS, fields)
+
+    @classmethod
+    def atomFields(cls, item: ET.Element, fields: Optional[Collection[str]] = None) -> dict[str, Any]:
+        """Extracts the named fields (or all of them), as a dict for rule evaluation."""
+        return cls._fields(item, ATOM_FIELDS, fields)
+
+    @classmethod
+    def _columns(cls, items: Sequence[ET.Element], tags: dict,
+                 fields: Optional[Collection[str]]) -> dict[str, list]:
+        return {name: [cls._content(item, tag, c) for item in items]
+                for name, (tag, c) in tags.items() if fields is None or name in fields}
+
+    @classmethod
+    def rssColumns(cls, items: Sequence[ET.Element],
+                   fields: Optional[Collection[str]] = None) -> dict[str, list]:
+        """Extracts the named fields (or all of them) of every item, one list per field."""
+        return cls._columns(items, RSS_FIELDS, fields)
+
+    @classmethod
+    def atomColumns(cls, items: Sequence[ET.Element],
+                    fields: Optional[Collection[str]] = None) -> dict[str, list]:
+        """Extracts the named fields (or all of them) of every entry, one list per field."""
+        return cls._columns(items, ATOM_FIELDS, fields)
+
     @classmethod
     def fromRssItem(cls, item: ET.Element) -> 'Item':
-        return Item(
-                title=cls._content(item, "title"),
-                date=cls._content(item, "pubDate", parsedate_to_datetime),
-                description=cls._content(item, "description")
-                )
+        return Item(**cls.rssFields(item))
 
     @classmethod
     def fromAtomEntry(cls, item: ET.Element) -> 'Item':
-        return Item(
-                title=cls._content(item, "{http://www.w3.org/2005/Atom}title"),
-                date=cls._content(item, "{http://www.w3.org/2005/Atom}updated", datetime.fromisoformat),
-                description=cls._content(item, "{http://www.w3.org/2005/Atom}summary")
-                )
+        return Item(**cls.atomFields(item))
+
+
+class ItemView(Mapping):
+    """Some of an item element's fields, read from the element when a rule
+    asks for them rather than copied into a dict first."""
+    __slots__ = ("_item", "_tags")
+
+    def __init__(self, item: ET.Element, tags: dict):
+        self._item = item
+        # Field -> (child tag, conversion), for the fields to expose.
+        self._tags = tags
+
+    @staticmethod
+    def tags(atom: bool, fields: Optional[Collection[str]] = None) -> dict:
+        """The tags argument for the named fields (or all of them)."""
+        return {name: spec for name, spec in (ATOM_FIELDS if atom else RSS_FIELDS).items()
+                if fields is None or name in fields}
+
+    def __getitem__(self, name: str) -> Any:
+        tag, c = self._tags[name]
+        return Item._content(self._item, tag, c)
+
+    def get(self, name: str, default: Any = None) -> Any:
+        spec = self._tags.get(name)
+        return default if spec is None else Item._content(self._item, *spec)
+
+    def __iter__(self):
+        return iter(self._tags)
+
+    def __len__(self) -> int:
+        return len(self._tags)
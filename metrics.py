@@ -0,0 +1,87 @@
+"""OpenTelemetry metrics for serving feeds.
+
+Instruments are created on the global meter provider, which configure() sets
+up from METRICS_EXPORTER in app.py. Until then, recording is a no-op.
+"""
+
+import contextlib
+import os
+import time
+from typing import Iterator, Optional
+
+from opentelemetry import metrics as otel_metrics
+from opentelemetry.sdk.metrics import MeterProvider
+from opentelemetry.sdk.metrics.export import (
+        ConsoleMetricExporter, InMemoryMetricReader, MetricReader, PeriodicExportingMetricReader)
+from opentelemetry.sdk.resources import Resource
+
+# Seconds between exports. Cloud Monitoring accepts at most one point per
+# time series every 5 seconds.
+METRICS_EXPORT_INTERVAL = float(os.environ.get("METRICS_EXPORT_INTERVAL", 60))
+
+meter = otel_metrics.get_meter(__name__)
+
+phase_duration = meter.create_histogram(
+        "filter_feed.phase.duration", unit="s",
+        description="Time spent in each phase of serving a feed, by phase")
+upstream_bytes = meter.create_counter(
+        "filter_feed.upstream.bytes", unit="By",
+        description="Bytes of upstream feed bodies downloaded")
+items = meter.create_counter(
+        "filter_feed.items", unit="{item}",
+        description="Items filtered, by direction: in (before) or out (kept)")
+cache_requests = meter.create_counter(
+        "filter_feed.cache.requests", unit="{request}",
+        description="Cache lookups, by cache and result (hit or miss)")
+in_flight = meter.create_up_down_counter(
+        "filter_feed.in_flight", unit="{request}",
+        description="Requests in progress, by kind: feed, merge or upstream")
+
+# Set by configure() for "memory", for tests to read.
+reader = None  # type: Optional[MetricReader]
+
+
+def configure(exporter: str, resource: Optional[Resource] = None):
+    """Sets the global meter provider up to export to "stackdriver", "stdout"
+    or "memory". Anything else leaves metrics disabled."""
+    global reader
+    interval = int(METRICS_EXPORT_INTERVAL * 1000)
+    if exporter == "stackdriver":
+        # Imported here since it needs Google Cloud credentials to be created.
+        from opentelemetry.exporter.cloud_monitoring import CloudMonitoringMetricsExporter
+        new_reader = PeriodicExportingMetricReader(
+                CloudMonitoringMetricsExporter(), export_interval_millis=interval)
+    elif exporter == "stdout":
+        new_reader = PeriodicExportingMetricReader(
+                ConsoleMetricExporter(), export_interval_millis=interval)
+    elif exporter == "memory":
+        new_reader = InMemoryMetricReader()
+    else:
+        return
+    otel_metrics.set_meter_provider(MeterProvider(
+            metric_readers=[new_reader], resource=resource or Resource.create()))
+    reader = new_reader
+
+
+@contextlib.contextmanager
+def phase(name: str) -> Iterator[None]:
+    """Records how long the block takes as phase name."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phase_duration.record(time.perf_counter() - start, {"phase": name})
+
+
+@contextlib.contextmanager
+def request(kind: str) -> Iterator[None]:
+    """Counts the block as an in-flight request of the given kind."""
+    in_flight.add(1, {"kind": kind})
+    try:
+        yield
+    finally:
+        in_flight.add(-1, {"kind": kind})
+
+
+def cache_lookup(cache: str, hit: bool, count: int = 1):
+    cache_requests.add(count, {"cache": cache, "result": "hit" if hit else "miss"})
@@ -57,6 +57,11 @@ class FilterFeed(ndb.Model):
     url = ndb.StringProperty(required=True, validator=_validate_url)
     name = ndb.StringProperty(required=True)
     query_builder = ndb.JsonProperty(required=True, validator=_validate_jqqb)
+    # Largest upstream body to download, for known-large feeds. Defaults to
+    # fetch.UPSTREAM_MAX_BYTES.
+    max_bytes = ndb.IntegerProperty()
+    # More upstream feeds to filter the same way and merge with url.
+    extra_urls = ndb.StringProperty(repeated=True, validator=_validate_url)
 
 
 class Role(ndb.Model,  RoleMixin):
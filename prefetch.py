@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""Keeps the most requested feeds refreshed before clients ask for them.
+
+In-process, app.py starts the scheduler when PREFETCH_FEEDS is set and every
+feed request is recorded. The hottest feeds are refetched and re-rendered in a
+background thread. Their output is served as fresh for FEED_FRESH_TTL, and
+after that stale while the next request revalidates it, so requests seldom
+wait on an upstream.
+
+As a separate worker, polls the service's own feed URLs so that its caches
+stay warm:
+
+    python3 prefetch.py --base_url=https://filter-feed.newg.as
+
+The worker can not see the requests the service receives, so it considers
+every FilterFeed equally popular.
+"""
+
+from dataclasses import dataclass
+import hashlib
+import heapq
+import math
+import os
+import threading
+import time
+from typing import Any, Callable, ContextManager, Hashable, Optional
+
+from absl import app, flags, logging
+from google.cloud import ndb  # type: Any
+
+import fetch
+import filter_feed
+import settings_cache
+from model import FilterFeed
+
+# Number of most requested feeds to keep refreshed in-process. 0 disables the
+# in-process scheduler.
+PREFETCH_FEEDS = int(os.environ.get("PREFETCH_FEEDS", 0))
+PREFETCH_MIN_INTERVAL = float(os.environ.get("PREFETCH_MIN_INTERVAL", 30))
+PREFETCH_MAX_INTERVAL = float(os.environ.get("PREFETCH_MAX_INTERVAL", 900))
+# Requests count for half as much after this many seconds.
+PREFETCH_HALF_LIFE = float(os.environ.get("PREFETCH_HALF_LIFE", 3600))
+PREFETCH_TICK = float(os.environ.get("PREFETCH_TICK", 5))
+
+# How much the refresh interval shrinks when a feed is seen to change, and
+# grows when it is not.
+INTERVAL_SHRINK = 0.5
+INTERVAL_GROW = 1.5
+
+
+@dataclass
+class _Feed:
+    score: float
+    scored_at: float
+    interval: float
+    next_refresh: float
+    fingerprint: Optional[str] = None
+
+
+class Scheduler:
+    """Tracks how often each feed is requested and when to refresh it.
+
+    Request counts decay exponentially with the given half life. Each feed's
+    refresh interval adapts to how often its upstream fingerprint changes:
+    halved when it has changed since the last refresh and grown by half when
+    it has not, between min_interval and max_interval.
+
+    refresh is called with a feed key and the interval until the feed will
+    next be refreshed, and returns the upstream fingerprint, or None if the
+    feed no longer exists.
+    """
+
+    def __init__(self, refresh: Callable[[Hashable, float], Optional[str]],
+                 max_feeds: int,
+                 min_interval: float = PREFETCH_MIN_INTERVAL,
+                 max_interval: float = PREFETCH_MAX_INTERVAL,
+                 half_life: float = PREFETCH_HALF_LIFE,
+                 clock: Callable[[], float] = time.monotonic):
+        self.refresh = refresh
+        self.max_feeds = max_feeds
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.half_life = half_life
+        self.clock = clock
+        # Tracks more feeds than it refreshes so that a feed has to stay
+        # popular for a while to be evicted.
+        self.max_tracked = max_feeds * 10
+        self._feeds = {}  # type: dict[Hashable, _Feed]
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None  # type: Optional[threading.Thread]
+
+    def _score(self, feed: _Feed, now: float) -> float:
+        return feed.score * math.pow(0.5, (now - feed.scored_at) / self.half_life)
+
+    def record(self, key: Hashable):
+        now = self.clock()
+        with self._lock:
+            feed = self._feeds.get(key)
+            if feed is None:
+                feed = self._feeds[key] = _Feed(
+                        score=0, scored_at=now, interval=self.min_interval,
+                        next_refresh=now + self.min_interval)
+            feed.score = self._score(feed, now) + 1
+            feed.scored_at = now
+            if len(self._feeds) > self.max_tracked:
+                coldest = min((k for k in self._feeds if k != key),
+                              key=lambda k: self._score(self._feeds[k], now))
+                del self._feeds[coldest]
+
+    def forget(self, key: Hashable):
+        with self._lock:
+            self._feeds.pop(key, None)
+
+    def due(self) -> list:
+        now = self.clock()
+        with self._lock:
+            hot = heapq.nlargest(self.max_feeds, self._feeds,
+                                 key=lambda k: self._score(self._feeds[k], now))
+            return [k for k in hot if self._feeds[k].next_refresh <= now]
+
+    def tracks(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._feeds
+
+    def interval(self, key: Hashable) -> Optional[float]:
+        with self._lock:
+            feed = self._feeds.get(key)
+            return feed.interval if feed else None
+
+    def _refreshed(self, key: Hashable, fingerprint: Optional[str]):
+        with self._lock:
+            feed = self._feeds.get(key)
+            if feed is None:
+                return
+            if fingerprint is not None and feed.fingerprint is not None:
+                if fingerprint != feed.fingerprint:
+                    feed.interval = max(self.min_interval, feed.interval * INTERVAL_SHRINK)
+                else:
+                    feed.interval = min(self.max_interval, feed.interval * INTERVAL_GROW)
+            feed.fingerprint = fingerprint
+            feed.next_refresh = self.clock() + feed.interval
+
+    def run_once(self):
+        for key in self.due():
+            with self._lock:
+                feed = self._feeds.get(key)
+                if feed is None:
+                    continue
+                interval = feed.interval
+            try:
+                fingerprint = self.refresh(key, interval)
+            except Exception as e:
+                logging.warning("Prefetching %s failed: %s", key, e)
+                self._refreshed(key, None)
+                continue
+            if fingerprint is None:
+                self.forget(key)
+            else:
+                self._refreshed(key, fingerprint)
+
+    def run(self, tick: float = PREFETCH_TICK):
+        while not self._stop.is_set():
+            self.run_once()
+            self._stop.wait(tick)
+
+    def start(self, tick: float = PREFETCH_TICK):
+        self._thread = threading.Thread(target=self.run, args=(tick,), name="prefetch",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def refresher(context: Callable[[], ContextManager]) -> Callable[[ndb.Key, float], Optional[str]]:
+    """Returns a Scheduler.refresh that refreshes the served feed in-process,
+    using context to enter an ndb context for the FilterFeed lookup.
+    """
+    def refresh(key: ndb.Key, interval: float) -> Optional[str]:
+        with context():
+            settings = settings_cache.get(key)
+        if settings is None:
+            return None
+        # Served as fresh for FEED_FRESH_TTL only, however long the interval:
+        # after that, requests revalidate the upstream as if there were no
+        # prefetching, so a quiet feed picks up a new item just as soon.
+        if settings.extra_urls:
+            # The merged output stands in for its upstreams' fingerprints.
+            rendered = filter_feed.refresh(key, settings)
+            return hashlib.sha256(rendered.body).hexdigest()
+        upstream = fetch.fetch(settings.url, settings.max_bytes)
+        filter_feed.refresh_from(key, settings, upstream)
+        return upstream.fingerprint
+    return refresh
+
+
+scheduler = None  # type: Optional[Scheduler]
+
+
+def start(context: Callable[[], ContextManager]):
+    global scheduler
+    if PREFETCH_FEEDS and scheduler is None:
+        scheduler = Scheduler(refresher(context), PREFETCH_FEEDS)
+        scheduler.start()
+
+
+def record(key: ndb.Key):
+    if scheduler is not None:
+        scheduler.record(key)
+
+
+flags.DEFINE_string("base_url", None, "Base URL of the filter-feed service to keep warm")
+flags.DEFINE_integer("max_feeds", 1000, "Maximum number of feeds to keep warm")
+
+FLAGS = flags.FLAGS
+
+
+def http_refresher(base_url: str) -> Callable[[ndb.Key, float], Optional[str]]:
+    """Returns a Scheduler.refresh that requests the feed from the service."""
+    def refresh(key: ndb.Key, interval: float) -> Optional[str]:
+        path = "/".join(str(pair[1]) for pair in key.pairs())
+        response = fetch.session.get(
+                f"{base_url.rstrip('/')}/v1/{path}",
+                timeout=(fetch.UPSTREAM_CONNECT_TIMEOUT, fetch.UPSTREAM_READ_TIMEOUT))
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return hashlib.sha256(response.content).hexdigest()
+    return refresh
+
+
+def main(_):
+    client = ndb.Client()
+    worker = Scheduler(http_refresher(FLAGS.base_url), FLAGS.max_feeds)
+    while True:
+        # Pick up feeds created since the last pass.
+        with client.context():
+            keys = FilterFeed.query().fetch(FLAGS.max_feeds, keys_only=True)
+        for key in keys:
+            if not worker.tracks(key):
+                worker.record(key)
+        deadline = time.monotonic() + PREFETCH_MAX_INTERVAL
+        while time.monotonic() < deadline:
+            worker.run_once()
+            time.sleep(PREFETCH_TICK)
+
+
+if __name__ == '__main__':
+    flags.mark_flag_as_required("base_url")
+    app.run(main)
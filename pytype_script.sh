@@ -1,2 +1,2 @@
 #!/bin/sh
-PATH="$PATH:$HOME/.local/bin" python3 -m pytype app.py filter_feed.py model.py item.py view.py feed_admin.py
+PATH="$PATH:$HOME/.local/bin" python3 -m pytype app.py filter_feed.py model.py item.py view.py feed_admin.py fetch.py cache.py streaming.py rules.py serializer.py asgi.py prefetch.py compress.py breaker.py settings_cache.py dates.py xml_backend.py benchmark.py metrics.py
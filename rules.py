@@ -0,0 +1,252 @@
+import collections.abc
+import hashlib
+import json
+import os
+from typing import Any, Callable, FrozenSet, Mapping, Optional, Sequence
+
+from jqqb_evaluator.evaluator import Evaluator
+from jqqb_evaluator.operators import Operators
+from jqqb_evaluator.rule import Rule
+
+import cache
+
+Predicate = Callable[[Mapping[str, Any]], bool]
+Columns = Mapping[str, Sequence[Any]]
+# Evaluates rules for the given rows of the columns, one result per row.
+ColumnPredicate = Callable[[Columns, Sequence[int]], list]
+
+COMPILED_RULES_CACHE_SIZE = int(os.environ.get("COMPILED_RULES_CACHE_SIZE", 1024))
+
+
+def query_builder_hash(query_builder) -> str:
+    canonical = json.dumps(query_builder, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+# Scalar versions of jqqb_evaluator.operators.Operators. List inputs are left
+# to the originals.
+_OPERATORS = {
+    "begins_with": lambda l, r: l.startswith(r),
+    "between": lambda l, r: r[0] < l < r[1],
+    "contains": lambda l, r: r in l,
+    "ends_with": lambda l, r: l.endswith(r),
+    "equal": lambda l, r: l == r,
+    "greater": lambda l, r: l > r,
+    "greater_or_equal": lambda l, r: l >= r,
+    "in": lambda l, r: r in l,
+    "is_empty": lambda l, r: not bool(l and l.strip()),
+    "is_not_empty": lambda l, r: bool(l and l.strip()),
+    "is_not_null": lambda l, r: l is not None,
+    "is_null": lambda l, r: l is None,
+    "less": lambda l, r: l < r,
+    "less_or_equal": lambda l, r: l <= r,
+    "not_begins_with": lambda l, r: not l.startswith(r),
+    "not_between": lambda l, r: l <= r[0] or l >= r[1],
+    "not_contains": lambda l, r: r not in l,
+    "not_ends_with": lambda l, r: not l.endswith(r),
+    "not_equal": lambda l, r: l != r,
+    "not_in": lambda l, r: r not in l,
+}
+
+
+def _compile_rule(rule_dict) -> Predicate:
+    rule = Rule(rule_dict)
+    op = _OPERATORS.get(rule.operator)
+    if op is None or "." in rule.field:
+        # Unknown operators and nested fields keep jqqb_evaluator's behaviour,
+        # including raising when evaluated.
+        return rule.evaluate
+    field = rule.field
+    value = rule.get_value()
+    typecast = rule.typecast_value
+    is_string = rule.type == 'string'
+    list_op = getattr(Operators, 'eval_' + rule.operator)
+
+    def evaluate(obj):
+        left = obj.get(field)
+        if isinstance(left, list):
+            return list_op([typecast(x) for x in left], value)
+        if left is not None and not (is_string and type(left) is str):
+            left = typecast(left)
+        return op(left, value)
+    return evaluate
+
+
+def _compile_group(group) -> Predicate:
+    children = [_compile_group(r) if 'rules' in r else _compile_rule(r)
+                for r in group['rules']]
+    if group['condition'] == 'AND':
+        def evaluate_all(obj):
+            for child in children:
+                if not child(obj):
+                    return False
+            return True
+        return evaluate_all
+    else:
+        def evaluate_any(obj):
+            for child in children:
+                if child(obj):
+                    return True
+            return False
+        return evaluate_any
+
+
+def compile_rules(query_builder) -> Predicate:
+    """Compiles a JQQB rule tree into a function equivalent to
+    Evaluator(query_builder).object_matches_rules.
+    """
+    try:
+        return _compile_group(query_builder)
+    except (KeyError, TypeError, ValueError):
+        # Malformed trees only fail once evaluated, as they did before.
+        return Evaluator(query_builder).object_matches_rules
+
+
+# Column-at-a-time versions of the commonest operators. The rest apply the
+# scalar operator to each value.
+_COLUMN_OPERATORS = {
+    "begins_with": lambda ls, r: [l.startswith(r) for l in ls],
+    "contains": lambda ls, r: [r in l for l in ls],
+    "ends_with": lambda ls, r: [l.endswith(r) for l in ls],
+    "equal": lambda ls, r: [l == r for l in ls],
+    "greater": lambda ls, r: [l > r for l in ls],
+    "greater_or_equal": lambda ls, r: [l >= r for l in ls],
+    "is_not_null": lambda ls, r: [l is not None for l in ls],
+    "is_null": lambda ls, r: [l is None for l in ls],
+    "less": lambda ls, r: [l < r for l in ls],
+    "less_or_equal": lambda ls, r: [l <= r for l in ls],
+    "not_begins_with": lambda ls, r: [not l.startswith(r) for l in ls],
+    "not_contains": lambda ls, r: [r not in l for l in ls],
+    "not_ends_with": lambda ls, r: [not l.endswith(r) for l in ls],
+    "not_equal": lambda ls, r: [l != r for l in ls],
+}
+
+
+class Row(collections.abc.Mapping):
+    """Row i of the columns, read in place rather than copied into a dict."""
+    __slots__ = ("_columns", "_i")
+
+    def __init__(self, columns: Columns, i: int):
+        self._columns = columns
+        self._i = i
+
+    def __getitem__(self, name: str) -> Any:
+        return self._columns[name][self._i]
+
+    def get(self, name: str, default: Any = None) -> Any:
+        column = self._columns.get(name)
+        return default if column is None else column[self._i]
+
+    def __iter__(self):
+        return iter(self._columns)
+
+    def __len__(self) -> int:
+        return len(self._columns)
+
+
+
+def _compile_column_rule(rule_dict) -> ColumnPredicate:
+    rule = Rule(rule_dict)
+    op = _OPERATORS.get(rule.operator)
+    if op is None or "." in rule.field:
+        return lambda columns, rows: [rule.evaluate(Row(columns, i)) for i in rows]
+    field = rule.field
+    value = rule.get_value()
+    typecast = rule.typecast_value
+    is_string = rule.type == 'string'
+    column_op = _COLUMN_OPERATORS.get(rule.operator)
+    if column_op is None:
+        column_op = lambda ls, r: [op(l, r) for l in ls]
+    row_rule = _compile_rule(rule_dict)
+
+    def evaluate(columns, rows):
+        column = columns.get(field)
+        if column is None:
+            return column_op([None] * len(rows), value)
+        values = [column[i] for i in rows]
+        if any(isinstance(v, list) for v in values):
+            return [row_rule(Row(columns, i)) for i in rows]
+        if is_string:
+            values = [v if v is None or type(v) is str else str(v) for v in values]
+        else:
+            values = [None if v is None else typecast(v) for v in values]
+        return column_op(values, value)
+    return evaluate
+
+
+def _compile_column_group(group) -> ColumnPredicate:
+    children = [_compile_column_group(r) if 'rules' in r else _compile_column_rule(r)
+                for r in group['rules']]
+    # Like the row-wise evaluator, each child only sees the rows whose result
+    # is still undecided, so later rules are never evaluated where jqqb would
+    # have short-circuited.
+    if group['condition'] == 'AND':
+        def evaluate_all(columns, rows):
+            remaining = rows
+            for child in children:
+                if not remaining:
+                    break
+                remaining = [i for i, m in zip(remaining, child(columns, remaining)) if m]
+            matched = set(remaining)
+            return [i in matched for i in rows]
+        return evaluate_all
+    else:
+        def evaluate_any(columns, rows):
+            matched = set()
+            remaining = rows
+            for child in children:
+                if not remaining:
+                    break
+                mask = child(columns, remaining)
+                matched.update(i for i, m in zip(remaining, mask) if m)
+                remaining = [i for i, m in zip(remaining, mask) if not m]
+            return [i in matched for i in rows]
+        return evaluate_any
+
+
+def compile_column_rules(query_builder) -> Callable[[Columns, int], list]:
+    """Compiles a JQQB rule tree into a function that evaluates it for every
+    row of a set of equal-length columns at once, one column per field.
+    """
+    try:
+        group = _compile_column_group(query_builder)
+        return lambda columns, count: group(columns, range(count))
+    except (KeyError, TypeError, ValueError):
+        evaluator = Evaluator(query_builder)
+        return lambda columns, count: [
+                evaluator.object_matches_rules(Row(columns, i)) for i in range(count)]
+
+
+def referenced_fields(query_builder) -> Optional[FrozenSet[str]]:
+    """Returns the top-level object fields the rules read, or None if unknown."""
+    def walk(group):
+        for r in group['rules']:
+            if 'rules' in r:
+                yield from walk(r)
+            else:
+                yield r['field'].split(".")[0]
+    try:
+        return frozenset(walk(query_builder))
+    except (KeyError, TypeError, AttributeError):
+        return None
+
+
+_compiled = cache.LRUCache(COMPILED_RULES_CACHE_SIZE, ttl=float('inf'))
+
+
+def compiled(query_builder) -> Predicate:
+    key = ("row", query_builder_hash(query_builder))
+    predicate = _compiled.get(key)
+    if predicate is None:
+        predicate = compile_rules(query_builder)
+        _compiled.put(key, predicate)
+    return predicate
+
+
+def compiled_columns(query_builder) -> Callable[[Columns, int], list]:
+    key = ("column", query_builder_hash(query_builder))
+    predicate = _compiled.get(key)
+    if predicate is None:
+        predicate = compile_column_rules(query_builder)
+        _compiled.put(key, predicate)
+    return predicate
@@ -0,0 +1,85 @@
+from typing import Mapping
+import xml.etree.ElementTree as ET
+
+XML_NS = "http://www.w3.org/XML/1998/namespace"
+
+
+def _name(name) -> str:
+    return name.text if isinstance(name, ET.QName) else name
+
+
+def _namespaces(root: ET.Element, prefixes: Mapping[str, str]):
+    """Like ElementTree._namespaces, but picks prefixes from the given
+    prefix -> uri map before the global registry, and never modifies either.
+    """
+    preferred = {uri: prefix for prefix, uri in prefixes.items()}
+    # dicts rather than sets so generated prefixes follow document order.
+    element_names = {}
+    attribute_names = {}
+    for elem in root.iter():
+        tag = elem.tag
+        if isinstance(tag, (str, ET.QName)):
+            element_names[_name(tag)] = None
+        for key, value in elem.items():
+            attribute_names[_name(key)] = None
+            if isinstance(value, ET.QName):
+                element_names[value.text] = None
+        if isinstance(elem.text, ET.QName):
+            element_names[elem.text.text] = None
+
+    # An unprefixed attribute is never in a namespace, and an unqualified
+    # element is only allowed while there is no default namespace.
+    default_allowed = all(name[:1] == "{" for name in element_names)
+    attribute_uris = {name[1:].rsplit("}", 1)[0] for name in attribute_names if name[:1] == "{"}
+
+    namespaces = {}
+    taken = set()
+
+    def prefix_for(uri: str) -> str:
+        if uri == XML_NS:
+            return "xml"
+        prefix = namespaces.get(uri)
+        if prefix is not None:
+            return prefix
+        prefix = preferred.get(uri)
+        if prefix is None:
+            # pytype: disable=module-attr
+            prefix = ET._namespace_map.get(uri)
+            # pytype: enable=module-attr
+        if prefix == "" and (not default_allowed or uri in attribute_uris):
+            prefix = None
+        if prefix is None or prefix in taken or prefix == "xml":
+            n = 0
+            while "ns%d" % n in taken:
+                n += 1
+            prefix = "ns%d" % n
+        taken.add(prefix)
+        namespaces[uri] = prefix
+        return prefix
+
+    qnames = {None: None}
+    for name in list(element_names) + list(attribute_names):
+        if name in qnames:
+            continue
+        if name[:1] == "{":
+            uri, local = name[1:].rsplit("}", 1)
+            prefix = prefix_for(uri)
+            qnames[name] = "%s:%s" % (prefix, local) if prefix else local
+        else:
+            qnames[name] = name
+    return qnames, namespaces
+
+
+def tostring(root: ET.Element, prefixes: Mapping[str, str]) -> str:
+    """Serializes root like ET.tostring(root, encoding='unicode'), using the
+    given prefix -> uri map (e.g. as recorded while parsing) for namespaces.
+
+    Unlike registering the prefixes with ET.register_namespace, this touches
+    no global state and so is safe to call from several threads at once.
+    """
+    qnames, namespaces = _namespaces(root, prefixes)
+    out = []
+    # pytype: disable=module-attr
+    ET._serialize_xml(out.append, root, qnames, namespaces, short_empty_elements=True)
+    # pytype: enable=module-attr
+    return "".join(out)
@@ -0,0 +1,104 @@
+"""Caches FilterFeed entities so that serving a feed rarely waits on Datastore.
+
+Two layers: an in-process LRU cache of entities, and optionally ndb's global
+cache, shared by every process, which ndb updates itself on put and delete.
+
+Edits made by another process, whether another worker or feed_admin.py, are
+only seen here once this process's entry expires. Without a global cache that
+takes up to SETTINGS_CACHE_TTL seconds. With one, ndb keeps the shared layer
+current, so the in-process entries only live for SETTINGS_CACHE_SHARED_TTL.
+"""
+
+import os
+from typing import Any, Callable, ContextManager, Optional
+
+from google.cloud import ndb  # type: Any
+from google.cloud.ndb import global_cache as ndb_global_cache
+
+import cache
+import metrics
+import model
+
+SETTINGS_CACHE_SIZE = int(os.environ.get("SETTINGS_CACHE_SIZE", 1024))
+# Writes from other processes are only seen once this expires.
+SETTINGS_CACHE_TTL = float(os.environ.get("SETTINGS_CACHE_TTL", 60))
+# Used instead when NDB_GLOBAL_CACHE is set.
+SETTINGS_CACHE_SHARED_TTL = float(os.environ.get("SETTINGS_CACHE_SHARED_TTL", 5))
+# "redis" (configured by REDIS_CACHE_URL), "memcache" (MEMCACHED_HOSTS),
+# "memory" (a stand-in that is only shared within the process, for tests) or
+# empty for none.
+NDB_GLOBAL_CACHE = os.environ.get("NDB_GLOBAL_CACHE", "").lower()
+NDB_GLOBAL_CACHE_TIMEOUT = int(os.environ.get("NDB_GLOBAL_CACHE_TIMEOUT", 3600))
+
+_global_cache = None  # type: Optional[ndb_global_cache.GlobalCache]
+
+
+def global_cache() -> Optional[ndb_global_cache.GlobalCache]:
+    global _global_cache
+    if _global_cache is None:
+        if NDB_GLOBAL_CACHE == "redis":
+            _global_cache = ndb_global_cache.RedisCache.from_environment()
+        elif NDB_GLOBAL_CACHE == "memcache":
+            _global_cache = ndb_global_cache.MemcacheCache.from_environment()
+        elif NDB_GLOBAL_CACHE == "memory":
+            _global_cache = ndb_global_cache._InProcessGlobalCache()
+    return _global_cache
+
+
+def context(client: ndb.Client) -> Callable[..., ContextManager]:
+    """Returns a replacement for client.context that uses the global cache.
+
+    Writes must also go through such a context for ndb to keep the global
+    cache up to date.
+    """
+    context = client.context
+    shared = global_cache()
+    if shared is None:
+        return context
+    return lambda **kwargs: context(
+            global_cache=shared,
+            global_cache_timeout_policy=lambda key: NDB_GLOBAL_CACHE_TIMEOUT,
+            **kwargs)
+
+
+# Keyed by FilterFeed urlsafe key. Only found entities are cached.
+_settings = cache.LRUCache(
+        SETTINGS_CACHE_SIZE, SETTINGS_CACHE_SHARED_TTL if NDB_GLOBAL_CACHE else SETTINGS_CACHE_TTL)
+
+
+def get(key: ndb.Key) -> Optional[model.FilterFeed]:
+    """Like key.get(), but cached. Don't modify the returned entity."""
+    urlsafe = key.urlsafe()
+    settings = _settings.get(urlsafe)
+    metrics.cache_lookup("settings", settings is not None)
+    if settings is None:
+        settings = key.get()
+        if settings is not None:
+            _settings.put(urlsafe, settings)
+    return settings
+
+
+def get_multi(keys: list) -> list:
+    """Like ndb.get_multi(keys), but cached, with one batched lookup for the
+    misses."""
+    found = [_settings.get(key.urlsafe()) for key in keys]
+    missing = [key for key, settings in zip(keys, found) if settings is None]
+    metrics.cache_lookup("settings", True, len(keys) - len(missing))
+    metrics.cache_lookup("settings", False, len(missing))
+    if missing:
+        fetched = iter(ndb.get_multi(missing))
+        for i, settings in enumerate(found):
+            if settings is None:
+                settings = found[i] = next(fetched)
+                if settings is not None:
+                    _settings.put(keys[i].urlsafe(), settings)
+    return found
+
+
+def invalidate(key: ndb.Key):
+    """Forgets key in this process only."""
+    _settings.discard(key.urlsafe())
+
+
+def clear():
+    _settings.clear()
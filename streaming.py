@@ -0,0 +1,170 @@
+from dataclasses import dataclass
+from typing import Callable, Optional
+from xml.parsers import expat
+import xml.etree.ElementTree as ET
+
+TITLE_SUFFIX = " (filtered)"
+
+
+@dataclass
+class Layout:
+    # Tag paths from the root element, e.g. ("rss", "channel", "item").
+    item_path: tuple
+    title_path: tuple
+    # Returns True for items that should be removed from the feed.
+    drop: Callable[[ET.Element], bool]
+
+
+class StreamingFilter:
+    """Filters a feed incrementally without building the whole tree.
+
+    Upstream bytes are fed in as they arrive. Everything outside of items is
+    passed through verbatim as soon as it has been parsed. Each item is
+    buffered only until its end tag, when it is either passed through
+    unchanged or dropped, so memory is bounded by the largest single item
+    rather than by the size of the feed.
+
+    layout_for_root is called with the tag of the root element and returns
+    how to find items and the title, or None to pass the feed through
+    unmodified.
+    """
+
+    def __init__(self, layout_for_root: Callable[[str], Optional[Layout]]):
+        self.layout_for_root = layout_for_root
+        self.layout = None  # type: Optional[Layout]
+        self._parser = expat.ParserCreate(namespace_separator="}")
+        self._parser.namespace_prefixes = True
+        self._parser.XmlDeclHandler = self._xml_decl
+        self._parser.StartElementHandler = self._start
+        self._parser.EndElementHandler = self._end
+        self._parser.CharacterDataHandler = self._data
+        for handler in ("CommentHandler", "ProcessingInstructionHandler",
+                        "StartCdataSectionHandler", "EndCdataSectionHandler"):
+            setattr(self._parser, handler, self._event)
+        self._encoding = "utf-8"
+        self._path = []  # type: list[str]
+        # Unparsed or undecided bytes, starting at absolute offset _buf_start.
+        self._buf = bytearray()
+        self._buf_start = 0
+        # Absolute offset up to which output has been decided.
+        self._cursor = 0
+        self._out = []  # type: list[bytes]
+        self._item = None  # type: Optional[ET.TreeBuilder]
+        self._item_drop = None  # type: Optional[bool]
+        self._title_done = False
+        # Items decided on so far, and how many of them were dropped.
+        self.items = 0
+        self.dropped = 0
+
+    def feed(self, data: bytes) -> bytes:
+        self._buf += data
+        self._parser.Parse(data, False)
+        return self._take()
+
+    def close(self) -> bytes:
+        self._parser.Parse(b"", True)
+        self._emit_to(self._buf_start + len(self._buf))
+        return self._take()
+
+    def _take(self) -> bytes:
+        consumed = self._cursor - self._buf_start
+        if consumed:
+            del self._buf[:consumed]
+            self._buf_start = self._cursor
+        out = b"".join(self._out)
+        self._out.clear()
+        return out
+
+    def _emit_to(self, offset: int):
+        if offset > self._cursor:
+            self._out.append(bytes(self._buf[self._cursor - self._buf_start:offset - self._buf_start]))
+            self._cursor = offset
+
+    def _skip_to(self, offset: int):
+        self._cursor = offset
+
+    def _event(self, *args):
+        self._advance(text=False)
+
+    def _advance(self, text: bool):
+        # Every parse event marks a point where the preceding bytes are
+        # complete, so any item that just ended can now be resolved and any
+        # bytes outside of items can be passed through.
+        offset = self._parser.CurrentByteIndex
+        if self._item_drop is not None:
+            if not self._item_drop:
+                self._emit_to(offset)
+            elif text:
+                # Like Element.remove, a dropped item takes its tail with it.
+                return
+            else:
+                self._skip_to(offset)
+            self._item_drop = None
+        if self._item is None:
+            self._emit_to(offset)
+
+    def _xml_decl(self, version, encoding, standalone):
+        if encoding:
+            self._encoding = encoding
+
+    @staticmethod
+    def _tag(name: str) -> str:
+        # expat reports names as "uri}local}prefix", "uri}local" or "local".
+        parts = name.split("}")
+        return "{%s}%s" % (parts[0], parts[1]) if len(parts) > 1 else name
+
+    @staticmethod
+    def _qname(name: str) -> str:
+        parts = name.split("}")
+        return "%s:%s" % (parts[2], parts[1]) if len(parts) == 3 else parts[-1]
+
+    def _at_end_tag(self, offset: int, name: str) -> bool:
+        end_tag = ("</" + self._qname(name)).encode(self._encoding)
+        i = offset - self._buf_start
+        return (self._buf[i:i + len(end_tag)] == end_tag
+                and self._buf[i + len(end_tag):i + len(end_tag) + 1] in (b">", b" ", b"\t", b"\r", b"\n"))
+
+    def _start(self, name, attrs):
+        self._event()
+        tag = self._tag(name)
+        self._path.append(tag)
+        if len(self._path) == 1:
+            self.layout = self.layout_for_root(tag)
+        if self._item is not None:
+            self._item.start(tag, {self._tag(k): v for k, v in attrs.items()})
+        elif self.layout is not None and tuple(self._path) == self.layout.item_path:
+            self._item = ET.TreeBuilder()
+            self._item.start(tag, {self._tag(k): v for k, v in attrs.items()})
+
+    def _data(self, data):
+        self._advance(text=True)
+        if self._item is not None:
+            self._item.data(data)
+
+    def _end(self, name):
+        self._event()
+        tag = self._tag(name)
+        if self._item is not None:
+            self._item.end(tag)
+            if tuple(self._path) == self.layout.item_path:
+                element = self._item.close()
+                self._item = None
+                # The end of the item is only known at the next event.
+                self._item_drop = self.layout.drop(element)
+                self.items += 1
+                self.dropped += bool(self._item_drop)
+        elif (self.layout is not None and not self._title_done
+              and tuple(self._path) == self.layout.title_path):
+            self._title_done = True
+            offset = self._parser.CurrentByteIndex
+            # An empty <title/> has no end tag to insert before.
+            if self._at_end_tag(offset, name):
+                self._emit_to(offset)
+                self._out.append(TITLE_SUFFIX.encode(self._encoding, "xmlcharrefreplace"))
+        self._path.pop()
+
+
+def splice(content: bytes, layout_for_root: Callable[[str], Optional[Layout]]) -> bytes:
+    """Returns content with dropped items cut out and the title marked."""
+    sf = StreamingFilter(layout_for_root)
+    return sf.feed(content) + sf.close()
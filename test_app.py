@@ -1,20 +1,27 @@
 #!/usr/bin/env python3
 
+import gzip
 import os
 from unittest import mock
 import unittest
 from xml.etree import ElementTree as ET
 
+import brotli
 from flask_login.test_client import FlaskLoginClient
 from google.cloud import ndb
 from google.cloud.datastore_v1 import types as datastore_type
+import requests
 import requests_mock
 import werkzeug
 from werkzeug.routing import ValidationError, Map
 
-from app import app, cloud_ndb, KeyConverter
+from app import app, cloud_ndb, KeyConverter, KeyListConverter
+import compress
+import fetch
+import filter_feed
 import model
 import ndb_mocks
+import settings_cache
 import ndb_user_datastore
 import dataclasses
 from fake_user import FakeUser, FakeRole
@@ -53,6 +60,20 @@ class AppTestCase(unittest.TestCase):
 class TestApply(AppTestCase):
     def setUp(self):
         super().setUp()
+        fetch.store.clear()
+        self.addCleanup(fetch.store.clear)
+        settings_cache.clear()
+        self.addCleanup(settings_cache.clear)
+        fetch.hosts.clear()
+        self.addCleanup(fetch.hosts.clear)
+        fetch._unavailable.clear()
+        self.addCleanup(fetch._unavailable.clear)
+        filter_feed.render_cache.clear()
+        self.addCleanup(filter_feed.render_cache.clear)
+        filter_feed.served_cache.clear()
+        self.addCleanup(filter_feed.served_cache.clear)
+        filter_feed.merged_cache.clear()
+        self.addCleanup(filter_feed.merged_cache.clear)
         self.requests = requests_mock.Mocker()
         self.requests.start()
         self.addCleanup(self.requests.stop)
@@ -95,6 +116,197 @@ class TestApply(AppTestCase):
             ET.canonicalize(from_file=os.path.join(TESTDATA,  "rss-filtered.xml")))
     
     
+    def test_stream(self):
+        e = datastore_type.Entity(
+          properties = {
+            "url": datastore_type.Value(string_value="http://example.com/a"), 
+            "name": datastore_type.Value(string_value="nickname"),  
+            "query_builder": datastore_type.Value(blob_value=b'{"condition":"AND","rules":[{"id":"title","field":"title","type":"string","input":"text","operator":"contains","value":"Boring"}]}')}, 
+          key = {"partition_id":{"project_id":app.config["NDB_PROJECT"]},"path": [
+              {"kind": "User", "id": 949},{"kind": "FilterFeed", "id": 123}]})
+        lookup_res = datastore_type.LookupResponse(found=[{"entity":e}])
+        self.stub.lookup.set_val(lookup_res)
+
+        with mock.patch.object(filter_feed, 'FEED_PIPELINE', 'stream'), \
+                mock.patch.object(filter_feed, 'STREAM_CHUNK_BYTES', 16):
+            r = self.client.get('/v1/949/123')
+
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(
+            ET.canonicalize(r.data),
+            ET.canonicalize(from_file=os.path.join(TESTDATA,  "rss-filtered.xml")))
+
+    def test_splice(self):
+        e = datastore_type.Entity(
+          properties = {
+            "url": datastore_type.Value(string_value="http://example.com/a"), 
+            "name": datastore_type.Value(string_value="nickname"),  
+            "query_builder": datastore_type.Value(blob_value=b'{"condition":"AND","rules":[{"id":"title","field":"title","type":"string","input":"text","operator":"contains","value":"Boring"}]}')}, 
+          key = {"partition_id":{"project_id":app.config["NDB_PROJECT"]},"path": [
+              {"kind": "User", "id": 949},{"kind": "FilterFeed", "id": 123}]})
+        lookup_res = datastore_type.LookupResponse(found=[{"entity":e}])
+        self.stub.lookup.set_val(lookup_res)
+
+        with mock.patch.object(filter_feed, 'FEED_PIPELINE', 'splice'):
+            r = self.client.get('/v1/949/123')
+
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(
+            ET.canonicalize(r.data),
+            ET.canonicalize(from_file=os.path.join(TESTDATA,  "rss-filtered.xml")))
+        # Formatting and prefixes are untouched.
+        self.assertIn(b'<fakens:blah></fakens:blah>', r.data)
+
+    def test_render_cached(self):
+        e = datastore_type.Entity(
+          properties = {
+            "url": datastore_type.Value(string_value="http://example.com/a"), 
+            "name": datastore_type.Value(string_value="nickname"),  
+            "query_builder": datastore_type.Value(blob_value=b'{"condition":"AND","rules":[{"id":"title","field":"title","type":"string","input":"text","operator":"contains","value":"Boring"}]}')}, 
+          key = {"partition_id":{"project_id":app.config["NDB_PROJECT"]},"path": [
+              {"kind": "User", "id": 949},{"kind": "FilterFeed", "id": 123}]})
+        lookup_res = datastore_type.LookupResponse(found=[{"entity":e}])
+        self.stub.lookup.set_val(lookup_res)
+
+        with mock.patch.object(filter_feed, 'render', wraps=filter_feed.render) as render:
+            r1 = self.client.get('/v1/949/123')
+            r2 = self.client.get('/v1/949/123')
+            render.assert_called_once()
+
+        self.assertEqual(r2.status_code, 200)
+        self.assertEqual(r1.data, r2.data)
+
+    def _lookup_feed(self):
+        e = datastore_type.Entity(
+          properties = {
+            "url": datastore_type.Value(string_value="http://example.com/a"), 
+            "name": datastore_type.Value(string_value="nickname"),  
+            "query_builder": datastore_type.Value(blob_value=b'{"condition":"AND","rules":[{"id":"title","field":"title","type":"string","input":"text","operator":"contains","value":"Boring"}]}')}, 
+          key = {"partition_id":{"project_id":app.config["NDB_PROJECT"]},"path": [
+              {"kind": "User", "id": 949},{"kind": "FilterFeed", "id": 123}]})
+        self.stub.lookup.set_val(datastore_type.LookupResponse(found=[{"entity":e}]))
+
+    def _age_served(self, fresh: bool, stale: bool):
+        for key in list(filter_feed.served_cache._entries):
+            served = filter_feed.served_cache.get(key)
+            now = filter_feed.served_cache.clock()
+            served.fresh_until = now + 60 if fresh else now - 1
+            served.stale_until = now + 60 if stale else now - 1
+
+    def test_serve_fresh(self):
+        self._lookup_feed()
+        r1 = self.client.get('/v1/949/123')
+        r2 = self.client.get('/v1/949/123')
+        self.assertEqual(self.requests.call_count, 1)
+        self.assertEqual(r1.data, r2.data)
+
+    def test_serve_stale_while_revalidate(self):
+        self._lookup_feed()
+        r1 = self.client.get('/v1/949/123')
+        self._age_served(fresh=False, stale=True)
+        self.requests.get('http://example.com/a', text="<rss><channel><title>New</title></channel></rss>")
+
+        with mock.patch.object(filter_feed._refresher, 'submit') as submit:
+            r2 = self.client.get('/v1/949/123')
+            submit.assert_called_once()
+            self.assertEqual(r2.data, r1.data)
+            submit.call_args[0][0]()
+
+        r3 = self.client.get('/v1/949/123')
+        self.assertIn(b"New (filtered)", r3.data)
+
+    def test_serve_stale_if_error(self):
+        self._lookup_feed()
+        r1 = self.client.get('/v1/949/123')
+        self._age_served(fresh=False, stale=False)
+        self.requests.get('http://example.com/a', exc=requests.exceptions.ConnectTimeout)
+
+        r2 = self.client.get('/v1/949/123')
+
+        self.assertEqual(r2.status_code, 200)
+        self.assertEqual(r2.data, r1.data)
+
+    def test_serve_stale_if_error_status(self):
+        self._lookup_feed()
+        r1 = self.client.get('/v1/949/123')
+        self._age_served(fresh=False, stale=False)
+        self.requests.get('http://example.com/a', status_code=503,
+                          text="<html><body>down</body></html>")
+
+        r2 = self.client.get('/v1/949/123')
+        r3 = self.client.get('/v1/949/123')
+
+        self.assertEqual(r2.status_code, 200)
+        self.assertEqual(r2.data, r1.data)
+        # The error page was not remembered as fresh either, and the failing
+        # upstream is not asked again for a while.
+        self.assertEqual(r3.data, r1.data)
+        self.assertEqual(self.requests.call_count, 2)
+
+    def test_upstream_error_status(self):
+        self._lookup_feed()
+        self.requests.get('http://example.com/a', status_code=503,
+                          text="<html><body>down</body></html>")
+
+        r = self.client.get('/v1/949/123')
+
+        self.assertEqual(r.status_code, 502)
+
+    def test_upstream_too_large(self):
+        self._lookup_feed()
+        self.requests.get('http://example.com/a', content=b"<rss/>" * 4, headers={"Content-Length": "24"})
+
+        with mock.patch.object(fetch, 'UPSTREAM_MAX_BYTES', new=10):
+            r = self.client.get('/v1/949/123')
+
+        self.assertEqual(r.status_code, 502)
+
+    def test_compressed(self):
+        self._lookup_feed()
+        plain = self.client.get('/v1/949/123')
+        self.assertIsNone(plain.content_encoding)
+        self.assertIn('Accept-Encoding', plain.vary)
+
+        with mock.patch.object(compress, 'COMPRESS_MIN_BYTES', new=0), \
+                mock.patch.object(compress, 'compress', wraps=compress.compress) as compressor:
+            for _ in range(2):
+                r = self.client.get('/v1/949/123', headers={'Accept-Encoding': 'gzip, br'})
+                self.assertEqual(r.content_encoding, 'br')
+                self.assertIn('Accept-Encoding', r.vary)
+                self.assertEqual(brotli.decompress(r.data), plain.data)
+            self.assertEqual(compressor.call_count, 1)
+
+            r = self.client.get('/v1/949/123', headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(r.content_encoding, 'gzip')
+            self.assertEqual(gzip.decompress(r.data), plain.data)
+
+    def test_small_not_compressed(self):
+        self._lookup_feed()
+        r = self.client.get('/v1/949/123', headers={'Accept-Encoding': 'gzip, br'})
+        self.assertIsNone(r.content_encoding)
+
+    def test_upstream_unreachable(self):
+        self._lookup_feed()
+        self.requests.get('http://example.com/a', exc=requests.exceptions.ConnectionError)
+
+        with mock.patch('app.logging.exception') as log_exception:
+            r = self.client.get('/v1/949/123')
+            log_exception.assert_not_called()
+
+        self.assertEqual(r.status_code, 502)
+
+    def test_render_cache_invalidate(self):
+        with cloud_ndb.context():
+            key = ndb.Key("User", 949, "FilterFeed", 123)
+            other = ndb.Key("User", 949, "FilterFeed", 456)
+        filter_feed.render_cache.put((key.urlsafe(), "a", "b"), "x")
+        filter_feed.render_cache.put((other.urlsafe(), "a", "b"), "y")
+        filter_feed.served_cache.put((key.urlsafe(), "b"), "x")
+        filter_feed.invalidate(key)
+        self.assertIsNone(filter_feed.served_cache.get((key.urlsafe(), "b")))
+        self.assertIsNone(filter_feed.render_cache.get((key.urlsafe(), "a", "b")))
+        self.assertEqual(filter_feed.render_cache.get((other.urlsafe(), "a", "b")), "y")
+
     def test_legacy_unknown(self):
         e = datastore_type.Entity(key = {
             "partition_id":{"project_id":app.config["NDB_PROJECT"]},
@@ -130,6 +342,109 @@ class TestApply(AppTestCase):
         
         self.assertEqual(r.status_code,  404)
 
+    def _lookup_feeds(self, feeds):
+        """Serves lookups of User 949's FilterFeeds from an id -> (url, extra urls) map."""
+        def entity(feed_id):
+            url, extra_urls = feeds[feed_id]
+            properties = {
+                "url": datastore_type.Value(string_value=url),
+                "name": datastore_type.Value(string_value="nickname"),
+                "query_builder": datastore_type.Value(blob_value=b'{"condition":"AND","rules":[{"id":"title","field":"title","type":"string","input":"text","operator":"contains","value":"Boring"}]}')}
+            if extra_urls:
+                properties["extra_urls"] = datastore_type.Value(array_value={
+                    "values": [datastore_type.Value(string_value=u) for u in extra_urls]})
+            return datastore_type.Entity(
+              properties=properties,
+              key = {"partition_id":{"project_id":app.config["NDB_PROJECT"]},"path": [
+                  {"kind": "User", "id": 949},{"kind": "FilterFeed", "id": feed_id}]})
+        def lookup(request, **kwargs):
+            found = []
+            missing = []
+            for key in request.keys:
+                feed_id = key.path[-1].id
+                if feed_id in feeds:
+                    found.append({"entity": entity(feed_id)})
+                else:
+                    missing.append({"entity": {"key": key}})
+            return datastore_type.LookupResponse(found=found, missing=missing)
+        self.stub.lookup.set_side_effect(lookup)
+
+    def test_merged(self):
+        self._lookup_feeds({123: ("http://example.com/a", []), 456: ("http://example.com/b", [])})
+        self.requests.get('http://example.com/b', text="""<rss><channel><title>Other Pod</title>
+            <item><title>Newer Ep</title><pubDate>Sun, 06 Jun 2021 00:00:00 +0000</pubDate></item>
+            <item><title>Boring Other Ep</title><pubDate>Mon, 07 Jun 2021 00:00:00 +0000</pubDate></item>
+            <item><title>Older Ep</title><pubDate>Fri, 04 Jun 2021 00:00:00 +0000</pubDate></item>
+            </channel></rss>""")
+
+        with mock.patch.object(filter_feed, 'render_merged', wraps=filter_feed.render_merged) as render:
+            r = self.client.get('/v1/merge/949/123+949/456.rss')
+            self.client.get('/v1/merge/949/123+949/456.rss')
+            render.assert_called_once()
+
+        self.assertEqual(r.status_code, 200)
+        root = ET.fromstring(r.data)
+        self.assertEqual(root.findtext("channel/title"), "Example Pod + Other Pod (filtered)")
+        self.assertEqual([t.text for t in root.iterfind("channel/item/title")],
+                         ["Newer Ep", "Interesting Ep", "Older Ep"])
+        # The first feed's channel elements are kept, with their namespaces.
+        self.assertIsNotNone(root.find("channel/{http://www.itunes.com/dtds/podcast-1.0.dtd}image"))
+
+    def test_merged_upstream_unreachable(self):
+        self._lookup_feeds({123: ("http://example.com/a", []), 456: ("http://example.com/b", [])})
+        self.requests.get('http://example.com/b', exc=requests.exceptions.ConnectionError)
+
+        r = self.client.get('/v1/merge/949/123+949/456')
+
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual([t.text for t in ET.fromstring(r.data).iterfind("channel/item/title")],
+                         ["Interesting Ep"])
+
+        self.requests.get('http://example.com/a', exc=requests.exceptions.ConnectionError)
+        fetch.store.clear()
+        self.assertEqual(self.client.get('/v1/merge/949/123+949/456').status_code, 502)
+
+    def test_merged_unknown_feed(self):
+        self._lookup_feeds({123: ("http://example.com/a", [])})
+
+        r = self.client.get('/v1/merge/949/123+949/456')
+
+        self.assertEqual(r.status_code, 404)
+
+    def test_merged_too_many(self):
+        with mock.patch.object(filter_feed, 'MERGE_MAX_FEEDS', new=1):
+            r = self.client.get('/v1/merge/949/123+949/456')
+
+        self.assertEqual(r.status_code, 404)
+
+    def test_extra_urls(self):
+        self._lookup_feeds({123: ("http://example.com/a", ["http://example.com/b"])})
+        self.requests.get('http://example.com/b', text="""<rss><channel><title>Other Pod</title>
+            <item><title>Newer Ep</title><pubDate>Sun, 06 Jun 2021 00:00:00 +0000</pubDate></item>
+            </channel></rss>""")
+
+        r = self.client.get('/v1/949/123')
+
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual([t.text for t in ET.fromstring(r.data).iterfind("channel/item/title")],
+                         ["Newer Ep", "Interesting Ep"])
+
+    def test_extra_urls_served_fresh_and_stale(self):
+        self._lookup_feeds({123: ("http://example.com/a", ["http://example.com/b"])})
+        self.requests.get('http://example.com/b', text="<rss><channel><title>Other Pod</title></channel></rss>")
+
+        r1 = self.client.get('/v1/949/123')
+        self.client.get('/v1/949/123')
+        self.assertEqual(self.requests.call_count, 2)
+
+        self._age_served(fresh=False, stale=False)
+        self.requests.get('http://example.com/a', exc=requests.exceptions.ConnectionError)
+        self.requests.get('http://example.com/b', exc=requests.exceptions.ConnectionError)
+        r2 = self.client.get('/v1/949/123')
+
+        self.assertEqual(r2.status_code, 200)
+        self.assertEqual(r2.data, r1.data)
+
 class TestLoginRequired(AppTestCase):
     def test_list(self):
         r = self.client.get('/')
@@ -360,6 +675,11 @@ class TestUpdate(AppTestCase):
             "path": [{"kind": "User", "id": 949}, {"kind": "FilterFeed", "id": 123}]})
         self.stub.commit.set_val(datastore_type.CommitResponse(mutation_results=[mr]))
 
+        with cloud_ndb.context():
+            cache_key = (ndb.Key("User", 949, "FilterFeed", 123).urlsafe(), "a", "b")
+        filter_feed.render_cache.put(cache_key, "stale")
+        self.addCleanup(filter_feed.render_cache.clear)
+
         r = self.client.post('/v1/949/123/edit', data={
             "url": "http://example.com/B",
             "name": "NicknameB",
@@ -367,6 +687,7 @@ class TestUpdate(AppTestCase):
             })
         
         self.assertEqual(r.status_code, 302)
+        self.assertIsNone(filter_feed.render_cache.get(cache_key))
         # Check the call
         self.stub.commit.assert_called_once()
         commit_req = self.stub.commit.call_args[0][0]
@@ -469,4 +790,14 @@ class KeyConverterTest(unittest.TestCase):
             KeyConverter(self.map).to_python("12w/3")
         with self.assertRaises(ValidationError):
             KeyConverter(self.map).to_python("12_")
-    
\ No newline at end of file
+    
+
+    def test_key_list(self):
+        self.assertEqual(
+            KeyListConverter(self.map).to_python("123+949/456"),
+            [("FilterFeed", 123), ("User", 949, "FilterFeed", 456)])
+        self.assertEqual(
+            KeyListConverter(self.map).to_url([("FilterFeed", 123), ndb.Key("User", 949, "FilterFeed", 456)]),
+            "123+949/456")
+        with self.assertRaises(ValidationError):
+            KeyListConverter(self.map).to_python("123+")
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+import asyncio
+import gzip
+import os
+from unittest import mock
+import unittest
+from xml.etree import ElementTree as ET
+
+from google.cloud.datastore_v1 import types as datastore_type
+import httpx
+
+import app as app_module
+from app import app, cloud_ndb
+import asgi
+import compress
+import fetch
+import filter_feed
+import ndb_mocks
+import settings_cache
+
+TESTDATA = os.path.join(os.path.dirname(__file__),  'testdata/')
+
+
+def get(path, headers=()):
+    messages = []
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+    async def send(message):
+        messages.append(message)
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+             "method": "GET", "scheme": "http", "path": path, "raw_path": path.encode(),
+             "root_path": "", "query_string": b"", "headers": list(headers),
+             "server": ("localhost", 80), "client": ("127.0.0.1", 1234)}
+    asyncio.run(asgi.application(scope, receive, send))
+    start = messages[0]
+    body = b"".join(m.get("body", b"") for m in messages[1:])
+    return start["status"], dict(start["headers"]), body
+
+
+class TestFeed(unittest.TestCase):
+    def setUp(self):
+        self.stub = ndb_mocks.MockDatastoreStub()
+        self.ndb_patch = mock.patch.object(cloud_ndb.client, 'stub', new=self.stub)
+        self.ndb_patch.start()
+        self.addCleanup(self.ndb_patch.stop)
+
+        with open(os.path.join(TESTDATA,  "rss.xml"), "rb") as test_in:
+            rss = test_in.read()
+        def upstream(request):
+            self.assertEqual(str(request.url), "http://example.com/a")
+            return httpx.Response(200, headers={"Content-Type": "application/rss+xml"},
+                                  stream=httpx.ByteStream(rss))
+        self.client_patch = mock.patch.object(
+            fetch, '_async_client', new=httpx.AsyncClient(transport=httpx.MockTransport(upstream)))
+        self.client_patch.start()
+        self.addCleanup(self.client_patch.stop)
+
+        fetch.store.clear()
+        self.addCleanup(fetch.store.clear)
+        settings_cache.clear()
+        self.addCleanup(settings_cache.clear)
+        fetch.hosts.clear()
+        self.addCleanup(fetch.hosts.clear)
+        fetch._unavailable.clear()
+        self.addCleanup(fetch._unavailable.clear)
+        filter_feed.render_cache.clear()
+        self.addCleanup(filter_feed.render_cache.clear)
+        filter_feed.served_cache.clear()
+        self.addCleanup(filter_feed.served_cache.clear)
+        filter_feed.merged_cache.clear()
+        self.addCleanup(filter_feed.merged_cache.clear)
+
+    def test_success(self):
+        e = datastore_type.Entity(
+          properties = {
+            "url": datastore_type.Value(string_value="http://example.com/a"), 
+            "name": datastore_type.Value(string_value="nickname"),  
+            "query_builder": datastore_type.Value(blob_value=b'{"condition":"AND","rules":[{"id":"title","field":"title","type":"string","input":"text","operator":"contains","value":"Boring"}]}')}, 
+          key = {"partition_id":{"project_id":app.config["NDB_PROJECT"]},"path": [
+              {"kind": "User", "id": 949},{"kind": "FilterFeed", "id": 123}]})
+        self.stub.lookup.set_val(datastore_type.LookupResponse(found=[{"entity":e}]))
+
+        status, headers, body = get('/v1/949/123.rss')
+
+        self.assertEqual(status, 200)
+        self.assertEqual(headers[b"content-type"], b"application/rss+xml")
+        self.assertEqual(
+            ET.canonicalize(body),
+            ET.canonicalize(from_file=os.path.join(TESTDATA,  "rss-filtered.xml")))
+
+    def test_compressed(self):
+        e = datastore_type.Entity(
+          properties = {
+            "url": datastore_type.Value(string_value="http://example.com/a"), 
+            "name": datastore_type.Value(string_value="nickname"),  
+            "query_builder": datastore_type.Value(blob_value=b'{"condition":"AND","rules":[{"id":"title","field":"title","type":"string","input":"text","operator":"contains","value":"Boring"}]}')}, 
+          key = {"partition_id":{"project_id":app.config["NDB_PROJECT"]},"path": [
+              {"kind": "User", "id": 949},{"kind": "FilterFeed", "id": 123}]})
+        self.stub.lookup.set_val(datastore_type.LookupResponse(found=[{"entity":e}]))
+
+        with mock.patch.object(compress, 'COMPRESS_MIN_BYTES', new=0):
+            status, headers, body = get('/v1/949/123', [(b"accept-encoding", b"gzip")])
+
+        self.assertEqual(status, 200)
+        self.assertEqual(headers[b"content-encoding"], b"gzip")
+        self.assertEqual(headers[b"vary"], b"Accept-Encoding")
+        self.assertEqual(
+            ET.canonicalize(gzip.decompress(body)),
+            ET.canonicalize(from_file=os.path.join(TESTDATA,  "rss-filtered.xml")))
+
+    def test_unknown_feed(self):
+        e = datastore_type.Entity(key = {
+            "partition_id":{"project_id":app.config["NDB_PROJECT"]},
+            "path": [{"kind": "FilterFeed", "id": 321}]})
+        self.stub.lookup.set_val(datastore_type.LookupResponse(missing=[{"entity":e}]))
+
+        status, _, _ = get('/v1/321')
+
+        self.assertEqual(status, 404)
+
+    def test_merged(self):
+        e = datastore_type.Entity(
+          properties = {
+            "url": datastore_type.Value(string_value="http://example.com/a"), 
+            "name": datastore_type.Value(string_value="nickname"),  
+            "query_builder": datastore_type.Value(blob_value=b'{"condition":"AND","rules":[{"id":"title","field":"title","type":"string","input":"text","operator":"contains","value":"Boring"}]}')}, 
+          key = {"partition_id":{"project_id":app.config["NDB_PROJECT"]},"path": [
+              {"kind": "User", "id": 949},{"kind": "FilterFeed", "id": 123}]})
+        self.stub.lookup.set_val(datastore_type.LookupResponse(found=[{"entity":e}]))
+
+        with mock.patch.object(filter_feed, 'merged_feed_async', wraps=filter_feed.merged_feed_async) as merged:
+            status, headers, body = get('/v1/merge/949/123.rss')
+            merged.assert_called_once()
+
+        self.assertEqual(status, 200)
+        self.assertEqual([t.text for t in ET.fromstring(body).iterfind("channel/item/title")],
+                         ["Interesting Ep"])
+
+    def test_error_reported(self):
+        with mock.patch.object(filter_feed, 'feed_by_key_async', side_effect=RuntimeError("bug")), \
+                mock.patch.object(app_module, 'STACKDRIVER_ERROR_REPORTING', new=True), \
+                mock.patch.object(app_module.error_reporting_client, 'report_exception') as report:
+            status, _, _ = get('/v1/949/123.rss', [(b"host", b"example.org"),
+                                                   (b"user-agent", b"reader")])
+
+        self.assertEqual(status, 500)
+        report.assert_called_once()
+        context = report.call_args.kwargs["http_context"]
+        self.assertEqual(context.url, "http://example.org/v1/949/123.rss")
+        self.assertEqual(context.method, "GET")
+        self.assertEqual(context.userAgent, "reader")
+        self.assertEqual(context.remoteIp, "127.0.0.1")
+
+    def test_other_routes_use_flask(self):
+        status, _, _ = get('/v1/123/edit')
+        self.assertNotEqual(status, 200)
+        self.stub.lookup.assert_not_called()
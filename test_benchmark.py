@@ -0,0 +1,45 @@
+import unittest
+import xml.etree.ElementTree as ET
+
+import benchmark
+import model
+
+
+class SyntheticFeedTest(unittest.TestCase):
+    def test_rss(self):
+      root = ET.fromstring(benchmark.synthetic_feed(20, description_bytes=100, namespaces=3))
+      items = root.findall("channel/item")
+      self.assertEqual(len(items), 20)
+      self.assertGreaterEqual(len(items[0].findtext("description")), 100)
+      self.assertEqual(len(items[0].findall("{http://example.com/ns/2}extra")), 1)
+
+    def test_atom(self):
+      root = ET.fromstring(benchmark.synthetic_feed(20, atom=True))
+      self.assertEqual(len(root.findall("{http://www.w3.org/2005/Atom}entry")), 20)
+
+    def test_filter(self):
+      settings = benchmark.synthetic_filter(5)
+      self.assertEqual(len(settings.query_builder["rules"]), 5)
+      self.assertTrue(model.validate_jqqb(settings.query_builder))
+
+
+class RunTest(unittest.TestCase):
+    def test_run_case(self):
+      case = benchmark.run_case(10, 64, 1, 2, atom=False, repeat=1)
+      self.assertEqual(case["name"], "rss-10-d64-ns1-r2")
+      self.assertEqual(set(case["stages"]),
+                       {"parse", "filter", "filter_warm", "serialize", "render"})
+      for stage in case["stages"].values():
+        self.assertGreater(stage["seconds"], 0)
+        self.assertGreater(stage["peak_bytes"], 0)
+
+    def test_compare(self):
+      def results(seconds):
+        return {"cases": [{"name": "a", "stages": {"parse": {"seconds": seconds}}}]}
+      self.assertEqual(benchmark.compare(results(1.1), results(1.0), 1.25), [])
+      self.assertEqual(len(benchmark.compare(results(2.0), results(1.0), 1.25)), 1)
+      self.assertEqual(benchmark.compare(results(2.0), {"cases": []}, 1.25), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
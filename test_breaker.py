@@ -0,0 +1,52 @@
+import unittest
+
+import breaker
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breaker = breaker.CircuitBreaker(max_failures=2, cooldown=10, clock=self.clock)
+
+    def test_opens_after_consecutive_failures(self):
+        self.breaker.failure("a")
+        self.assertTrue(self.breaker.allow("a"))
+        self.breaker.failure("a")
+        self.assertFalse(self.breaker.allow("a"))
+        self.assertTrue(self.breaker.allow("b"))
+
+    def test_success_resets(self):
+        self.breaker.failure("a")
+        self.breaker.success("a")
+        self.breaker.failure("a")
+        self.assertTrue(self.breaker.allow("a"))
+
+    def test_half_open_single_probe(self):
+        self.breaker.failure("a")
+        self.breaker.failure("a")
+        self.clock.now = 10
+        self.assertTrue(self.breaker.allow("a"))
+        self.assertFalse(self.breaker.allow("a"))
+        self.breaker.success("a")
+        self.assertTrue(self.breaker.allow("a"))
+        self.assertFalse(self.breaker.is_open("a"))
+
+    def test_failed_probe_reopens(self):
+        self.breaker.failure("a")
+        self.breaker.failure("a")
+        self.clock.now = 10
+        self.assertTrue(self.breaker.allow("a"))
+        self.breaker.failure("a")
+        self.assertFalse(self.breaker.allow("a"))
+        self.clock.now = 19
+        self.assertFalse(self.breaker.allow("a"))
+        self.clock.now = 20
+        self.assertTrue(self.breaker.allow("a"))
@@ -0,0 +1,142 @@
+import asyncio
+import threading
+import time
+import unittest
+
+import cache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestLRUCache(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = cache.LRUCache(max_entries=2, ttl=10, clock=self.clock)
+
+    def test_get_put(self):
+        self.assertIsNone(self.cache.get("a"))
+        self.cache.put("a", 1)
+        self.assertEqual(self.cache.get("a"), 1)
+
+    def test_evicts_least_recently_used(self):
+        self.cache.put("a", 1)
+        self.cache.put("b", 2)
+        self.cache.get("a")
+        self.cache.put("c", 3)
+        self.assertEqual(self.cache.get("a"), 1)
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(self.cache.get("c"), 3)
+
+    def test_ttl(self):
+        self.cache.put("a", 1)
+        self.cache.put("b", 2, ttl=20)
+        self.clock.now = 10
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(self.cache.get("b"), 2)
+        self.assertEqual(len(self.cache), 1)
+
+    def test_discard_where(self):
+        self.cache.put(("x", 1), 1)
+        self.cache.put(("y", 1), 2)
+        self.cache.discard_where(lambda k: k[0] == "x")
+        self.assertIsNone(self.cache.get(("x", 1)))
+        self.assertEqual(self.cache.get(("y", 1)), 2)
+
+    def test_max_bytes(self):
+        sized = cache.LRUCache(max_entries=10, ttl=10, clock=self.clock, max_bytes=10, sizeof=len)
+        sized.put("a", b"aaaa")
+        sized.put("b", b"bbbb")
+        sized.put("a", b"aa")
+        self.assertEqual(sized.size, 6)
+        sized.put("c", b"cccccc")
+        self.assertIsNone(sized.get("b"))
+        self.assertEqual(sized.get("a"), b"aa")
+        self.assertEqual(sized.size, 8)
+        sized.put("a", b"x" * 11)
+        self.assertIsNone(sized.get("a"))
+        self.assertEqual(sized.size, 6)
+        sized.discard("c")
+        self.assertEqual(sized.size, 0)
+
+
+class TestSingleFlight(unittest.TestCase):
+    def test_coalesces_concurrent_calls(self):
+        flight = cache.SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def slow():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return "result"
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(flight.do("k", slow)))
+        leader.start()
+        started.wait()
+        followers = [threading.Thread(target=lambda: results.append(flight.do("k", slow)))
+                     for _ in range(3)]
+        for t in followers:
+            t.start()
+        # Give the followers time to start waiting.
+        time.sleep(0.05)
+        release.set()
+        for t in [leader] + followers:
+            t.join()
+        self.assertEqual(results, ["result"] * 4)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flight.do("k", lambda: "again"), "again")
+
+    def test_shares_exception(self):
+        flight = cache.SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+
+        def fail():
+            started.set()
+            release.wait()
+            raise ValueError("upstream")
+
+        errors = []
+        def call():
+            try:
+                flight.do("k", fail)
+            except ValueError as e:
+                errors.append(e)
+
+        leader = threading.Thread(target=call)
+        leader.start()
+        started.wait()
+        follower = threading.Thread(target=call)
+        follower.start()
+        release.set()
+        leader.join()
+        follower.join()
+        self.assertEqual(len(errors), 2)
+
+
+class TestAsyncSingleFlight(unittest.TestCase):
+    def test_coalesces_concurrent_calls(self):
+        flight = cache.AsyncSingleFlight()
+        calls = []
+
+        async def slow():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "result"
+
+        async def run():
+            return await asyncio.gather(*[flight.do("k", slow) for _ in range(5)])
+
+        self.assertEqual(asyncio.run(run()), ["result"] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(asyncio.run(flight.do("k", slow)), "result")
+        self.assertEqual(len(calls), 2)
@@ -0,0 +1,38 @@
+import gzip
+import unittest
+
+import brotli
+
+import compress
+
+
+class TestNegotiate(unittest.TestCase):
+    def test_negotiate(self):
+        for accept, encoding in (
+                (None, None),
+                ("", None),
+                ("identity", None),
+                ("gzip", "gzip"),
+                ("gzip, deflate, br", "br"),
+                ("br;q=0.5, gzip", "gzip"),
+                ("br;q=0, gzip;q=0", None),
+                ("GZIP", "gzip"),
+                ("*", "br"),
+                ("*;q=0.1, gzip;q=0.5", "gzip"),
+                ("br;q=bad, gzip", "gzip")):
+            with self.subTest(accept=accept):
+                self.assertEqual(compress.negotiate(accept), encoding)
+
+
+class TestCompress(unittest.TestCase):
+    def test_round_trip(self):
+        body = b"<rss>" + b"<item>x</item>" * 100 + b"</rss>"
+        self.assertEqual(gzip.decompress(compress.compress(body, "gzip")), body)
+        self.assertEqual(brotli.decompress(compress.compress(body, "br")), body)
+
+    def test_deterministic(self):
+        self.assertEqual(compress.compress(b"abc", "gzip"), compress.compress(b"abc", "gzip"))
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            compress.compress(b"abc", "zstd")
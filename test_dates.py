@@ -0,0 +1,63 @@
+from datetime import datetime, timezone, timedelta
+from email.utils import parsedate_to_datetime
+import unittest
+
+import dates
+
+PDT = timezone(timedelta(hours=-7))
+
+
+class ParseTest(unittest.TestCase):
+    def setUp(self):
+      dates.parse.cache_clear()
+
+    def test_rfc822(self):
+      for text in ("Sat, 05 Jun 2021 16:57:00 -0700",
+                   "Sat 05 Jun 2021 16:57:00 -0700",
+                   "5 Jun 2021 16:57 -0700",
+                   "  Sat, 05 jun 2021 16:57:00 -0700\n"):
+        with self.subTest(text=text):
+          self.assertEqual(dates.parse(text), datetime(2021, 6, 5, 16, 57, tzinfo=PDT))
+
+    def test_rfc822_utc(self):
+      for text in ("Sat, 05 Jun 2021 23:57:00 GMT", "Sat, 05 Jun 2021 23:57:00 +0000",
+                   "Sat, 05 Jun 2021 23:57:00 UT"):
+        with self.subTest(text=text):
+          self.assertEqual(dates.parse(text),
+                           datetime(2021, 6, 5, 23, 57, tzinfo=timezone.utc))
+
+    def test_rfc822_like_email_utils(self):
+      for text in ("Sat, 05 Jun 2021 16:57:00 -0000",
+                   "Sat, 05 Jun 2021 16:57:00",
+                   "Sat, 05 Jun 2021 16:57:00 PDT",
+                   "Sat, 05 Jun 21 16:57:00 -0700"):
+        with self.subTest(text=text):
+          self.assertEqual(dates.parse(text), parsedate_to_datetime(text))
+
+    def test_rfc3339(self):
+      for text in ("2021-06-05T16:57:00-07:00", "2021-06-05T23:57:00Z",
+                   "2021-06-05t23:57:00z", "2021-06-05 16:57-07:00"):
+        with self.subTest(text=text):
+          self.assertEqual(dates.parse(text), datetime(2021, 6, 5, 16, 57, tzinfo=PDT))
+
+    def test_rfc3339_fraction(self):
+      self.assertEqual(dates.parse("2021-06-05T23:57:00.1234567Z"),
+                       datetime(2021, 6, 5, 23, 57, 0, 123456, tzinfo=timezone.utc))
+
+    def test_iso_fallback(self):
+      self.assertEqual(dates.parse("2021-06-05"), datetime(2021, 6, 5))
+
+    def test_invalid(self):
+      for text in (None, "", "not a date", "Sat, 31 Feb 2021 16:57:00 -0700",
+                   "2021-13-05T16:57:00Z"):
+        with self.subTest(text=text):
+          self.assertIsNone(dates.parse(text))
+
+    def test_memoized(self):
+      dates.parse("Sat, 05 Jun 2021 16:57:00 -0700")
+      dates.parse("Sat, 05 Jun 2021 16:57:00 -0700")
+      self.assertEqual(dates.parse.cache_info().hits, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
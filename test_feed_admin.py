@@ -98,6 +98,40 @@ class TestUpsertFeed(unittest.TestCase):
         self.assertEqual(commit_req.mutations[0].upsert.properties["name"].string_value, NAME)
         self.assertEqual(commit_req.mutations[0].upsert.properties["query_builder"].blob_value, bytes(QB, encoding='utf-8'))
 
+    def testUpdateFeedMaxBytes(self):
+        e = datastore_type.Entity(
+          properties = {
+            "url": datastore_type.Value(string_value=URL), 
+            "name": datastore_type.Value(string_value=NAME),
+            "query_builder": datastore_type.Value(blob_value=bytes(QB, encoding='utf-8'))}, 
+          key = {"partition_id":{"project_id":"blah"},"path": [{"kind": "FilterFeed", "id": 123}]})
+        lookup_res = datastore_type.LookupResponse(found=[{"entity":e}])
+        self.client.stub.lookup.set_val(lookup_res)
+        mr = datastore_type.MutationResult(key = {"partition_id":{"project_id":"blah"},"path": [{"kind": "FilterFeed", "id": 123}]})
+        commit_res = datastore_type.CommitResponse(mutation_results=[mr])
+        self.client.stub.commit.set_val(commit_res)
+        feed_admin.upsert_feed(123, None, None, None, 64 * 1024 * 1024)
+        commit_req = self.client.stub.commit.call_args[0][0]
+        self.assertEqual(commit_req.mutations[0].upsert.properties["max_bytes"].integer_value, 64 * 1024 * 1024)
+        self.assertEqual(commit_req.mutations[0].upsert.properties["url"].string_value, URL)
+
+    def testUpdateFeedExtraUrls(self):
+        e = datastore_type.Entity(
+          properties = {
+            "url": datastore_type.Value(string_value=URL), 
+            "name": datastore_type.Value(string_value=NAME),
+            "query_builder": datastore_type.Value(blob_value=bytes(QB, encoding='utf-8'))}, 
+          key = {"partition_id":{"project_id":"blah"},"path": [{"kind": "FilterFeed", "id": 123}]})
+        lookup_res = datastore_type.LookupResponse(found=[{"entity":e}])
+        self.client.stub.lookup.set_val(lookup_res)
+        mr = datastore_type.MutationResult(key = {"partition_id":{"project_id":"blah"},"path": [{"kind": "FilterFeed", "id": 123}]})
+        commit_res = datastore_type.CommitResponse(mutation_results=[mr])
+        self.client.stub.commit.set_val(commit_res)
+        feed_admin.upsert_feed(123, None, None, None, extra_urls=["http://www.example.com/c"])
+        commit_req = self.client.stub.commit.call_args[0][0]
+        extra_urls = commit_req.mutations[0].upsert.properties["extra_urls"].array_value.values
+        self.assertEqual([v.string_value for v in extra_urls], ["http://www.example.com/c"])
+
 
 
 if __name__ == "__main__":
@@ -0,0 +1,417 @@
+import asyncio
+import gzip
+import http.server
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+import unittest
+import zlib
+from unittest import mock
+
+import brotli
+import httpx
+import requests
+import requests_mock
+
+import fetch
+
+URL = "http://example.com/a"
+# 64 MiB of zeros, gzipped to about 64 KiB.
+BOMB = gzip.compress(b"\0" * (64 * 1024 * 1024))
+
+
+class DripHandler(http.server.BaseHTTPRequestHandler):
+    """Sends a feed a byte at a time, each well within the read timeout."""
+
+    def do_GET(self):
+        body = b"<rss/>" * 100
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            for i in range(len(body)):
+                self.wfile.write(body[i:i + 1])
+                self.wfile.flush()
+                time.sleep(0.05)
+        except OSError:
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+def drip_server(test: unittest.TestCase, protocol_version: str = "HTTP/1.0") -> str:
+    """Starts a DripHandler server for the test, returning its URL."""
+    handler = type("DripHandler", (DripHandler,), {"protocol_version": protocol_version})
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    test.addCleanup(server.server_close)
+    test.addCleanup(server.shutdown)
+    return "http://127.0.0.1:%d/" % server.server_address[1]
+
+
+def peak_memory(f) -> int:
+    """Returns the most memory allocated at once while f ran."""
+    tracemalloc.start()
+    try:
+        f()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+class TestUpstreamStore(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        store = fetch.UpstreamStore(max_bytes=10)
+        store.put(fetch.Upstream("a", b"1234", None, etag='"a"'))
+        store.put(fetch.Upstream("b", b"1234", None, etag='"b"'))
+        store.get("a")
+        store.put(fetch.Upstream("c", b"1234", None, etag='"c"'))
+        self.assertIsNotNone(store.get("a"))
+        self.assertIsNone(store.get("b"))
+        self.assertIsNotNone(store.get("c"))
+
+    def test_too_large(self):
+        store = fetch.UpstreamStore(max_bytes=3)
+        store.put(fetch.Upstream("a", b"1234", None, etag='"a"'))
+        self.assertIsNone(store.get("a"))
+
+
+class TestNormalizeUrl(unittest.TestCase):
+    def test_normalize(self):
+        for url, normalized in (
+                ("http://example.com/a", "http://example.com/a"),
+                ("HTTP://Example.COM:80/a#frag", "http://example.com/a"),
+                ("https://example.com:443", "https://example.com/"),
+                ("https://example.com:8443/a?b=C", "https://example.com:8443/a?b=C"),
+                ("http://u:p@example.com/", "http://u:p@example.com/"),
+                ("http://[::1]:80/", "http://[::1]/"),
+                ("http://example.com:bad/", "http://example.com:bad/")):
+            with self.subTest(url=url):
+                self.assertEqual(fetch.normalize_url(url), normalized)
+
+
+class TestFetch(unittest.TestCase):
+    def setUp(self):
+        fetch.store.clear()
+        self.addCleanup(fetch.store.clear)
+        fetch.hosts.clear()
+        self.addCleanup(fetch.hosts.clear)
+        fetch._unavailable.clear()
+        self.addCleanup(fetch._unavailable.clear)
+        self.requests = requests_mock.Mocker()
+        self.requests.start()
+        self.addCleanup(self.requests.stop)
+
+    def test_unconditional(self):
+        self.requests.get(URL, content=b"<rss/>",
+                          headers={"Content-Type": "application/rss+xml"})
+        upstream = fetch.fetch(URL)
+        self.assertEqual(upstream.content, b"<rss/>")
+        self.assertEqual(upstream.content_type, "application/rss+xml")
+        self.assertNotIn("If-None-Match", self.requests.last_request.headers)
+        self.assertNotIn("If-Modified-Since", self.requests.last_request.headers)
+        self.assertIsNone(fetch.store.get(URL))
+
+    def test_revalidate_not_modified(self):
+        self.requests.get(URL, content=b"<rss/>", headers={
+            "ETag": '"v1"', "Last-Modified": "Wed, 21 Oct 2015 07:28:00 GMT"})
+        fetch.fetch(URL)
+        self.requests.get(URL, status_code=304)
+        upstream = fetch.fetch(URL)
+        self.assertEqual(upstream.content, b"<rss/>")
+        self.assertEqual(self.requests.last_request.headers["If-None-Match"], '"v1"')
+        self.assertEqual(self.requests.last_request.headers["If-Modified-Since"],
+                         "Wed, 21 Oct 2015 07:28:00 GMT")
+
+    def test_revalidate_modified(self):
+        self.requests.get(URL, content=b"<rss/>", headers={"ETag": '"v1"'})
+        fetch.fetch(URL)
+        self.requests.get(URL, content=b"<rss><channel/></rss>", headers={"ETag": '"v2"'})
+        upstream = fetch.fetch(URL)
+        self.assertEqual(upstream.content, b"<rss><channel/></rss>")
+        self.assertEqual(fetch.store.get(URL).etag, '"v2"')
+
+    def test_error_forgets_stored(self):
+        self.requests.get(URL, content=b"<rss/>", headers={"ETag": '"v1"'})
+        fetch.fetch(URL)
+        self.requests.get(URL, status_code=500)
+        with self.assertRaises(fetch.UpstreamUnavailable):
+            fetch.fetch(URL)
+        self.assertIsNone(fetch.store.get(URL))
+
+    def test_server_error_remembered(self):
+        self.requests.get(URL, status_code=503, text="<html><body>down</body></html>")
+        with self.assertRaises(fetch.UpstreamUnavailable):
+            fetch.fetch(URL)
+        with self.assertRaises(fetch.UpstreamUnavailable):
+            fetch.fetch(URL)
+        self.assertEqual(self.requests.call_count, 1)
+
+    def test_error_status(self):
+        self.requests.get(URL, status_code=404, text="<html><body>gone</body></html>")
+        with self.assertRaises(fetch.UpstreamHTTPError):
+            fetch.fetch(URL)
+
+    def test_too_large_by_length(self):
+        self.requests.get(URL, content=b"<rss/>" * 4, headers={"Content-Length": "24"})
+        with self.assertRaises(fetch.UpstreamTooLarge):
+            fetch.fetch(URL, max_bytes=10)
+
+    def test_too_large_by_body(self):
+        def body(request, context):
+            context.headers.pop("Content-Length", None)
+            return b"<rss/>" * 4
+        self.requests.get(URL, content=body)
+        with self.assertRaises(fetch.UpstreamTooLarge):
+            fetch.fetch(URL, max_bytes=10)
+        self.assertEqual(fetch.fetch(URL, max_bytes=24).content, b"<rss/>" * 4)
+
+    def test_stored_too_large(self):
+        self.requests.get(URL, content=b"<rss/>" * 4, headers={"ETag": '"v1"'})
+        fetch.fetch(URL)
+        self.requests.get(URL, status_code=304)
+        with self.assertRaises(fetch.UpstreamTooLarge):
+            fetch.fetch(URL, max_bytes=10)
+
+    def test_deadline(self):
+        self.requests.stop()
+        # With HTTP/1.1 the connection keeps the socket, otherwise the response.
+        for protocol_version in ("HTTP/1.0", "HTTP/1.1"):
+            with self.subTest(protocol_version=protocol_version):
+                url = drip_server(self, protocol_version)
+                start = time.monotonic()
+                with mock.patch.object(fetch, 'UPSTREAM_DEADLINE', new=0.3):
+                    with self.assertRaises(fetch.UpstreamDeadlineExceeded):
+                        fetch.fetch(url)
+                # The whole body would take 30s.
+                self.assertLess(time.monotonic() - start, 2)
+
+    def test_decodes_compressed(self):
+        self.requests.get(URL, content=gzip.compress(b"<rss/>"),
+                          headers={"Content-Encoding": "gzip"})
+        self.assertEqual(fetch.fetch(URL).content, b"<rss/>")
+        self.assertNotIn("br", self.requests.last_request.headers["Accept-Encoding"])
+
+    def test_decodes_deflate(self):
+        for content in (zlib.compress(b"<rss/>"), zlib.compress(b"<rss/>")[2:-4]):
+            with self.subTest(content=content):
+                self.requests.get(URL, content=content, headers={"Content-Encoding": "deflate"})
+                self.assertEqual(fetch.fetch(URL).content, b"<rss/>")
+
+    def test_decodes_gzip_members(self):
+        self.requests.get(URL, content=gzip.compress(b"<rss>") + gzip.compress(b"</rss>"),
+                          headers={"Content-Encoding": "gzip"})
+        self.assertEqual(fetch.fetch(URL).content, b"<rss></rss>")
+
+    def test_unsupported_encoding(self):
+        self.requests.get(URL, content=brotli.compress(b"<rss/>"),
+                          headers={"Content-Encoding": "br"})
+        with self.assertRaises(fetch.UpstreamUnavailable):
+            fetch.fetch(URL)
+
+    def test_compression_bomb(self):
+        self.requests.get(URL, content=BOMB, headers={"Content-Encoding": "gzip"})
+        def run():
+            with self.assertRaises(fetch.UpstreamTooLarge):
+                fetch.fetch(URL, max_bytes=1024 * 1024)
+        self.assertLess(peak_memory(run), 4 * 1024 * 1024)
+
+    def test_unreachable(self):
+        self.requests.get(URL, exc=requests.exceptions.ConnectTimeout)
+        with self.assertRaises(fetch.UpstreamUnavailable):
+            fetch.fetch(URL)
+        # Remembered for a while, without trying again.
+        with self.assertRaises(fetch.UpstreamUnavailable):
+            fetch.fetch(URL)
+        self.assertEqual(self.requests.call_count, 1)
+
+    def test_circuit_opens_for_host(self):
+        self.requests.get(requests_mock.ANY, status_code=503)
+        # Different URLs, since each failed URL is remembered by itself.
+        for i in range(fetch.UPSTREAM_BREAKER_FAILURES):
+            with self.assertRaises(fetch.UpstreamUnavailable):
+                fetch.fetch("%s/%d" % (URL, i))
+        self.requests.get("http://example.com/b", content=b"<rss/>")
+        with self.assertRaises(fetch.UpstreamUnavailable):
+            fetch.fetch("http://example.com/b")
+        self.assertEqual(self.requests.call_count, fetch.UPSTREAM_BREAKER_FAILURES)
+        self.requests.get("http://example.org/b", content=b"<rss/>")
+        self.assertEqual(fetch.fetch("http://example.org/b").content, b"<rss/>")
+
+    def test_shared_between_spellings(self):
+        self.requests.get(URL, content=b"<rss/>", headers={"ETag": '"v1"'})
+        fetch.fetch(URL)
+        self.requests.get(URL, status_code=304)
+        upstream = fetch.fetch("HTTP://EXAMPLE.com:80/a#x")
+        self.assertEqual(upstream.content, b"<rss/>")
+        self.assertEqual(self.requests.last_request.headers["If-None-Match"], '"v1"')
+
+    def test_coalesces_concurrent_fetches(self):
+        release = threading.Event()
+        def slow(request, context):
+            release.wait()
+            return b"<rss/>"
+        self.requests.get(URL, content=slow)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(fetch.fetch(URL)))
+                   for _ in range(4)]
+        for t in threads:
+            t.start()
+        time.sleep(0.05)
+        release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.requests.call_count, 1)
+        self.assertEqual([u.content for u in results], [b"<rss/>"] * 4)
+
+
+class TestFetchAcrossProcesses(unittest.TestCase):
+    def setUp(self):
+        fetch.store.clear()
+        self.addCleanup(fetch.store.clear)
+        fetch.hosts.clear()
+        self.addCleanup(fetch.hosts.clear)
+        fetch._unavailable.clear()
+        self.addCleanup(fetch._unavailable.clear)
+        self.requests = requests_mock.Mocker()
+        self.requests.start()
+        self.addCleanup(self.requests.stop)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        patch = mock.patch.object(fetch, 'UPSTREAM_COALESCE_DIR', new=tmp.name)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_reuses_response_fetched_while_waiting(self):
+        self.requests.get(URL, content=b"<rss/>", headers={"ETag": '"v1"'})
+        upstream = fetch.fetch(URL)
+        self.assertEqual(self.requests.call_count, 1)
+        # As if another process fetched it while this one waited for the lock.
+        with mock.patch.object(time, 'time', return_value=0):
+            shared = fetch.fetch(URL)
+        self.assertEqual(self.requests.call_count, 1)
+        self.assertEqual(shared, upstream)
+
+    def test_refetches_older_response(self):
+        self.requests.get(URL, content=b"<rss/>")
+        fetch.fetch(URL)
+        path = fetch._shared_path(URL)
+        os.utime(path, (0, 0))
+        fetch.fetch(URL)
+        self.assertEqual(self.requests.call_count, 2)
+
+
+class TestFetchAsync(unittest.TestCase):
+    def setUp(self):
+        fetch.store.clear()
+        self.addCleanup(fetch.store.clear)
+        fetch.hosts.clear()
+        self.addCleanup(fetch.hosts.clear)
+        fetch._unavailable.clear()
+        self.addCleanup(fetch._unavailable.clear)
+
+    @staticmethod
+    def response(status_code, content=b"", headers=None):
+        # As over the network, the body has not been read yet.
+        return httpx.Response(status_code, headers=headers, stream=httpx.ByteStream(content))
+
+    def fetch(self, handler):
+        async def run():
+            async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+                return await fetch.fetch_async(URL, client=client)
+        return asyncio.run(run())
+
+    def test_revalidate_not_modified(self):
+        upstream = self.fetch(lambda request: self.response(
+            200, b"<rss/>", headers={"ETag": '"v1"'}))
+        self.assertEqual(upstream.content, b"<rss/>")
+        def not_modified(request):
+            self.assertEqual(request.headers["If-None-Match"], '"v1"')
+            return self.response(304)
+        upstream = self.fetch(not_modified)
+        self.assertEqual(upstream.content, b"<rss/>")
+
+    def test_too_large(self):
+        async def run():
+            async def body():
+                for _ in range(4):
+                    yield b"<rss/>"
+            transport = httpx.MockTransport(lambda request: httpx.Response(200, content=body()))
+            async with httpx.AsyncClient(transport=transport) as client:
+                return await fetch.fetch_async(URL, max_bytes=10, client=client)
+        with self.assertRaises(fetch.UpstreamTooLarge):
+            asyncio.run(run())
+
+    def test_deadline(self):
+        url = drip_server(self)
+        async def run():
+            async with httpx.AsyncClient() as client:
+                return await fetch.fetch_async(url, client=client)
+        start = time.monotonic()
+        with mock.patch.object(fetch, 'UPSTREAM_DEADLINE', new=0.3):
+            with self.assertRaises(fetch.UpstreamDeadlineExceeded):
+                asyncio.run(run())
+        self.assertLess(time.monotonic() - start, 2)
+
+    def test_too_large_by_length(self):
+        def handler(request):
+            return httpx.Response(200, content=b"<rss/>" * 4, headers={"Content-Length": "24"})
+        async def run():
+            async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+                return await fetch.fetch_async(URL, max_bytes=10, client=client)
+        with self.assertRaises(fetch.UpstreamTooLarge):
+            asyncio.run(run())
+        # The host responded, so it is not counted as failing.
+        self.assertNotIn("example.com", fetch.hosts._circuits)
+
+    def test_undecodable(self):
+        with self.assertRaises(fetch.UpstreamUnavailable):
+            self.fetch(lambda request: self.response(
+                200, b"not gzip", headers={"Content-Encoding": "gzip"}))
+
+    def test_decodes_compressed(self):
+        def compressed(request):
+            self.assertEqual(request.headers["Accept-Encoding"], fetch.ACCEPT_ENCODING)
+            return self.response(200, gzip.compress(b"<rss/>"),
+                                 headers={"Content-Encoding": "gzip"})
+        async def run():
+            async with httpx.AsyncClient(transport=httpx.MockTransport(compressed),
+                                         headers={"Accept-Encoding": fetch.ACCEPT_ENCODING}) as client:
+                return await fetch.fetch_async(URL, client=client)
+        self.assertEqual(asyncio.run(run()).content, b"<rss/>")
+
+    def test_compression_bomb(self):
+        async def run():
+            # All of it arrives in one read.
+            transport = httpx.MockTransport(lambda request: self.response(
+                200, BOMB, headers={"Content-Encoding": "gzip"}))
+            async with httpx.AsyncClient(transport=transport) as client:
+                with self.assertRaises(fetch.UpstreamTooLarge):
+                    await fetch.fetch_async(URL, max_bytes=1024 * 1024, client=client)
+        self.assertLess(peak_memory(lambda: asyncio.run(run())), 4 * 1024 * 1024)
+
+    def test_error_forgets_stored(self):
+        self.fetch(lambda request: self.response(200, b"<rss/>", headers={"ETag": '"v1"'}))
+        with self.assertRaises(fetch.UpstreamUnavailable):
+            self.fetch(lambda request: self.response(500))
+        self.assertIsNone(fetch.store.get(URL))
+
+
+class TestSession(unittest.TestCase):
+    def test_pool_sizes(self):
+        session = fetch.new_session(pool_hosts=3, pool_maxsize=2)
+        adapter = session.get_adapter("https://example.com/")
+        self.assertEqual(adapter._pool_connections, 3)
+        self.assertEqual(adapter._pool_maxsize, 2)
+        self.assertIs(session.get_adapter("http://example.com/"), adapter)
+
+    def test_timeouts(self):
+        with requests_mock.Mocker() as m:
+            m.get(URL, content=b"<rss/>")
+            fetch.fetch(URL)
+            self.assertEqual(m.last_request.timeout,
+                             (fetch.UPSTREAM_CONNECT_TIMEOUT, fetch.UPSTREAM_READ_TIMEOUT))
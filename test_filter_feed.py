@@ -1,9 +1,14 @@
 
+import copy
 import os
 import unittest
+from unittest import mock
 import xml.etree.ElementTree as ET
 
+import fetch
+import filter_feed
 from filter_feed import detectRss, detectAtom, modifyRss, modifyAtom
+from item import Item
 from model import FilterFeed
 
 TESTDATA = os.path.join(os.path.dirname(__file__),  'testdata/')
@@ -103,6 +108,43 @@ class ModifyRssTest(unittest.TestCase):
       self.assertIsNotNone(xml.find(".//channel/title"), "Accidentally removed title")
 
 
+    def test_unreferenced_fields_not_parsed(self):
+      xml = ET.fromstring(
+              "<rss><channel><title>asdf</title><item><title>foo</title><pubDate>not a date</pubDate></item></channel></rss>"
+              )
+      ff = FilterFeed(query_builder={
+          "condition": "AND",
+          "rules": [{
+              "id": "title",
+              "field": "title",
+              "type": "string",
+              "input": "text",
+              "operator": "equal",
+              "value": "foo"
+              }]})
+      modifyRss(xml, ff)
+      self.assertIsNone(xml.find(".//item/title"))
+
+    def test_remove_consecutive(self):
+      for engine in ("row", "column"):
+        with self.subTest(engine=engine), mock.patch.object(filter_feed, "RULE_ENGINE", engine):
+          xml = ET.fromstring(
+                  "<rss><channel><title>asdf</title><item><title>foo</title></item>"
+                  "<item><title>foo</title></item><item><title>bar</title></item></channel></rss>"
+                  )
+          ff = FilterFeed(query_builder={
+              "condition": "AND",
+              "rules": [{
+                  "id": "title",
+                  "field": "title",
+                  "type": "string",
+                  "input": "text",
+                  "operator": "equal",
+                  "value": "foo"
+                  }]})
+          modifyRss(xml, ff)
+          self.assertEqual([t.text for t in xml.iterfind(".//item/title")], ["bar"])
+
     def test_golden(self):
       xml_in = ET.parse(os.path.join(TESTDATA, "rss.xml"))
       xml_check = ET.parse(os.path.join(TESTDATA, "rss-filtered.xml"))
@@ -164,3 +206,139 @@ class ModifyAtomTest(unittest.TestCase):
       self.assertIsNotNone(xml.find(".//{http://www.w3.org/2005/Atom}entry/{http://www.w3.org/2005/Atom}title"))
       self.assertIsNotNone(xml.find("./{http://www.w3.org/2005/Atom}title"), "Accidentally removed title")
 
+
+class ParsedTest(unittest.TestCase):
+    def setUp(self):
+      filter_feed.parsed_cache.clear()
+      self.addCleanup(filter_feed.parsed_cache.clear)
+
+    @staticmethod
+    def titleFilter(value):
+      return FilterFeed(query_builder={
+          "condition": "AND",
+          "rules": [{
+              "id": "title",
+              "field": "title",
+              "type": "string",
+              "input": "text",
+              "operator": "equal",
+              "value": value
+              }]})
+
+    def test_filtered_leaves_shared_tree(self):
+      parsed = filter_feed.Parsed(
+              b"<rss><channel><title>t</title><item><title>a</title></item><item><title>b</title></item></channel></rss>",
+              None)
+      before = ET.tostring(parsed.root)
+      a = parsed.filtered(self.titleFilter("a"))
+      b = parsed.filtered(self.titleFilter("b"))
+      self.assertEqual(ET.tostring(parsed.root), before)
+      self.assertEqual(ET.tostring(a),
+              b"<rss><channel><title>t (filtered)</title><item><title>b</title></item></channel></rss>")
+      self.assertEqual(ET.tostring(b),
+              b"<rss><channel><title>t (filtered)</title><item><title>a</title></item></channel></rss>")
+
+    def test_parse_shared_between_feeds(self):
+      with open(os.path.join(TESTDATA, "rss.xml"), "rb") as f:
+        content = f.read()
+      one = fetch.Upstream("http://example.com/a", content, "application/rss+xml")
+      other = fetch.Upstream("http://example.com/a", content, "application/rss+xml")
+      with mock.patch.object(filter_feed, 'Parsed', wraps=filter_feed.Parsed) as parsed:
+        filter_feed.render_tree(one, self.titleFilter("a"))
+        filter_feed.render_tree(other, self.titleFilter("b"))
+        parsed.assert_called_once()
+
+    def test_parsed_cache_bounded_by_bytes(self):
+      one = fetch.Upstream("http://example.com/a", b"<rss><channel><title>a</title></channel></rss>", None)
+      other = fetch.Upstream("http://example.com/b", b"<rss><channel><title>b</title></channel></rss>", None)
+      with mock.patch.object(filter_feed.parsed_cache, 'max_bytes', new=len(one.content) + 10):
+        filter_feed.parse(one)
+        filter_feed.parse(other)
+        self.assertEqual(len(filter_feed.parsed_cache), 1)
+        self.assertEqual(filter_feed.parsed_cache.size, len(other.content))
+
+
+class MergeTest(unittest.TestCase):
+    def setUp(self):
+      filter_feed.parsed_cache.clear()
+      self.addCleanup(filter_feed.parsed_cache.clear)
+
+    @staticmethod
+    def source(url, content, content_type=None):
+      return (None, ParsedTest.titleFilter("drop"), fetch.Upstream(url, content, content_type))
+
+    def test_merged_by_date(self):
+      rendered = filter_feed.render_merged([
+          self.source("http://example.com/a",
+              b"<rss><channel><title>A</title>"
+              b"<item><title>a1</title><pubDate>Mon, 01 Jan 2024 00:00:00 +0000</pubDate></item>"
+              b"<item><title>drop</title><pubDate>Wed, 03 Jan 2024 00:00:00 +0000</pubDate></item>"
+              b"<link>http://a/</link></channel></rss>", "application/rss+xml"),
+          self.source("http://example.com/b",
+              b"<rss><channel><title>B</title>"
+              b"<item><title>undated</title></item>"
+              b"<item><title>b1</title><pubDate>Tue, 02 Jan 2024 00:00:00 GMT</pubDate></item>"
+              b"</channel></rss>"),
+          ])
+      self.assertEqual(rendered.content_type, "application/rss+xml")
+      root = ET.fromstring(rendered.body)
+      self.assertEqual(root.findtext("channel/title"), "A + B (filtered)")
+      self.assertEqual([t.text for t in root.iterfind("channel/item/title")], ["b1", "a1", "undated"])
+      self.assertEqual(root.findtext("channel/link"), "http://a/")
+
+    def test_merged_dedupes_guids(self):
+      content = b"<rss><channel><title>A</title><item><title>a1</title><guid>1</guid></item></channel></rss>"
+      rendered = filter_feed.render_merged([
+          self.source("http://example.com/a", content),
+          self.source("http://example.com/mirror", content),
+          ])
+      root = ET.fromstring(rendered.body)
+      self.assertEqual(root.findtext("channel/title"), "A (filtered)")
+      self.assertEqual(len(root.findall("channel/item")), 1)
+
+    def test_merged_skips_other_format(self):
+      rendered = filter_feed.render_merged([
+          self.source("http://example.com/a",
+              b'<feed xmlns="http://www.w3.org/2005/Atom"><title>A</title>'
+              b'<entry><title>a1</title><updated>2024-01-01T00:00:00+00:00</updated></entry></feed>'),
+          self.source("http://example.com/b",
+              b"<rss><channel><title>B</title><item><title>b1</title></item></channel></rss>"),
+          ])
+      root = ET.fromstring(rendered.body)
+      self.assertEqual([t.text for t in root.iterfind("{http://www.w3.org/2005/Atom}entry/{http://www.w3.org/2005/Atom}title")],
+                       ["a1"])
+      self.assertEqual(root.findtext("{http://www.w3.org/2005/Atom}title"), "A (filtered)")
+
+
+class DecisionIndexTest(unittest.TestCase):
+    def setUp(self):
+      filter_feed.decision_index.clear()
+      self.addCleanup(filter_feed.decision_index.clear)
+
+    @staticmethod
+    def rss(*titles):
+      return ("<rss><channel><title>t</title>%s</channel></rss>" % "".join(
+          "<item><title>%s</title></item>" % t for t in titles)).encode()
+
+    def test_only_new_items_evaluated(self):
+      settings = ParsedTest.titleFilter("b")
+      before = filter_feed.Parsed(self.rss("a", "b", "c"), None)
+      self.assertEqual(before.dropMask(settings), [False, True, False])
+
+      after = filter_feed.Parsed(self.rss("new", "a", "b", "bb"), None)
+      with mock.patch.object(Item, 'rssColumns', wraps=Item.rssColumns) as columns:
+        self.assertEqual(after.dropMask(settings), [False, False, True, False])
+        evaluated = columns.call_args[0][0]
+      self.assertEqual([i.findtext("title") for i in evaluated], ["new", "bb"])
+
+    def test_keyed_by_filter(self):
+      parsed = filter_feed.Parsed(self.rss("a", "b"), None)
+      self.assertEqual(parsed.dropMask(ParsedTest.titleFilter("a")), [True, False])
+      self.assertEqual(parsed.dropMask(ParsedTest.titleFilter("b")), [False, True])
+
+    def test_matcher(self):
+      item = ET.fromstring("<item><title>b</title></item>")
+      with mock.patch.object(filter_feed, 'ItemView', wraps=filter_feed.ItemView) as view:
+        self.assertTrue(filter_feed.rssMatcher(ParsedTest.titleFilter("b"))(item))
+        self.assertTrue(filter_feed.rssMatcher(ParsedTest.titleFilter("b"))(copy.deepcopy(item)))
+        view.assert_called_once()
@@ -0,0 +1,60 @@
+from datetime import datetime, timezone, timedelta
+import unittest
+import xml.etree.ElementTree as ET
+
+import rules
+from item import Item, ItemView
+
+
+class ItemTest(unittest.TestCase):
+    def test_rss(self):
+      xml = ET.fromstring(
+              "<item><title>foo</title><pubDate>Sat, 05 Jun 2021 16:57:00 -0700</pubDate>"
+              "<description>bar</description></item>"
+              )
+      self.assertEqual(Item.fromRssItem(xml), Item(
+          title="foo",
+          date=datetime(2021, 6, 5, 16, 57, tzinfo=timezone(timedelta(hours=-7))),
+          description="bar"))
+
+    def test_atom(self):
+      xml = ET.fromstring(
+              "<entry xmlns=\"http://www.w3.org/2005/Atom\"><title>foo</title>"
+              "<updated>2021-06-05T16:57:00-07:00</updated></entry>"
+              )
+      self.assertEqual(Item.fromAtomEntry(xml), Item(
+          title="foo",
+          date=datetime(2021, 6, 5, 16, 57, tzinfo=timezone(timedelta(hours=-7))),
+          description=None))
+
+    def test_only_requested_fields(self):
+      xml = ET.fromstring(
+              "<item><title>foo</title><pubDate>not a date</pubDate></item>"
+              )
+      self.assertEqual(Item.rssFields(xml, {"title"}), {"title": "foo"})
+      self.assertEqual(Item.rssFields(xml, {"date"}), {"date": None})
+
+    def test_mapping(self):
+      item = Item(title="foo", date=None, description="bar")
+      self.assertFalse(hasattr(item, "__dict__"))
+      self.assertEqual(dict(item), {"title": "foo", "date": None, "description": "bar"})
+      self.assertIsNone(item.get("link"))
+      matches = rules.compile_rules({"condition": "AND", "rules": [{
+          "id": "title", "field": "title", "type": "string", "input": "text",
+          "operator": "equal", "value": "foo"}]})
+      self.assertTrue(matches(item))
+
+    def test_view(self):
+      xml = ET.fromstring(
+              "<entry xmlns='http://www.w3.org/2005/Atom'><title>foo</title>"
+              "<summary>bar</summary></entry>")
+      view = ItemView(xml, ItemView.tags(True, {"title", "date"}))
+      self.assertFalse(hasattr(view, "__dict__"))
+      self.assertEqual(dict(view), {"title": "foo", "date": None})
+      self.assertIsNone(view.get("description"))
+      with self.assertRaises(KeyError):
+        view["description"]
+      matches = rules.compile_rules({"condition": "AND", "rules": [{
+          "id": "title", "field": "title", "type": "string", "input": "text",
+          "operator": "equal", "value": "foo"}]})
+      self.assertTrue(matches(view))
@@ -0,0 +1,127 @@
+import unittest
+
+import requests_mock
+
+import fetch
+import filter_feed
+import metrics
+from model import FilterFeed
+
+URL = "http://example.com/feed"
+RSS = (b"<rss><channel><title>t</title><item><title>a</title></item>"
+       b"<item><title>b</title></item></channel></rss>")
+
+
+def setUpModule():
+    # The meter provider can only be set once per process.
+    if metrics.reader is None:
+        metrics.configure("memory")
+
+
+# The last value seen of each data point, by metric name and attributes. The
+# SDK leaves points that have not changed since the last collection out.
+_last = {}
+
+
+def points(name: str) -> dict:
+    """The value (or, for histograms, count) of each data point of the named
+    metric, by its attributes."""
+    data = metrics.reader.get_metrics_data()
+    for resource_metrics in data.resource_metrics if data else ():
+        for scope_metrics in resource_metrics.scope_metrics:
+            for metric in scope_metrics.metrics:
+                for point in metric.data.data_points:
+                    value = point.count if hasattr(point, "count") else point.value
+                    _last[metric.name, frozenset(point.attributes.items())] = value
+    return {attributes: value for (n, attributes), value in _last.items() if n == name}
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+      filter_feed.parsed_cache.clear()
+      self.addCleanup(filter_feed.parsed_cache.clear)
+      filter_feed.decision_index.clear()
+      self.addCleanup(filter_feed.decision_index.clear)
+      fetch.store.clear()
+      self.addCleanup(fetch.store.clear)
+
+    @staticmethod
+    def snapshot() -> dict:
+      return {name: points(name) for name in (
+          "filter_feed.phase.duration", "filter_feed.upstream.bytes", "filter_feed.items",
+          "filter_feed.cache.requests", "filter_feed.in_flight")}
+
+    def added(self, before: dict, name: str, **attributes) -> int:
+      key = frozenset(attributes.items())
+      return points(name).get(key, 0) - before[name].get(key, 0)
+
+    def test_phase(self):
+      before = self.snapshot()
+      with metrics.phase("test"):
+        pass
+      self.assertEqual(self.added(before, "filter_feed.phase.duration", phase="test"), 1)
+
+    def test_request(self):
+      before = self.snapshot()
+      with metrics.request("test"):
+        self.assertEqual(self.added(before, "filter_feed.in_flight", kind="test"), 1)
+      self.assertEqual(self.added(before, "filter_feed.in_flight", kind="test"), 0)
+
+    def test_render(self):
+      settings = FilterFeed(query_builder={
+          "condition": "AND",
+          "rules": [{"id": "title", "field": "title", "type": "string", "input": "text",
+                     "operator": "equal", "value": "a"}]})
+      before = self.snapshot()
+      with requests_mock.Mocker() as m:
+        m.get(URL, content=RSS, headers={"Content-Type": "application/rss+xml"})
+        upstream = fetch.fetch(URL)
+      filter_feed.render_tree(upstream, settings)
+      filter_feed.render_tree(upstream, settings)
+      self.assertEqual(self.added(before, "filter_feed.upstream.bytes"), len(RSS))
+      for phase, count in (("parse", 1), ("filter", 2), ("serialize", 2)):
+        with self.subTest(phase=phase):
+          self.assertEqual(self.added(before, "filter_feed.phase.duration", phase=phase), count)
+      self.assertEqual(self.added(before, "filter_feed.items", direction="in"), 4)
+      self.assertEqual(self.added(before, "filter_feed.items", direction="out"), 2)
+      for cache, result, count in (("parsed", "miss", 1), ("parsed", "hit", 1),
+                                   ("decision", "miss", 2), ("decision", "hit", 2)):
+        with self.subTest(cache=cache, result=result):
+          self.assertEqual(self.added(before, "filter_feed.cache.requests",
+                                      cache=cache, result=result), count)
+      self.assertEqual(self.added(before, "filter_feed.in_flight", kind="upstream"), 0)
+
+    def test_splice(self):
+      before = self.snapshot()
+      with requests_mock.Mocker() as m:
+        m.get(URL, content=RSS, headers={"Content-Type": "application/rss+xml"})
+        upstream = fetch.fetch(URL)
+      filter_feed.render_splice(upstream, self.settings())
+      self.assertEqual(self.added(before, "filter_feed.phase.duration", phase="splice"), 1)
+      self.assertEqual(self.added(before, "filter_feed.items", direction="in"), 2)
+      self.assertEqual(self.added(before, "filter_feed.items", direction="out"), 1)
+
+    def test_stream(self):
+      before = self.snapshot()
+      with requests_mock.Mocker() as m:
+        m.get(URL, content=RSS, headers={"Content-Type": "application/rss+xml"})
+        response = filter_feed.stream_feed(self.settings(url=URL))
+        self.assertEqual(self.added(before, "filter_feed.phase.duration", phase="stream"), 0)
+        body = b"".join(response.response)
+      self.assertIn(b"<title>a</title>", body)
+      self.assertNotIn(b"<title>b</title>", body)
+      self.assertEqual(self.added(before, "filter_feed.phase.duration", phase="stream"), 1)
+      self.assertEqual(self.added(before, "filter_feed.items", direction="in"), 2)
+      self.assertEqual(self.added(before, "filter_feed.items", direction="out"), 1)
+      self.assertEqual(self.added(before, "filter_feed.in_flight", kind="feed"), 0)
+
+    @staticmethod
+    def settings(**kwargs) -> FilterFeed:
+      return FilterFeed(query_builder={
+          "condition": "AND",
+          "rules": [{"id": "title", "field": "title", "type": "string", "input": "text",
+                     "operator": "not_equal", "value": "a"}]}, **kwargs)
+
+
+if __name__ == "__main__":
+    unittest.main()
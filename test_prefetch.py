@@ -0,0 +1,187 @@
+import hashlib
+import unittest
+from unittest import mock
+
+from google.cloud import ndb
+import requests
+import requests_mock
+
+from app import cloud_ndb
+import fetch
+import filter_feed
+import prefetch
+import settings_cache
+from model import FilterFeed
+
+URL = "http://example.com/a"
+RSS = b"<rss><channel><title>t</title><item><title>a</title></item></channel></rss>"
+QUERY = {"condition": "AND", "rules": []}
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.fingerprints = {}
+        self.refreshed = []
+        self.scheduler = prefetch.Scheduler(
+                self.refresh, max_feeds=2, min_interval=10, max_interval=100,
+                half_life=60, clock=self.clock)
+
+    def refresh(self, key, interval):
+        self.refreshed.append(key)
+        fingerprint = self.fingerprints.get(key, "same")
+        if isinstance(fingerprint, Exception):
+            raise fingerprint
+        return fingerprint
+
+    def test_refreshes_hottest(self):
+        for key, hits in (("a", 3), ("b", 1), ("c", 2)):
+            for _ in range(hits):
+                self.scheduler.record(key)
+        self.clock.now = 10
+        self.scheduler.run_once()
+        self.assertCountEqual(self.refreshed, ["a", "c"])
+
+    def test_requests_decay(self):
+        for _ in range(3):
+            self.scheduler.record("a")
+        self.clock.now = 600
+        self.scheduler.record("b")
+        self.scheduler.record("c")
+        self.clock.now = 610
+        self.scheduler.run_once()
+        self.assertCountEqual(self.refreshed, ["b", "c"])
+
+    def test_not_due(self):
+        self.scheduler.record("a")
+        self.clock.now = 5
+        self.scheduler.run_once()
+        self.assertEqual(self.refreshed, [])
+
+    def test_interval_grows_when_unchanged(self):
+        self.scheduler.record("a")
+        self.clock.now = 10
+        self.scheduler.run_once()
+        self.assertEqual(self.scheduler.interval("a"), 10)
+        self.clock.now = 20
+        self.scheduler.run_once()
+        self.assertEqual(self.scheduler.interval("a"), 15)
+        for _ in range(20):
+            self.clock.now += 100
+            self.scheduler.run_once()
+        self.assertEqual(self.scheduler.interval("a"), 100)
+
+    def test_interval_shrinks_when_changed(self):
+        self.scheduler.record("a")
+        for _ in range(10):
+            self.clock.now += 100
+            self.scheduler.run_once()
+        self.assertEqual(self.scheduler.interval("a"), 100)
+        self.fingerprints["a"] = "changed"
+        self.clock.now += 100
+        self.scheduler.run_once()
+        self.assertEqual(self.scheduler.interval("a"), 50)
+
+    def test_forgets_deleted(self):
+        self.scheduler.record("a")
+        self.fingerprints["a"] = None
+        self.clock.now = 10
+        self.scheduler.run_once()
+        self.assertFalse(self.scheduler.tracks("a"))
+
+    def test_failure_retries_later(self):
+        self.scheduler.record("a")
+        self.fingerprints["a"] = IOError("upstream down")
+        self.clock.now = 10
+        self.scheduler.run_once()
+        self.scheduler.run_once()
+        self.assertEqual(self.refreshed, ["a"])
+        self.clock.now = 20
+        self.scheduler.run_once()
+        self.assertEqual(self.refreshed, ["a", "a"])
+
+    def test_evicts_coldest(self):
+        for i in range(self.scheduler.max_tracked):
+            self.scheduler.record(i)
+            self.scheduler.record(i)
+        self.scheduler.record("new")
+        self.assertTrue(self.scheduler.tracks("new"))
+        self.assertEqual(sum(self.scheduler.tracks(i) for i in range(self.scheduler.max_tracked)),
+                         self.scheduler.max_tracked - 1)
+
+
+class TestRefresher(unittest.TestCase):
+    def setUp(self):
+        for c in (fetch.store, fetch.hosts, fetch._unavailable, filter_feed.render_cache,
+                  filter_feed.served_cache, filter_feed.merged_cache):
+            c.clear()
+            self.addCleanup(c.clear)
+        self.requests = requests_mock.Mocker()
+        self.requests.start()
+        self.addCleanup(self.requests.stop)
+        self.requests.get(URL, content=RSS)
+        self.refresh = prefetch.refresher(cloud_ndb.context)
+        with cloud_ndb.context():
+            self.key = ndb.Key("User", 949, "FilterFeed", 123)
+
+    def settings(self, settings):
+        patch = mock.patch.object(settings_cache, 'get', return_value=settings)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_deleted(self):
+        self.settings(None)
+        self.assertIsNone(self.refresh(self.key, 600))
+        self.assertEqual(self.requests.call_count, 0)
+
+    def test_fresh_for_fresh_ttl(self):
+        settings = FilterFeed(url=URL, query_builder=QUERY)
+        self.settings(settings)
+        fingerprint = self.refresh(self.key, 600)
+        self.assertEqual(fingerprint, fetch.Upstream(URL, RSS, None).fingerprint)
+        served = filter_feed.served_cache.get(filter_feed._served_key(self.key, settings))
+        # Not until the next refresh, 600s away.
+        self.assertAlmostEqual(served.fresh_until - filter_feed.served_cache.clock(),
+                               filter_feed.FEED_FRESH_TTL, delta=1)
+        self.assertIn(b"(filtered)", served.rendered.body)
+
+    def test_extra_urls_merged(self):
+        settings = FilterFeed(url=URL, extra_urls=["http://example.com/b"], query_builder=QUERY)
+        self.settings(settings)
+        self.requests.get("http://example.com/b",
+                          content=b"<rss><channel><title>u</title><item><title>b</title></item></channel></rss>")
+        self.assertIsNotNone(self.refresh(self.key, 600))
+        self.assertEqual(self.requests.call_count, 2)
+        served = filter_feed.served_cache.get(filter_feed._served_key(self.key, settings))
+        self.assertIn(b"t + u (filtered)", served.rendered.body)
+
+
+class TestHttpRefresher(unittest.TestCase):
+    def setUp(self):
+        self.requests = requests_mock.Mocker()
+        self.requests.start()
+        self.addCleanup(self.requests.stop)
+        self.refresh = prefetch.http_refresher("https://filter-feed.example/")
+        with cloud_ndb.context():
+            self.key = ndb.Key("User", 949, "FilterFeed", 123)
+
+    def test_fingerprint(self):
+        self.requests.get("https://filter-feed.example/v1/949/123", content=RSS)
+        self.assertEqual(self.refresh(self.key, 600), hashlib.sha256(RSS).hexdigest())
+
+    def test_not_found_forgets(self):
+        self.requests.get("https://filter-feed.example/v1/949/123", status_code=404)
+        self.assertIsNone(self.refresh(self.key, 600))
+
+    def test_error_retries(self):
+        self.requests.get("https://filter-feed.example/v1/949/123", status_code=502)
+        with self.assertRaises(requests.HTTPError):
+            self.refresh(self.key, 600)
@@ -0,0 +1,128 @@
+from datetime import datetime
+import unittest
+
+from jqqb_evaluator.evaluator import Evaluator
+
+import rules
+
+
+def rule(operator, value, field="title", type="string"):
+    return {"id": field, "field": field, "type": type, "input": "text",
+            "operator": operator, "value": value}
+
+
+ITEMS = [
+    {"title": "Boring Ep", "date": datetime(2021, 6, 5), "description": "  "},
+    {"title": "Interesting Ep", "date": datetime(2022, 1, 1), "description": "Blah"},
+    {"title": "", "date": datetime(2020, 1, 1), "description": "Boring"},
+]
+
+
+class CompileTest(unittest.TestCase):
+    def assertEquivalent(self, query_builder, items=ITEMS):
+        evaluator = Evaluator(query_builder)
+        predicate = rules.compile_rules(query_builder)
+        for item in items:
+            with self.subTest(query_builder=query_builder, item=item):
+                self.assertEqual(predicate(item), evaluator.object_matches_rules(item))
+        columns = {k: [item[k] for item in items] for k in items[0]}
+        with self.subTest(query_builder=query_builder, engine="column"):
+            self.assertEqual(
+                rules.compile_column_rules(query_builder)(columns, len(items)),
+                [evaluator.object_matches_rules(item) for item in items])
+
+    def test_string_operators(self):
+        for operator, value in [
+                ("begins_with", "Boring"), ("not_begins_with", "Boring"),
+                ("contains", "Ep"), ("not_contains", "Ep"),
+                ("ends_with", "Ep"), ("not_ends_with", "Ep"),
+                ("equal", "Boring Ep"), ("not_equal", "Boring Ep"),
+                ("in", "ing"), ("not_in", "ing"),
+                ("is_empty", None), ("is_not_empty", None),
+                ("is_null", None), ("is_not_null", None),
+                ("less", "C"), ("greater_or_equal", "C"),
+                ("between", ["A", "C"]), ("not_between", ["A", "C"])]:
+            for field in ("title", "description"):
+                self.assertEquivalent(
+                    {"condition": "AND", "rules": [rule(operator, value, field=field)]})
+
+    def test_date_operators(self):
+        for operator in ("less", "greater", "less_or_equal", "greater_or_equal"):
+            self.assertEquivalent({"condition": "AND", "rules": [
+                rule(operator, "2021-06-05T00:00:00.000Z", field="date", type="datetime")]})
+
+    def test_groups(self):
+        contains = rule("contains", "Boring")
+        not_empty = rule("is_not_empty", None, field="description")
+        for condition in ("AND", "OR"):
+            self.assertEquivalent({"condition": condition, "rules": []})
+            self.assertEquivalent({"condition": condition, "rules": [contains, not_empty]})
+            self.assertEquivalent({"condition": condition, "rules": [
+                contains, {"condition": "OR", "rules": [not_empty, rule("equal", "")]}]})
+
+    def test_missing_field_raises(self):
+        predicate = rules.compile_rules({"condition": "AND", "rules": [rule("contains", "x")]})
+        with self.assertRaises(TypeError):
+            predicate({"title": None})
+
+    def test_short_circuit_guards(self):
+        query_builder = {"condition": "AND", "rules": [
+            rule("is_not_null", None), rule("contains", "x")]}
+        items = [{"title": None}, {"title": "x"}]
+        self.assertEqual([rules.compile_rules(query_builder)(i) for i in items], [False, True])
+        self.assertEqual(
+            rules.compile_column_rules(query_builder)({"title": [None, "x"]}, 2),
+            [False, True])
+
+    def test_malformed_raises_on_evaluation(self):
+        predicate = rules.compile_rules(None)
+        with self.assertRaises(TypeError):
+            predicate(ITEMS[0])
+
+    def test_unknown_operator_raises_on_evaluation(self):
+        predicate = rules.compile_rules({"condition": "OR", "rules": [rule("regex", "x")]})
+        with self.assertRaises(AttributeError):
+            predicate(ITEMS[0])
+
+
+class CompiledTest(unittest.TestCase):
+    def test_cached_by_hash(self):
+        a = {"condition": "AND", "rules": [rule("contains", "x")]}
+        b = {"rules": [rule("contains", "x")], "condition": "AND"}
+        self.assertIs(rules.compiled(a), rules.compiled(b))
+        self.assertIsNot(rules.compiled(a), rules.compiled({"condition": "OR", "rules": a["rules"]}))
+
+
+class ColumnTest(unittest.TestCase):
+    def test_missing_column(self):
+        predicate = rules.compile_column_rules(
+            {"condition": "OR", "rules": [rule("is_null", None, field="description")]})
+        self.assertEqual(predicate({"title": ["a", "b"]}, 2), [True, True])
+
+    def test_malformed_raises_on_evaluation(self):
+        predicate = rules.compile_column_rules(None)
+        with self.assertRaises(TypeError):
+            predicate({"title": ["a"]}, 1)
+
+
+class RowTest(unittest.TestCase):
+    def test_view(self):
+        columns = {k: [item[k] for item in ITEMS] for k in ITEMS[0]}
+        row = rules.Row(columns, 1)
+        self.assertEqual(dict(row), ITEMS[1])
+        self.assertIsNone(row.get("link"))
+        columns["title"][1] = "Changed"
+        self.assertEqual(row["title"], "Changed")
+
+
+class ReferencedFieldsTest(unittest.TestCase):
+    def test_nested(self):
+        self.assertEqual(
+            rules.referenced_fields({"condition": "AND", "rules": [
+                rule("contains", "x"),
+                {"condition": "OR", "rules": [rule("less", "x", field="date.year")]}]}),
+            frozenset(["title", "date"]))
+
+    def test_malformed(self):
+        self.assertIsNone(rules.referenced_fields(None))
+        self.assertIsNone(rules.referenced_fields({"condition": "AND"}))
@@ -0,0 +1,63 @@
+import threading
+import unittest
+import xml.etree.ElementTree as ET
+
+from xml_backend import NamespaceRecordingTreeBuilder
+import serializer
+
+
+def parse(xml):
+    tb = NamespaceRecordingTreeBuilder()
+    return ET.fromstring(xml, parser=ET.XMLParser(target=tb)), tb.ns
+
+
+class TostringTest(unittest.TestCase):
+    def test_recorded_prefixes(self):
+        root, ns = parse('<rss xmlns:itunes="http://itunes/"><itunes:image href="x"/></rss>')
+        self.assertEqual(serializer.tostring(root, ns),
+                         '<rss xmlns:itunes="http://itunes/"><itunes:image href="x" /></rss>')
+
+    def test_default_namespace(self):
+        root, ns = parse('<feed xmlns="http://www.w3.org/2005/Atom"><title>a</title></feed>')
+        self.assertEqual(serializer.tostring(root, ns),
+                         '<feed xmlns="http://www.w3.org/2005/Atom"><title>a</title></feed>')
+
+    def test_default_namespace_with_unqualified(self):
+        root = ET.fromstring('<a xmlns="http://a/"><b xmlns=""/></a>')
+        out = serializer.tostring(root, {"": "http://a/"})
+        self.assertEqual(out, '<ns0:a xmlns:ns0="http://a/"><b /></ns0:a>')
+        self.assertEqual(ET.tostring(ET.fromstring(out)), ET.tostring(root))
+
+    def test_default_namespace_attribute(self):
+        root = ET.fromstring('<a xmlns="http://a/" xmlns:p="http://a/" p:x="1"/>')
+        out = serializer.tostring(root, {"": "http://a/"})
+        self.assertEqual(ET.fromstring(out).attrib, {"{http://a/}x": "1"})
+
+    def test_prefix_clash(self):
+        root = ET.fromstring('<a xmlns:p="http://1/"><p:b/><c xmlns:p="http://2/"><p:d/></c></a>')
+        out = serializer.tostring(root, {"p": "http://2/"})
+        self.assertEqual(ET.tostring(ET.fromstring(out)), ET.tostring(root))
+
+    def test_xml_namespace(self):
+        root, ns = parse('<a xml:lang="en"/>')
+        self.assertEqual(serializer.tostring(root, ns), '<a xml:lang="en" />')
+
+    def test_global_map_untouched(self):
+        before = dict(ET._namespace_map)
+        root, ns = parse('<rss xmlns:itunes="http://itunes/"><itunes:image/></rss>')
+        serializer.tostring(root, ns)
+        self.assertEqual(ET._namespace_map, before)
+
+    def test_threads(self):
+        docs = [parse('<r xmlns:p%d="http://same/"><p%d:x/></r>' % (i, i)) for i in range(8)]
+        results = {}
+        def run(i):
+            for _ in range(200):
+                results.setdefault(i, set()).add(serializer.tostring(*docs[i]))
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for i in range(8):
+            self.assertEqual(results[i], {'<r xmlns:p%d="http://same/"><p%d:x /></r>' % (i, i)})
@@ -0,0 +1,99 @@
+from unittest import mock
+import unittest
+
+from google.cloud import ndb
+from google.cloud.datastore_v1 import types as datastore_type
+
+from app import app, cloud_ndb
+import ndb_mocks
+import settings_cache
+
+
+class SettingsCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.stub = ndb_mocks.MockDatastoreStub()
+        self.ndb_patch = mock.patch.object(cloud_ndb.client, 'stub', new=self.stub)
+        self.ndb_patch.start()
+        self.addCleanup(self.ndb_patch.stop)
+        settings_cache.clear()
+        self.addCleanup(settings_cache.clear)
+
+    def found(self):
+        e = datastore_type.Entity(
+          properties = {
+            "url": datastore_type.Value(string_value="http://example.com/a"), 
+            "name": datastore_type.Value(string_value="nickname"),  
+            "query_builder": datastore_type.Value(blob_value=b'{"condition":"AND","rules":[]}')}, 
+          key = {"partition_id":{"project_id":app.config["NDB_PROJECT"]},"path": [
+              {"kind": "User", "id": 949},{"kind": "FilterFeed", "id": 123}]})
+        self.stub.lookup.set_val(datastore_type.LookupResponse(found=[{"entity":e}]))
+
+
+class TestGet(SettingsCacheTestCase):
+    def test_cached(self):
+        self.found()
+        with cloud_ndb.context():
+            key = ndb.Key("User", 949, "FilterFeed", 123)
+            self.assertEqual(settings_cache.get(key).name, "nickname")
+            self.assertEqual(settings_cache.get(key).name, "nickname")
+        self.stub.lookup.assert_called_once()
+
+    def test_invalidate(self):
+        self.found()
+        with cloud_ndb.context():
+            key = ndb.Key("User", 949, "FilterFeed", 123)
+            settings_cache.get(key)
+        settings_cache.invalidate(key)
+        with cloud_ndb.context():
+            settings_cache.get(key)
+        self.assertEqual(self.stub.lookup.call_count, 2)
+
+    def test_missing_not_cached(self):
+        e = datastore_type.Entity(key = {
+            "partition_id":{"project_id":app.config["NDB_PROJECT"]},
+            "path": [{"kind": "FilterFeed", "id": 321}]})
+        self.stub.lookup.set_val(datastore_type.LookupResponse(missing=[{"entity":e}]))
+        with cloud_ndb.context():
+            key = ndb.Key("FilterFeed", 321)
+            self.assertIsNone(settings_cache.get(key))
+        with cloud_ndb.context():
+            self.assertIsNone(settings_cache.get(key))
+        self.assertEqual(self.stub.lookup.call_count, 2)
+
+    def test_get_multi(self):
+        self.found()
+        with cloud_ndb.context():
+            key = ndb.Key("User", 949, "FilterFeed", 123)
+            settings_cache.get(key)
+        e = datastore_type.Entity(key = {
+            "partition_id":{"project_id":app.config["NDB_PROJECT"]},
+            "path": [{"kind": "User", "id": 949},{"kind": "FilterFeed", "id": 456}]})
+        self.stub.lookup.set_val(datastore_type.LookupResponse(missing=[{"entity":e}]))
+        with cloud_ndb.context():
+            other = ndb.Key("User", 949, "FilterFeed", 456)
+            found = settings_cache.get_multi([key, other])
+        self.assertEqual(found[0].name, "nickname")
+        self.assertIsNone(found[1])
+        # Only the miss was looked up.
+        self.assertEqual(self.stub.lookup.call_count, 2)
+        self.assertEqual(len(self.stub.lookup.call_args[0][0].keys), 1)
+
+class TestGlobalCache(SettingsCacheTestCase):
+    def setUp(self):
+        super().setUp()
+        for name, value in (("NDB_GLOBAL_CACHE", "memory"), ("_global_cache", None)):
+            patch = mock.patch.object(settings_cache, name, new=value)
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_shared_between_contexts(self):
+        self.found()
+        context = settings_cache.context(cloud_ndb.client)
+        with context():
+            key = ndb.Key("User", 949, "FilterFeed", 123)
+            settings_cache.get(key)
+        # As if in another process.
+        settings_cache.clear()
+        with context():
+            self.assertEqual(settings_cache.get(key).name, "nickname")
+        self.stub.lookup.assert_called_once()
@@ -0,0 +1,92 @@
+import os
+import unittest
+import xml.etree.ElementTree as ET
+
+import streaming
+
+TESTDATA = os.path.join(os.path.dirname(__file__),  'testdata/')
+ATOM = "{http://www.w3.org/2005/Atom}"
+
+
+def rss_layout(tag):
+    return streaming.Layout(
+        item_path=(tag, "channel", "item"),
+        title_path=(tag, "channel", "title"),
+        drop=lambda i: "Boring" in i.findtext("title", ""))
+
+
+def atom_layout(tag):
+    return streaming.Layout(
+        item_path=(tag, ATOM + "entry"),
+        title_path=(tag, ATOM + "title"),
+        drop=lambda i: "Boring" in i.findtext(ATOM + "title", ""))
+
+
+def run(layout_for_root, data, chunk_size):
+    sf = streaming.StreamingFilter(layout_for_root)
+    out = [sf.feed(data[i:i + chunk_size]) for i in range(0, len(data), chunk_size)]
+    out.append(sf.close())
+    return b"".join(out)
+
+
+class StreamingFilterTest(unittest.TestCase):
+    def test_golden(self):
+        with open(os.path.join(TESTDATA, "rss.xml"), "rb") as f:
+            data = f.read()
+        for chunk_size in (1, 7, 64, len(data)):
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(
+                    ET.canonicalize(run(rss_layout, data, chunk_size).decode()),
+                    ET.canonicalize(from_file=os.path.join(TESTDATA, "rss-filtered.xml")))
+
+    def test_passes_through_bytes(self):
+        data = (b'<rss xmlns:a="http://a/"><channel><title>T</title>'
+                b'<item><title>Boring</title></item>\n'
+                b'<item  a:x="1"><title>Good</title><!-- c --></item>\n'
+                b'<item/></channel></rss>')
+        self.assertEqual(
+            run(rss_layout, data, 5),
+            b'<rss xmlns:a="http://a/"><channel><title>T (filtered)</title>'
+            b'<item  a:x="1"><title>Good</title><!-- c --></item>\n'
+            b'<item/></channel></rss>')
+
+    def test_atom(self):
+        data = (b'<feed xmlns="http://www.w3.org/2005/Atom"><title>T</title>'
+                b'<entry><title>Good</title></entry>'
+                b'<entry><title>Boring</title></entry></feed>')
+        self.assertEqual(
+            run(atom_layout, data, 3),
+            b'<feed xmlns="http://www.w3.org/2005/Atom"><title>T (filtered)</title>'
+            b'<entry><title>Good</title></entry></feed>')
+
+    def test_empty_title(self):
+        data = b'<rss><channel><title/></channel></rss>'
+        self.assertEqual(run(rss_layout, data, 4), data)
+
+    def test_unknown_format(self):
+        data = b'<html><channel><item><title>Boring</title></item></channel></html>'
+        self.assertEqual(run(lambda tag: None, data, 4), data)
+
+    def test_encoding(self):
+        data = ('<?xml version="1.0" encoding="ISO-8859-1"?>'
+                '<rss><channel><title>Caf\xe9</title></channel></rss>').encode("iso-8859-1")
+        self.assertEqual(
+            run(rss_layout, data, 4).decode("iso-8859-1"),
+            '<?xml version="1.0" encoding="ISO-8859-1"?>'
+            '<rss><channel><title>Caf\xe9 (filtered)</title></channel></rss>')
+
+    def test_malformed(self):
+        with self.assertRaises(Exception):
+            run(rss_layout, b'<rss><channel></rss>', 4)
+
+
+class SpliceTest(unittest.TestCase):
+    def test_keeps_formatting(self):
+        with open(os.path.join(TESTDATA, "rss.xml"), "rb") as f:
+            data = f.read()
+        out = streaming.splice(data, rss_layout)
+        start = data.index(b"\t\t<item>")
+        end = data.index(b"\t\t<item>", start + 1)
+        self.assertEqual(
+            out,
+            data[:start].replace(b"Example Pod", b"Example Pod (filtered)") + data[end:])
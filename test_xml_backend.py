@@ -0,0 +1,60 @@
+import os
+import unittest
+import xml.etree.ElementTree as ET
+
+import xml_backend
+
+TESTDATA = os.path.join(os.path.dirname(__file__),  'testdata/')
+
+BACKENDS = [xml_backend.EtreeDocument]
+if xml_backend.lxml_etree is not None:
+    BACKENDS.append(xml_backend.LxmlDocument)
+
+ATOM = (b'<feed xmlns="http://www.w3.org/2005/Atom"><title>A</title>\n'
+        b'<entry><title>a1</title></entry>\n<entry><title>a2</title></entry>\n</feed>')
+
+
+class DocumentTest(unittest.TestCase):
+    def setUp(self):
+      with open(os.path.join(TESTDATA, "rss.xml"), "rb") as f:
+        self.rss = f.read()
+
+    def test_filtered(self):
+      for backend in BACKENDS:
+        with self.subTest(backend=backend.__name__):
+          doc = backend(self.rss)
+          before = doc.tostring(doc.root)
+          items = doc.findall(xml_backend.ITEMS[False])
+          root = doc.filtered(False, items, [True, False], "Example Pod (filtered)")
+          self.assertEqual(
+              ET.canonicalize(doc.tostring(root)),
+              ET.canonicalize(from_file=os.path.join(TESTDATA, "rss-filtered.xml")))
+          self.assertEqual(doc.tostring(doc.root), before)
+
+    def test_filtered_atom(self):
+      for backend in BACKENDS:
+        with self.subTest(backend=backend.__name__):
+          doc = backend(ATOM)
+          items = doc.findall(xml_backend.ITEMS[True])
+          self.assertEqual(len(items), 2)
+          root = doc.filtered(True, items, [False, True], "B")
+          self.assertEqual(
+              ET.canonicalize(doc.tostring(root)),
+              ET.canonicalize('<feed xmlns="http://www.w3.org/2005/Atom"><title>B</title>\n'
+                              '<entry><title>a1</title></entry>\n</feed>'))
+
+    def test_merged(self):
+      for backend in BACKENDS:
+        with self.subTest(backend=backend.__name__):
+          doc = backend(b"<rss><channel><title>A</title><item>a</item><link/></channel></rss>")
+          other = backend(b"<rss><channel><title>B</title><item>b</item></channel></rss>")
+          items = other.findall(xml_backend.ITEMS[False]) + doc.findall(xml_backend.ITEMS[False])
+          root = doc.merged(False, doc.findall(xml_backend.ITEMS[False]), items, "A + B")
+          self.assertEqual(
+              ET.canonicalize(doc.tostring(root)),
+              "<rss><channel><title>A + B</title><item>b</item><item>a</item><link></link></channel></rss>")
+          self.assertEqual(len(other.findall(xml_backend.ITEMS[False])), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
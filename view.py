@@ -7,6 +7,7 @@ from google.cloud import ndb  # type: Any
 from opentelemetry import  trace
 import json
 
+import filter_feed
 import model
 from flask_wtf.form import FlaskForm
 from wtforms import StringField, URLField, HiddenField
@@ -51,6 +52,7 @@ def create_feed(request: flask.Request) -> flask.Response:
         logging.info("Creating feed %s",  feed)
         key = feed.put()
         logging.info("Feed created with key %s",  key)
+        filter_feed.invalidate(key)
         return flask.redirect(flask.url_for('list_feeds'))
     else:
         return flask.render_template('get.html', form=form, filter=filter,  new=True)
@@ -68,6 +70,7 @@ def update_feed(request: flask.Request,  key: ndb.Key) -> flask.Response:
     feed.query_builder = form.query_builder.data
     logging.info("Updating feed from %s to %s",  old_feed,  repr(feed))
     feed.put()
+    filter_feed.invalidate(key)
     return flask.redirect(flask.url_for('list_feeds'))
 
 def delete_feed(request: flask.Request, key: ndb.Key) -> flask.Response:
@@ -78,4 +81,5 @@ def delete_feed(request: flask.Request, key: ndb.Key) -> flask.Response:
     form.validate()  # still needex cor CSRF
     logging.info("Deleting feed %s",  feed)
     feed.key.delete()
+    filter_feed.invalidate(key)
     return flask.redirect(flask.url_for('list_feeds'))
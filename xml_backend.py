@@ -0,0 +1,195 @@
+"""Parses, filters and serializes feed documents with either ElementTree or
+lxml.
+
+XML_BACKEND picks the implementation: "etree" (the default) or "lxml", which
+falls back to "etree" when lxml is not installed. Both expose the same
+ElementTree-style elements, so Item and the rules work on either.
+"""
+
+import copy
+import os
+from typing import Any, Collection, Mapping, Optional
+import xml.etree.ElementTree as ET
+
+from absl import logging
+
+import serializer
+
+try:
+    from lxml import etree as lxml_etree  # type: Any
+except ImportError:
+    lxml_etree = None
+
+XML_BACKEND = os.environ.get("XML_BACKEND", "etree").lower()
+if XML_BACKEND == "lxml" and lxml_etree is None:
+    logging.warning("XML_BACKEND is lxml, but lxml is not installed; using etree")
+    XML_BACKEND = "etree"
+
+ATOM = "http://www.w3.org/2005/Atom"
+ATOM_NS = "{%s}" % ATOM
+
+# ElementPath expressions selecting the items, title and the element that
+# holds the items of an RSS (False) or Atom (True) document.
+ITEMS = {False: ".//item", True: ".//%sentry" % ATOM_NS}
+TITLE = {False: ".//channel/title", True: "./%stitle" % ATOM_NS}
+CONTAINER = {False: "channel", True: "."}
+
+
+class NamespaceRecordingTreeBuilder(ET.TreeBuilder):
+    def __init__(self, *args,  **kwargs):
+        self.ns = {}
+        super().__init__(*args,  **kwargs)
+
+    def start_ns(self,  prefix,  uri):
+        self.ns[prefix] = uri
+
+
+class EtreeDocument:
+    """A document parsed with xml.etree.ElementTree.
+
+    The tree is never modified: filtered() and merged() copy only the
+    elements on the path to the items and title they change, and share the
+    rest with the parsed tree.
+    """
+
+    def __init__(self, content: bytes):
+        tb = NamespaceRecordingTreeBuilder()
+        self.root = ET.fromstring(content, parser=ET.XMLParser(target=tb))
+        # Prefixes as declared in the document, to reuse when serializing.
+        self.ns = tb.ns
+        self._parents = {id(child): parent for parent in self.root.iter() for child in parent}
+
+    def findall(self, path: str) -> list:
+        return list(self.root.iterfind(path))
+
+    def find(self, path: str) -> Optional[ET.Element]:
+        return self.root.find(path)
+
+    def _rewrite(self, replaced: dict, dropped: Collection[int] = ()) -> ET.Element:
+        # Only the ancestors of changed elements need copying.
+        changed = set()
+        for el_id in list(dropped) + list(replaced):
+            parent = self._parents.get(el_id)
+            while parent is not None and id(parent) not in changed:
+                changed.add(id(parent))
+                parent = self._parents.get(id(parent))
+
+        def rewrite(el: ET.Element) -> ET.Element:
+            if id(el) in replaced:
+                return replaced[id(el)]
+            if id(el) not in changed:
+                return el
+            new = copy.copy(el)
+            # Like Element.remove, a dropped child takes its tail with it.
+            new[:] = [rewrite(c) for c in el if id(c) not in dropped]
+            return new
+        return rewrite(self.root)
+
+    def _retitled(self, atom: bool, title: Optional[str]) -> dict:
+        el = self.find(TITLE[atom])
+        if el is None or title is None:
+            return {}
+        new = copy.copy(el)
+        new.text = title
+        return {id(el): new}
+
+    def filtered(self, atom: bool, items: list, dropped: list[bool],
+                 title: Optional[str]) -> ET.Element:
+        """Returns the document without the dropped items, retitled."""
+        return self._rewrite(self._retitled(atom, title),
+                             {id(i) for i, drop in zip(items, dropped) if drop})
+
+    def merged(self, atom: bool, own: list, items: list, title: Optional[str]) -> ET.Element:
+        """Returns the document with its own items replaced by items, which
+        can belong to other EtreeDocuments, retitled."""
+        container = self.find(CONTAINER[atom])
+        own_ids = {id(i) for i in own}
+        replaced = self._retitled(atom, title)
+        children = [replaced.get(id(c), c) for c in container if id(c) not in own_ids]
+        # The items go where the document's own items started.
+        at = next((n for n, c in enumerate(container) if id(c) in own_ids), len(children))
+        new = copy.copy(container)
+        new[:] = children[:at] + items + children[at:]
+        replaced[id(container)] = new
+        # Items outside the container are dropped as well.
+        return self._rewrite(replaced, own_ids)
+
+    def tostring(self, root: ET.Element, ns: Optional[Mapping[str, str]] = None) -> bytes:
+        return serializer.tostring(root, self.ns if ns is None else ns).encode('utf-8')
+
+
+class LxmlDocument:
+    """A document parsed with lxml.
+
+    lxml elements can only have one parent, so filtered() and merged() deep
+    copy the tree (in C) and edit the copy. Items are selected with compiled
+    XPath, and namespace declarations are kept on the elements themselves.
+    """
+
+    _XPATHS = {}  # type: dict[str, Any]
+
+    def __init__(self, content: bytes):
+        parser = lxml_etree.XMLParser(resolve_entities=False, no_network=True)
+        self.root = lxml_etree.fromstring(content, parser=parser)
+        self.ns = {}  # type: dict[str, str]
+
+    @classmethod
+    def _xpath(cls, path: str):
+        xpath = cls._XPATHS.get(path)
+        if xpath is None:
+            # ElementPath to XPath, for the paths used here.
+            expr = path.replace(ATOM_NS, "a:")
+            if expr.startswith(".//"):
+                expr = "descendant::" + expr[3:]
+            elif expr.startswith("./"):
+                expr = expr[2:]
+            xpath = cls._XPATHS[path] = lxml_etree.XPath(expr, namespaces={"a": ATOM})
+        return xpath
+
+    def findall(self, path: str, root: Any = None) -> list:
+        return self._xpath(path)(self.root if root is None else root)
+
+    def find(self, path: str, root: Any = None) -> Optional[Any]:
+        found = self.findall(path, root)
+        return found[0] if found else None
+
+    def _copy(self, atom: bool, title: Optional[str]) -> Any:
+        root = copy.deepcopy(self.root)
+        el = self.find(TITLE[atom], root)
+        if el is not None and title is not None:
+            el.text = title
+        return root
+
+    def filtered(self, atom: bool, items: list, dropped: list[bool],
+                 title: Optional[str]) -> Any:
+        root = self._copy(atom, title)
+        # The copy's items are in the same order as the original's.
+        for item, drop in zip(self.findall(ITEMS[atom], root), dropped):
+            if drop:
+                # Like ElementTree, the item's tail goes with it.
+                item.getparent().remove(item)
+        return root
+
+    def merged(self, atom: bool, own: list, items: list, title: Optional[str]) -> Any:
+        root = self._copy(atom, title)
+        container = root if CONTAINER[atom] == "." else self.find(CONTAINER[atom], root)
+        # The copy's own items, rather than the given originals.
+        own = self.findall(ITEMS[atom], root)
+        at = len(container)
+        for item in own:
+            if item.getparent() is container:
+                at = min(at, container.index(item))
+        # Everything before the first own item stays, so at is still right
+        # once they are removed.
+        for item in own:
+            item.getparent().remove(item)
+        for n, item in enumerate(items):
+            container.insert(at + n, copy.deepcopy(item))
+        return root
+
+    def tostring(self, root: Any, ns: Optional[Mapping[str, str]] = None) -> bytes:
+        return lxml_etree.tostring(root, encoding="UTF-8", xml_declaration=False)
+
+
+def document_class() -> type:
+    return LxmlDocument if XML_BACKEND == "lxml" else EtreeDocument